@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import argparse
+import time
+from rdkit import Chem
+from io_utils import open_prediction_writer, checkpoint_name, iter_smiles_chunks, PREDICTION_WRITERS
+
+# Training arguments that change how chemprop builds the molecules from the SMILES (hydrogens and atom maps)
+FEATURIZATION_ARGS = ('explicit_h', 'adding_h', 'keeping_atom_map')
+
+class ChempropScorer:
+    """Score molecules with several chemprop (GNN) checkpoints at once
+    Every checkpoint is loaded once. The molecular graph of each batch is built once and shared by all
+    checkpoints, and inference runs on the CPU with `num_threads` torch threads. The hydrogen and atom map
+    settings the checkpoints were trained with are applied to the featurization, so they must be the same for
+    all checkpoints.
+    """
+    def __init__(self, checkpoints, num_threads=None):
+        """
+        Args:
+            checkpoints (list): Paths of the chemprop checkpoints (e.g. data/HitGen/models/CK1a/chemprop.pt)
+            num_threads (int, optional): Number of torch threads. Defaults to None (torch default)
+        """
+        import torch
+        from chemprop.utils import load_checkpoint, load_scalers, load_args
+        from chemprop.features import mol2graph, set_explicit_h, set_adding_hs, set_keeping_atom_map
+        self.torch = torch
+        self.mol2graph = mol2graph
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.models = {}
+        self.scalers = {}
+        featurization = None
+        for checkpoint in checkpoints:
+            train_args = load_args(checkpoint)
+            # The shared graph only holds the default atom/bond features, so checkpoints trained with
+            # extra molecule-level features or descriptors cannot be scored here
+            if any(getattr(train_args, arg, None) for arg in ('features_generator', 'features_path', 'atom_descriptors',
+                                                               'bond_descriptors', 'reaction')) \
+                    or getattr(train_args, 'number_of_molecules', 1) != 1:
+                raise ValueError(f"{checkpoint} needs extra features or several molecules per input, "
+                                 "which are not supported; please use chemprop_predict instead")
+            settings = {arg: bool(getattr(train_args, arg, False)) for arg in FEATURIZATION_ARGS}
+            if featurization is not None and settings != featurization:
+                raise ValueError(f"{checkpoint} was trained with {settings} but the previous checkpoints with {featurization}; "
+                                 "checkpoints with different featurization settings must be scored in separate runs")
+            featurization = settings
+            name = checkpoint_name(checkpoint)
+            if name in self.models:
+                name = f"{name}_{len(self.models)}"
+            print(f"Loading {checkpoint} as {name}")
+            model = load_checkpoint(checkpoint, device=torch.device('cpu'))
+            model.eval()
+            self.models[name] = model
+            self.scalers[name] = load_scalers(checkpoint)[0]
+        if featurization is not None:
+            set_explicit_h(featurization['explicit_h'])
+            set_adding_hs(featurization['adding_h'])
+            set_keeping_atom_map(featurization['keeping_atom_map'])
+
+    @property
+    def columns(self):
+        return list(self.models)
+
+    def score_mols(self, mols):
+        """Score a batch of molecules with every checkpoint
+        Args:
+            mols (list): Valid SMILES strings. chemprop only applies the hydrogen and atom map settings when it
+                parses the SMILES itself; RDKit molecules are featurized as they are
+        Returns:
+            np.ndarray: Array of shape (len(mols), len(columns)) with the first task of each checkpoint
+        """
+        batch_graph = self.mol2graph(mols)
+        scores = np.empty((len(mols), len(self.models)), dtype=np.float32)
+        with self.torch.no_grad():
+            for i, (name, model) in enumerate(self.models.items()):
+                prediction = model([batch_graph]).cpu().numpy()
+                if self.scalers[name] is not None:
+                    prediction = self.scalers[name].inverse_transform(prediction)
+                scores[:, i] = prediction[:, 0]
+        return scores
+
+    def score(self, smiles_strings):
+        """Parse and score a batch of SMILES strings
+        Returns:
+            np.ndarray: Boolean mask of the valid SMILES
+            np.ndarray: Scores of the valid SMILES (see `score_mols`)
+        """
+        valid = np.array([Chem.MolFromSmiles(smiles) is not None for smiles in smiles_strings], dtype=bool)
+        if not valid.any():
+            return valid, np.empty((0, len(self.models)), dtype=np.float32)
+        return valid, self.score_mols([smiles for smiles, is_valid in zip(smiles_strings, valid) if is_valid])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, required=True, help="csv (or Parquet/Feather) file with a SMILES column")
+    parser.add_argument("--save_path", type=str, required=True, help="path to store results")
+    parser.add_argument("--checkpoint", type=str, nargs='+', required=True,
+                        help="chemprop checkpoint(s). Each checkpoint gets its own output column")
+    parser.add_argument("--experiment", type=str, required=True, help="experiment name")
+    parser.add_argument("--batch_size", type=int, default=1000, help="number of molecules scored at a time")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of CPU threads used by torch")
+    parser.add_argument("--output_format", type=str, choices=list(PREDICTION_WRITERS), default="csv",
+                        help="format of the prediction file")
+    args = parser.parse_args()
+
+    scorer = ChempropScorer(args.checkpoint, args.num_threads)
+    if not os.path.exists(args.save_path):
+        os.makedirs(args.save_path)
+
+    print("Predicting...")
+    t_start = time.time()
+    n_predicted, n_invalid = 0, 0
+    with open_prediction_writer(args.save_path, args.experiment, args.output_format, scorer.columns) as writer:
+        for smiles_strings in iter_smiles_chunks(args.input_file, args.batch_size):
+            valid, scores = scorer.score(smiles_strings)
+            writer.write(smiles_strings[valid], scores)
+            n_predicted += int(valid.sum())
+            n_invalid += int((~valid).sum())
+            print(f"Predicted {n_predicted} molecules")
+    print(f"Time elapsed: {time.time() - t_start} seconds")
+    print(f"Predicted {n_predicted} molecules ({n_invalid} invalid SMILES)")
@@ -0,0 +1,270 @@
+import os
+import time
+import argparse
+import yaml
+import h5py
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from io_utils import read_smiles, parse_input_files
+from feature_extractor import resolve_pool_settings
+from similarity_search import TanimotoSearchIndex, bit_counts
+from tanimoto import tanimoto_block
+
+# Fingerprints are clustered without ever building the N x N similarity matrix: similarities are computed
+# block by block (a block of rows against a chunk of columns) by worker processes, and only neighbour counts
+# or cluster assignments are sent back. A block is computed as one matrix product of the unpacked bits (see
+# tanimoto.py), which gives the intersection counts of all its pairs at once.
+
+# Number of rows and columns of the similarity blocks computed at a time
+ROW_BLOCK = 1024
+COLUMN_BLOCK = 4096
+
+# Fingerprints of the worker processes (uint64 words sorted by bit count, see TanimotoSearchIndex)
+_words = None
+_counts = None
+_threshold = None
+
+def _init_worker(words, counts, threshold):
+    global _words, _counts, _threshold
+    _words, _counts, _threshold = words, counts, threshold
+
+def _count_neighbours(start, end, column_end):
+    """Neighbours of the rows [start, end) among the rows [start, column_end), each pair being counted once
+    Returns:
+        np.ndarray: Neighbours of each row of the block
+        np.ndarray: Neighbours of each row of [start, column_end) within the block
+    """
+    rows = np.zeros(end - start, dtype=np.int64)
+    columns = np.zeros(column_end - start, dtype=np.int64)
+    for column_start in range(start, column_end, COLUMN_BLOCK):
+        column_stop = min(column_start + COLUMN_BLOCK, column_end)
+        hits = tanimoto_block(_words[start:end], _counts[start:end], _words[column_start:column_stop],
+                              _counts[column_start:column_stop]) >= _threshold
+        if column_start < end:
+            # Pairs within the row block: keep j > i only
+            hits &= np.arange(column_start, column_stop)[None, :] > np.arange(start, end)[:, None]
+        rows += hits.sum(axis=1)
+        columns[column_start - start:column_stop - start] += hits.sum(axis=0)
+    return rows, columns
+
+def _first_leader(leader_words, leader_counts, positions):
+    """First leader (in leader order) having each fingerprint of `positions` as neighbour
+    Returns:
+        np.ndarray: Index of the leader, -1 if none
+        np.ndarray: Similarity to that leader
+    """
+    similarities = tanimoto_block(leader_words, leader_counts, _words[positions], _counts[positions])
+    hits = similarities >= _threshold
+    first = np.where(hits.any(axis=0), hits.argmax(axis=0), -1)
+    return first, similarities[np.maximum(first, 0), np.arange(len(positions))]
+
+class FingerprintClustering:
+    """Leader (sphere exclusion) and Taylor-Butina clustering of fingerprints at a Tanimoto similarity threshold
+    Candidates are visited in a given order: a candidate without cluster becomes the centroid of a new cluster, which
+    takes every fingerprint without cluster within the threshold. Butina clustering is the same pass with the
+    candidates ordered by decreasing number of neighbours, ties by decreasing input row (as rdkit.ML.Cluster.Butina),
+    which needs one more pass over all pairs to count them. Leaders are processed a block of candidates at a time,
+    which gives the same clusters as visiting them one by one.
+    """
+    def __init__(self, index, threshold=0.6, num_processes=1):
+        """
+        Args:
+            index (TanimotoSearchIndex): Fingerprints to cluster
+            threshold (float): Minimum Tanimoto similarity between a centroid and the members of its cluster
+            num_processes (int): Number of worker processes computing the similarities
+        """
+        self.index = index
+        self.threshold = threshold
+        self.num_processes = num_processes
+        self.executor = None
+
+    def __enter__(self):
+        if self.num_processes > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.num_processes, initializer=_init_worker,
+                                                initargs=(self.index.words, self.index.counts, self.threshold))
+        else:
+            _init_worker(self.index.words, self.index.counts, self.threshold)
+        return self
+
+    def __exit__(self, *exc):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _map(self, function, *iterables):
+        return self.executor.map(function, *iterables) if self.executor is not None else map(function, *iterables)
+
+    def _bound_end(self, counts):
+        """End (exclusive) of the fingerprints whose bit count can reach the threshold with the largest of `counts`"""
+        high = int(np.floor(counts.max() / self.threshold + 1e-9)) if self.threshold > 0 else self.index.nBits
+        return self.index.bin_start[min(high, self.index.nBits) + 1]
+
+    def neighbour_counts(self):
+        """Number of neighbours (similarity at or above the threshold) of every fingerprint"""
+        n = len(self.index.counts)
+        neighbours = np.zeros(n, dtype=np.int64)
+        blocks = [(start, min(start + ROW_BLOCK, n)) for start in range(0, n, ROW_BLOCK)]
+        # Fingerprints are sorted by bit count, so the neighbours of a row block are within [start, bound)
+        column_ends = [self._bound_end(self.index.counts[start:end]) for start, end in blocks]
+        for (start, end), column_end, (rows, columns) in zip(blocks, column_ends,
+                self._map(_count_neighbours, [start for start, _ in blocks], [end for _, end in blocks], column_ends)):
+            neighbours[start:end] += rows
+            neighbours[start:column_end] += columns
+        return neighbours
+
+    def leader_clusters(self, order):
+        """Sphere exclusion clustering visiting the candidates in `order`
+        Args:
+            order (np.ndarray): Positions of the fingerprints (in the index) in visiting order
+        Returns:
+            np.ndarray: Cluster of each fingerprint, numbered in order of creation
+            np.ndarray: Similarity of each fingerprint to the centroid of its cluster
+            np.ndarray: Position of the centroid of each cluster
+        """
+        n = len(order)
+        words, counts = self.index.words, self.index.counts
+        cluster = np.full(n, -1, dtype=np.int64)
+        similarity = np.zeros(n, dtype=np.float32)
+        centroids = []
+        cursor = 0
+        while cursor < n:
+            # Next block of candidates without cluster
+            pieces, taken = [], 0
+            while taken < ROW_BLOCK and cursor < n:
+                piece = order[cursor:cursor + ROW_BLOCK]
+                piece = piece[cluster[piece] < 0]
+                pieces.append(piece)
+                taken += len(piece)
+                cursor += ROW_BLOCK
+            block = np.concatenate(pieces)
+            if len(block) == 0:
+                continue
+
+            # Leaders within the block, one by one
+            block_similarity = tanimoto_block(words[block], counts[block], words[block], counts[block])
+            leaders = []
+            for i, position in enumerate(block):
+                if cluster[position] >= 0:
+                    continue
+                cluster_id = len(centroids)
+                centroids.append(position)
+                leaders.append(position)
+                cluster[position], similarity[position] = cluster_id, 1.0
+                later = block[i + 1:]
+                joined = (block_similarity[i, i + 1:] >= self.threshold) & (cluster[later] < 0)
+                cluster[later[joined]] = cluster_id
+                similarity[later[joined]] = block_similarity[i, i + 1:][joined]
+
+            # Every other fingerprint without cluster comes after the block: it joins the first new leader it is close to
+            leaders = np.array(leaders)
+            remaining = np.flatnonzero(cluster < 0)
+            if len(remaining) == 0:
+                break
+            leader_counts = counts[leaders]
+            low = int(np.ceil(self.threshold * leader_counts.min() - 1e-9))
+            remaining = remaining[(remaining >= self.index.bin_start[low]) & (remaining < self._bound_end(leader_counts))]
+            chunks = [remaining[start:start + COLUMN_BLOCK] for start in range(0, len(remaining), COLUMN_BLOCK)]
+            leader_words = words[leaders]
+            leader_clusters = cluster[leaders]
+            for positions, (first, first_similarity) in zip(chunks, self._map(_first_leader, [leader_words] * len(chunks),
+                                                                               [leader_counts] * len(chunks), chunks)):
+                joined = first >= 0
+                cluster[positions[joined]] = leader_clusters[first[joined]]
+                similarity[positions[joined]] = first_similarity[joined]
+        return cluster, similarity, np.array(centroids, dtype=np.int64)
+
+    def cluster(self, method="sphere"):
+        """Cluster the fingerprints with the "sphere" (leader, input order) or "butina" method
+        Returns:
+            see `leader_clusters`, positions being in the index order (sorted by bit count)
+        """
+        if method == "butina":
+            t_start = time.time()
+            neighbours = self.neighbour_counts()
+            print(f"Counted the neighbours of {len(neighbours)} fingerprints in {time.time() - t_start:.1f} seconds")
+            # Most neighbours first, ties by decreasing input row (as rdkit.ML.Cluster.Butina, which sorts the
+            # (neighbour count, index) pairs in reverse)
+            order = np.lexsort((-self.index.rows, -neighbours))
+        elif method == "sphere":
+            order = np.argsort(self.index.rows, kind='stable')
+        else:
+            raise ValueError(f"Unknown clustering method {method}")
+        return self.leader_clusters(order)
+
+def maxmin_picks(words, counts, num_picks, seed=0):
+    """Diverse subset of fingerprints picked by the MaxMin algorithm: each pick is the fingerprint whose highest
+    similarity to the previous picks is the lowest
+    Args:
+        words (np.ndarray): uint64 fingerprints to pick from
+        counts (np.ndarray): Bit count of each fingerprint
+        num_picks (int): Number of picks
+        seed (int): First pick
+    Returns:
+        np.ndarray: Picked rows, in pick order
+        np.ndarray: Highest similarity of each pick to the previous picks (0 for the first one)
+    """
+    num_picks = min(num_picks, len(words))
+    picks = np.zeros(num_picks, dtype=np.int64)
+    pick_similarity = np.zeros(num_picks, dtype=np.float32)
+    closest = np.full(len(words), -np.inf, dtype=np.float32)
+    pick = seed
+    for i in range(num_picks):
+        picks[i], pick_similarity[i] = pick, max(closest[pick], 0.0)
+        intersection = bit_counts(words & words[pick])
+        np.maximum(closest, intersection / np.maximum(counts + counts[pick] - intersection, 1), out=closest)
+        closest[picks[:i + 1]] = np.inf
+        pick = int(np.argmin(closest))
+    return picks, pick_similarity
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, nargs='+', required=True,
+                        help="feature file(s) written by feature_extractor.py, optionally named as name=path")
+    parser.add_argument("--save_path", type=str, required=True, help="folder to store the clusters and the picks")
+    parser.add_argument("--experiment", type=str, required=True, help="experiment name")
+    parser.add_argument("--method", type=str, default="sphere", choices=["sphere", "butina"],
+                        help="sphere exclusion (leader) in input order, or Butina (most neighbours first, quadratic time)")
+    parser.add_argument("--threshold", type=float, default=0.6, help="minimum Tanimoto similarity to the cluster centroid")
+    parser.add_argument("--num_picks", type=int, default=1000, help="number of diverse cluster centroids to pick")
+    args = parser.parse_args()
+
+    with open("./config.yaml", "r") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    num_processes, _ = resolve_pool_settings(config)
+
+    t_start = time.time()
+    names, paths = parse_input_files(args.input_file)
+    index = TanimotoSearchIndex.build(paths, names)
+    print(f"Loaded {len(index.rows)} fingerprints in {time.time() - t_start:.1f} seconds")
+    with FingerprintClustering(index, args.threshold, num_processes) as clustering:
+        cluster, similarity, centroids = clustering.cluster(args.method)
+    cluster_size = np.bincount(cluster, minlength=len(centroids))
+    print(f"Found {len(centroids)} clusters ({np.sum(cluster_size == 1)} singletons) in {time.time() - t_start:.1f} seconds")
+
+    # Tables in input order
+    smiles = []
+    for path in paths:
+        with h5py.File(path, 'r') as hf:
+            smiles.append(read_smiles(hf) if 'SMILES' in hf else np.full(hf["feature"].shape[0], None, dtype=object))
+    smiles = np.concatenate(smiles) if smiles else np.zeros(0, dtype=object)
+    rows = index.rows
+    sources = index.sources(rows)
+    file_rows = rows - index.offsets[np.searchsorted(index.offsets, rows, side='right') - 1]
+    is_centroid = np.zeros(len(rows), dtype=bool)
+    is_centroid[centroids] = True
+    clusters = pd.DataFrame({'source': sources, 'index': file_rows, 'SMILES': smiles[rows], 'cluster': cluster,
+                             'cluster_size': cluster_size[cluster], 'is_centroid': is_centroid,
+                             'centroid_similarity': similarity}).iloc[np.argsort(rows, kind='stable')]
+
+    # Diverse picks among the centroids, starting from the centroid of the largest cluster
+    picks, pick_similarity = maxmin_picks(index.words[centroids], index.counts[centroids], args.num_picks,
+                                          seed=int(np.argmax(cluster_size)) if len(centroids) else 0)
+    picked = centroids[picks]
+    pick_list = pd.DataFrame({'pick': np.arange(len(picks)), 'source': sources[picked], 'index': file_rows[picked],
+                              'SMILES': smiles[rows[picked]], 'cluster': picks, 'cluster_size': cluster_size[picks],
+                              'max_similarity_to_previous': pick_similarity})
+
+    os.makedirs(args.save_path, exist_ok=True)
+    clusters.to_csv(os.path.join(args.save_path, f"{args.experiment}_clusters.csv"), index=False)
+    pick_list.to_csv(os.path.join(args.save_path, f"{args.experiment}_picks.csv"), index=False)
+    print(f"Wrote {len(clusters)} compounds and {len(pick_list)} picks in {time.time() - t_start:.1f} seconds")
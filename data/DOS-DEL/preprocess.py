@@ -1,150 +1,196 @@
 import os
+import sys
+import numpy as np
 import pandas as pd
 import yaml
 from tqdm import tqdm
-
-def pad(st):
-    """Pad a string with zeros to make it 3 digits long"""
-    return '0'*(3-len(str(st))) + str(st)
-
-def load_library(config):
-    """Load the library of structures. Each (sub)library contain SMIELS string of the molecules."""
-    lib_dfs = []
-    for lib in tqdm(config['sublibrary']):
-        lib_path = os.path.join(config['data_path'], "libraries", f"lib{lib}.csv")
-        lib_df = pd.read_csv(lib_path)
-        lib_df['sublibrary'] = lib
-        lib_dfs.append(lib_df)
-
-    lib_dfs = pd.concat(lib_dfs)
-    lib_dfs.rename(columns={'structure': 'SMILES'}, inplace=True)
-    return lib_dfs
-
-
-def load_sample(config):
-    """Load the sample of structures. Each sample file contains the screening results (counts) of each sublibrary 
-    under a specific experimental condition. See the config file for the mapping between sample number and
-    experimental condition.
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import write_table, read_table, table_path
+from del_common.manifest import cached_digests, config_subset, load_manifest, save_manifest
+
+# Columns read from each kind of raw file and their (compact) types
+LIBRARY_DTYPES = {'structure': object}
+SCREENING_DTYPES = {'lib_id': 'int16', 'cycle1': 'int16', 'cycle2': 'int16', 'cycle3': 'int16',
+                    'er': 'float64', 'er_lb': 'float64', 'er_ub': 'float64'}
+SAMPLE_DTYPES = {'value': 'int32'}
+
+# Config keys that change the content of a sublibrary partition (the raw files are tracked by their hashes)
+PARTITION_CONFIG_KEYS = ['experimental_condition', 'sample_to_exp_condition']
+
+def read_raw_csv(path, dtypes):
+    """Read only the columns of `dtypes` from a raw csv file
+    The pyarrow parser releases the GIL, so several files can be parsed at the same time by a thread pool."""
+    return pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, engine='pyarrow')
+
+def compound_key(df):
+    """Encode (lib_id, cycle1, cycle2, cycle3) as one int64 so that tables can be joined on a single integer
+    Each cycle id takes three decimal digits, as in the CompoundIndex."""
+    return (df['lib_id'].to_numpy(dtype=np.int64) * 10**9 + df['cycle1'].to_numpy(dtype=np.int64) * 10**6
+            + df['cycle2'].to_numpy(dtype=np.int64) * 10**3 + df['cycle3'].to_numpy(dtype=np.int64))
+
+def compound_index(df):
+    """Name the compounds by their zero-padded DEL synthesis cycles, e.g. (1, 12, 3) -> 001.012.003"""
+    return (df['cycle1'].astype(str).str.zfill(3) + '.' + df['cycle2'].astype(str).str.zfill(3) + '.'
+            + df['cycle3'].astype(str).str.zfill(3))
+
+def library_file(config, lib):
+    return os.path.join(config['data_path'], "libraries", f"lib{lib}.csv")
+
+def screening_result_file(config, exp_cond, lib):
+    return os.path.join(config['data_path'], f"{exp_cond}_lib{lib}.csv")
+
+def sample_file(config, sample, lib):
+    return os.path.join(config['data_path'], 'samples', f'run038_samp000{sample}_lib{lib}.csv')
+
+def sublibrary_files(config, lib):
+    """All raw files a sublibrary is built from"""
+    return ([library_file(config, lib)]
+            + [screening_result_file(config, exp_cond, lib) for exp_cond in config['experimental_condition']]
+            + [sample_file(config, sample, lib) for sample in config['sample_to_exp_condition']])
+
+def load_library(config, lib):
+    """Load the SMILES strings of the molecules of a sublibrary"""
+    return read_raw_csv(library_file(config, lib), LIBRARY_DTYPES)['structure'].to_numpy(dtype=object)
+
+def load_screening_result(config, exp_cond, lib):
+    """Load the enrichment ratios of a sublibrary under an experimental condition"""
+    return read_raw_csv(screening_result_file(config, exp_cond, lib), SCREENING_DTYPES)
+
+def load_sample(config, sample, lib):
+    """Load the sequencing counts of a sublibrary in one sample. See the config file for the mapping between
+    sample number and experimental condition."""
+    return read_raw_csv(sample_file(config, sample, lib), SAMPLE_DTYPES)['value'].to_numpy()
+
+def load_sublibrary(executor, config, lib):
+    """Start reading all raw files of a sublibrary in the thread pool
+    Returns:
+        tuple: Futures of the SMILES, of the screening results ({condition: future}) and of the sample counts ({sample: future})
+    """
+    return (executor.submit(load_library, config, lib),
+            {exp_cond: executor.submit(load_screening_result, config, exp_cond, lib) for exp_cond in config['experimental_condition']},
+            {sample: executor.submit(load_sample, config, sample, lib) for sample in config['sample_to_exp_condition']})
+
+def preprocess_sublibrary(config, lib, raw_files):
+    """Merge the structures, the screening results and the sample counts of one sublibrary into one table
+    The rows of the library file, of the sample files and of the screening result file of the first
+    experimental condition describe the same compounds in the same order. Those rows are keyed by
+    (lib_id, cycle1, cycle2, cycle3) once, and the screening results of every condition are joined on that key.
+    Every column is computed once and the table is built in a single step.
+    Args:
+        config (dict): Preprocessing configuration (see config.yaml)
+        lib (str): Sublibrary id (e.g. "002")
+        raw_files (tuple): Futures of the raw files of the sublibrary (see `load_sublibrary`)
+    Returns:
+        pd.DataFrame: One row per compound with SMILES, sublibrary, library.name, {cond}_er, {cond}_er_ub,
+            {cond}_er_lb, {cond}_hit_counts_{run}, blank_hit_counts_{run} and CompoundIndex
+    """
+    smiles_future, result_futures, sample_futures = raw_files
+    smiles = smiles_future.result()
+    results = {exp_cond: future.result() for exp_cond, future in result_futures.items()}
+    reference = results[config['experimental_condition'][0]]
+    if len(reference) != len(smiles):
+        raise ValueError(f"lib{lib}.csv has {len(smiles)} molecules but the screening results have {len(reference)} rows")
+    keys = pd.Index(compound_key(reference))
+
+    # Sample counts, one column per (condition, run)
+    hit_counts = {}
+    for sample, exp_cond in config['sample_to_exp_condition'].items():
+        counts = sample_futures[sample].result()
+        if len(counts) != len(smiles):
+            raise ValueError(f"Sample {sample} of lib{lib} has {len(counts)} rows instead of {len(smiles)}")
+        hit_counts[f'{exp_cond}_hit_counts_{sample % 2}'] = counts
+
+    # All sublibraries share the same categories, so concatenating them keeps the categorical dtype
+    sublibrary = pd.Categorical.from_codes(np.full(len(smiles), config['sublibrary'].index(lib)), categories=config['sublibrary'])
+    columns = {'SMILES': smiles, 'sublibrary': sublibrary, 'library.name': sublibrary}
+    for exp_cond, result in results.items():
+        if not pd.Index(compound_key(result)).is_unique:
+            raise ValueError(f"{exp_cond}_lib{lib}.csv lists some compounds more than once")
+        rows = pd.Index(compound_key(result)).get_indexer(keys)
+        found = rows >= 0
+        for column in ['er', 'er_ub', 'er_lb']:
+            values = np.full(len(keys), np.nan)
+            values[found] = result[column].to_numpy(dtype=np.float64)[rows[found]]
+            columns[f'{exp_cond}_{column}'] = values
+        columns[f'{exp_cond}_hit_counts_0'] = hit_counts[f'{exp_cond}_hit_counts_0']
+        columns[f'{exp_cond}_hit_counts_1'] = hit_counts[f'{exp_cond}_hit_counts_1']
+    columns['blank_hit_counts_0'] = hit_counts['blank_hit_counts_0']
+    columns['blank_hit_counts_1'] = hit_counts['blank_hit_counts_1']
+    columns['CompoundIndex'] = compound_index(reference).to_numpy(dtype=object)
+    return pd.DataFrame(columns)
+
+def sublibrary_fingerprints(executor, config, file_cache):
+    """Describe what each sublibrary partition is built from: the hashes of its raw files and the config
+    values it depends on. A partition only needs to be rebuilt when its fingerprint changes.
+    Args:
+        file_cache (dict): Size, modification time and hash of the raw files of the last run (see `cached_digests`)
+    Returns:
+        dict: Sublibrary id -> {'inputs': {path: sha256}, 'config': {key: value}}
     """
-    sample_dfs = []
-    sample_to_exp_condition = config['sample_to_exp_condition']
-    sample_list = list(sample_to_exp_condition.keys())
-    for sample in tqdm(range(min(sample_list), max(sample_list) + 1)):
-        tmp_dfs = []
-        for lib in config['sublibrary']:
-            sample_path_per_lib = os.path.join(config['data_path'], 'samples', f'run038_samp000{sample}_lib{lib}.csv')
-            sample_df_per_lib = pd.read_csv(sample_path_per_lib)
-            tmp_dfs.append(sample_df_per_lib)
-        
-        sample_df = pd.concat(tmp_dfs)
-        sample_df['experimental_cond'] = sample_to_exp_condition[sample]
-        sample_df['sample'] = sample
-        sample_df['run'] = sample % 2
-        
-        sample_dfs.append(sample_df)
-        
-    all_sample_df = pd.concat(sample_dfs)
-    return all_sample_df
-
-def merge_sample_and_experiment(config, all_sample_df, output_path):
-    """Merge the sample and experiment results"""
-    tmp = []
-    for exp_cond in tqdm(config['experimental_condition']):
-        # Retrieve the sample results for the current experiment condition
-        sample_df = all_sample_df[all_sample_df['experimental_cond'] == exp_cond]
-        sample_df_0 = sample_df[sample_df['run'] == 0].reset_index(drop=True)
-        sample_df_1 = sample_df[sample_df['run'] == 1].reset_index(drop=True)
-
-        # Retrieve the screening results for the current experiment condition across all sublibraries
-        dfs = []
-        for lib in config['sublibrary']:
-            lib_exp_cond_info = pd.read_csv(os.path.join(config['data_path'], f"{exp_cond}_lib{lib}.csv"))
-            dfs.append(lib_exp_cond_info)
-        exp_cond_df = pd.concat(dfs)
-
-        # Naming the compound by concatenating the library ID and the DEL synthesis cycle number
-        exp_cond_df['CompoundIndex'] = exp_cond_df['lib_id'].astype(str).str.cat([exp_cond_df['cycle1'].astype(str), \
-                                                                                  exp_cond_df['cycle2'].astype(str), \
-                                                                                  exp_cond_df['cycle3'].astype(str)], sep='.')
-        # Concatenate the corresponding molecule with screening results
-        exp_cond_df['experimental_cond'] = exp_cond
-        exp_cond_df_full = pd.concat([lib_dfs, exp_cond_df], axis=1)
-        exp_cond_df_full.reset_index(drop=True, inplace=True)
-        exp_cond_df_full['hit_counts_0'] = sample_df_0['value']
-        exp_cond_df_full['hit_counts_1'] = sample_df_1['value']
-        tmp.append(exp_cond_df_full)
-
-    # Concate the results for all experiment conditions
-    all_exp_cond_df = pd.concat(tmp)
-    all_exp_cond_df['CompoundIndex'] = all_exp_cond_df['cycle1'].apply(pad).str.cat([all_exp_cond_df['cycle2'].apply(pad), \
-                                                                                    all_exp_cond_df['cycle3'].apply(pad)], sep='.')
-    all_exp_cond_df.reset_index(inplace=True)
-    all_exp_cond_df.drop(columns=['index'], inplace=True)
-    return all_exp_cond_df
-
-def merge_library_for_all_experiment(experimental_condition, lib_dfs, all_exp_cond_df):
-    for exp_cond in tqdm(experimental_condition):
-        exp_cond_df = all_exp_cond_df[all_exp_cond_df['experimental_cond'] == exp_cond].copy().reset_index()
-        exp_cond_df = exp_cond_df.rename(columns={
-            'er': f'{exp_cond}_er',
-            'er_lb': f'{exp_cond}_er_lb',
-            'er_ub': f'{exp_cond}_er_ub',
-            'hit_counts_0': f'{exp_cond}_hit_counts_0',
-            'hit_counts_1': f'{exp_cond}_hit_counts_1'
-        })
-
-        lib_dfs = pd.concat([lib_dfs, exp_cond_df[[f'{exp_cond}_er', f'{exp_cond}_er_ub', f'{exp_cond}_er_lb', f'{exp_cond}_hit_counts_0', 
-                                            f'{exp_cond}_hit_counts_1']]], axis=1)
-    return lib_dfs
+    files = {lib: sublibrary_files(config, lib) for lib in config['sublibrary']}
+    paths = sorted({path for lib_files in files.values() for path in lib_files})
+    digests = cached_digests(paths, file_cache, executor.map)
+    partition_config = config_subset(config, PARTITION_CONFIG_KEYS)
+    return {lib: {'inputs': {path: digests[path] for path in lib_files}, 'config': partition_config}
+            for lib, lib_files in files.items()}
+
+def assemble(config, partition_path):
+    """Concatenate the sublibrary partitions into the preprocessed table"""
+    sublibrary_type = pd.CategoricalDtype(config['sublibrary'])
+    sublibrary_dfs = []
+    for lib in config['sublibrary']:
+        df = read_table(partition_path, f"lib{lib}")
+        # Each partition only knows its own category: give them all the same ones so concat keeps the categorical
+        df['sublibrary'] = df['sublibrary'].astype(str).astype(sublibrary_type)
+        df['library.name'] = df['library.name'].astype(str).astype(sublibrary_type)
+        sublibrary_dfs.append(df)
+    return pd.concat(sublibrary_dfs, ignore_index=True)
 
 if __name__ == "__main__":
     # Load config file
     with open("config.yaml", "r") as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
+    table_format = config.get('table_format', 'parquet')
     output_path_preprocessed = os.path.join(config['output_path'], "preprocessed")
-    os.makedirs(output_path_preprocessed, exist_ok=True)
-
-    # Step 1: Load library
-    print("Loading library...")
-    lib_dfs = load_library(config)
-
-    # Step2: Load sample
-    print("Loading sample...")
-    all_sample_df = load_sample(config)
-
-    # Step 3: Merge sample with screeing results from different experiment conditions and save the merged results individually
-    print("Merging sample and experiment...")
-    all_exp_cond_df = merge_sample_and_experiment(config, all_sample_df, output_path_preprocessed)
-    smile2compoundIndex = all_exp_cond_df[['SMILES', 'CompoundIndex']].set_index('SMILES')['CompoundIndex'].to_dict()
-
-    # Step 4: Merge the library and all readouts of all experiment conditions (except blank)
-    # Potential enhancement in the future: Step 3 and Step 4 could be merged together
-    print("Merging library and experiment...")
-    lib_dfs_w_exp_cond = lib_dfs.reset_index().copy()
-    lib_dfs_w_exp_cond['library.name'] = lib_dfs_w_exp_cond['sublibrary']
-    lib_dfs_w_exp_cond = merge_library_for_all_experiment(config['experimental_condition'], lib_dfs_w_exp_cond, all_exp_cond_df)
-    
-    # Step 5: Merge the blank results
-    print("Merging blank...")
-    blank_sample_df = all_sample_df[all_sample_df['experimental_cond'] == 'blank']
-    blank_sample_0_df = blank_sample_df[blank_sample_df['run'] == 0].reset_index(drop=True).copy()
-    blank_sample_0_df['blank_hit_counts_0'] = blank_sample_0_df['value']
-    blank_sample_1_df = blank_sample_df[blank_sample_df['run'] == 1].reset_index(drop=True).copy()
-    blank_sample_1_df['blank_hit_counts_1'] = blank_sample_1_df['value']
-    lib_dfs_w_exp_cond = pd.concat([lib_dfs_w_exp_cond, blank_sample_0_df[['blank_hit_counts_0']], 
-                                    blank_sample_1_df['blank_hit_counts_1']], axis=1)
-    
-    # Clean and save the results
-    print("Saving final results...")
-    lib_dfs_w_exp_cond['CompoundIndex'] = lib_dfs_w_exp_cond['SMILES'].map(smile2compoundIndex)
-    lib_dfs_w_exp_cond.drop(columns=['index'], inplace=True)
-    lib_dfs_w_exp_cond.to_csv(os.path.join(output_path_preprocessed, "preprocessed.csv"), index=False)
-    
-    
-
-
-
-
-    
-    
\ No newline at end of file
+    # Every sublibrary is stored as its own partition; the manifest records what each partition was built from
+    partition_path = os.path.join(output_path_preprocessed, "partitions")
+    manifest_path = os.path.join(output_path_preprocessed, "manifest.json")
+    os.makedirs(partition_path, exist_ok=True)
+    manifest = load_manifest(manifest_path)
+    partitions = manifest.setdefault('partitions', {})
+
+    with ThreadPoolExecutor(max_workers=config.get('num_workers', 8)) as executor:
+        print("Hashing raw files...")
+        # Only the raw files whose size or modification time changed since the last run are hashed again
+        fingerprints = sublibrary_fingerprints(executor, config, manifest.setdefault('files', {}))
+        save_manifest(manifest, manifest_path)
+        stale = [lib for lib in config['sublibrary'] if partitions.get(lib) != fingerprints[lib]
+                 or not os.path.exists(table_path(partition_path, f"lib{lib}", "parquet"))]
+        print(f"{len(stale)} of {len(config['sublibrary'])} sublibraries changed since the last run")
+
+        # Each changed sublibrary is merged independently: structures, screening results of every experiment
+        # condition and the counts of every sample (including blank). The raw files of a sublibrary are
+        # read concurrently, and the files of the next sublibrary are read while the current one is merged.
+        print("Merging library, samples and experiments...")
+        next_raw_files = load_sublibrary(executor, config, stale[0]) if stale else None
+        for i, lib in enumerate(tqdm(stale)):
+            raw_files = next_raw_files
+            if i + 1 < len(stale):
+                next_raw_files = load_sublibrary(executor, config, stale[i + 1])
+            # Partitions are always parquet: they are only read back by this script and must keep their dtypes
+            write_table(preprocess_sublibrary(config, lib, raw_files), partition_path, f"lib{lib}", "parquet")
+            partitions[lib] = fingerprints[lib]
+            save_manifest(manifest, manifest_path)
+
+    # The preprocessed table only depends on the partitions, the list of sublibraries and the output format
+    assembled = config_subset({'sublibrary': config['sublibrary'], 'table_format': table_format}, ['sublibrary', 'table_format'])
+    if not stale and manifest.get('assembled') == assembled \
+            and os.path.exists(table_path(output_path_preprocessed, "preprocessed", table_format)):
+        print("Preprocessed table is up to date")
+    else:
+        print("Saving final results...")
+        write_table(assemble(config, partition_path), output_path_preprocessed, "preprocessed", table_format)
+        manifest['assembled'] = assembled
+        save_manifest(manifest, manifest_path)
@@ -1,142 +1,117 @@
-import seaborn as sns
-import matplotlib.pylab as plt
+import argparse
 import numpy as np
 import pandas as pd
 import os
-
-def get_sublibary_stat(sublib_of_interest, sublib_mol_count, experiment_conditoin):
-    """Get the statistics of sublibrary of interest
-    Args:
-        sublib_of_interest (pd.DataFrame): Dataframe of sublibrary of interest
-        sublib_mol_count (dict): Dictionary of sublibrary and its corresponding molecule count
-        experiment_conditoin (str): Experimental condition
-    Returns:
-        pd.DataFrame: Dataframe of sublibrary statistics
-    """
-    sublib_mol_count_interest = sublib_of_interest.groupby('library.name').count()['SMILES'].to_dict()
-    output_dict = {'library.name':[], 'fraction':[] ,'pass_filter_rate':[], 'experiment_condition':[]}
-    for sublib,  mol_count in sublib_mol_count.items():
-        output_dict['library.name'].append(sublib)
-        output_dict['experiment_condition'].append(experiment_conditoin)
-        if sublib not in sublib_mol_count_interest:
-            output_dict['fraction'].append(0)
-            output_dict['pass_filter_rate'].append(0)
-        else:
-            output_dict['pass_filter_rate'].append(sublib_mol_count_interest[sublib]/mol_count)
-            output_dict['fraction'].append(sublib_mol_count_interest[sublib]/len(sublib_of_interest))
-    return pd.DataFrame(output_dict)
-
-def get_enrichment_ratio_plot(df, experiment_condition, output_path):
-    """Get the enrichment ratio plot
+import sys
+import yaml
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import read_table, iter_table_chunks
+from del_common.sketches import sketch_chunks, quantile_table
+from del_common.report import CategoryCounts, group_boxes, sublibrary_figures, render_report, save_figures, load_figures
+
+palette = {"Allosteric":"tab:blue",
+           "Orthosteric":"tab:green",
+           "Cryptic":"tab:purple"}
+
+def enrichment_ratio_figures(df, experiment_condition, output_path, k=1000):
+    """Boxen plots of the log10 enrichment ratio and of its lower bound for each label, and for the orthosteric
+    compounds of each library
     Args:
         df (pd.DataFrame): Dataframe of preprocessed data for the experiment condition
         experiment_condition (str): Experimental condition
         output_path (str): Output path
+        k (int): Accuracy of the letter values of the large groups
+    Returns:
+        list: enrichment_ratio.png, enrichment_ratio_lower_bound.png and the orthosteric per library figures
     """
-    palette = {"Allosteric":"tab:blue",
-            "Orthosteric":"tab:green",
-            "Cryptic":"tab:purple"}
-
-    # Get the columns of interest
-    df_ortho_er = df[df['customlabel'] == 'Orthosteric'].loc[:, ['library.name', 'customlabel',f'{experiment_condition}_er', f'{experiment_condition}_er_lb']]
-    df_allo_er = df[df['customlabel'] == 'Allosteric'].loc[:, ['library.name', 'customlabel',f'{experiment_condition}_er_merge', f'{experiment_condition}_er_lb_merge']]
-    df_cryptic_er = df[df['customlabel'] == 'Cryptic'].loc[:, ['library.name', 'customlabel',f'{experiment_condition}_inh_er', f'{experiment_condition}_inh_er_lb']]
-
-    # Rename the columns to facilitate seaborn plotting
-    df_ortho_er.rename(columns={f'{experiment_condition}_er':'Enrichment Ratio', f'{experiment_condition}_er_lb':'Enrichment Ratio Lower Bound'}, inplace=True)
-    df_allo_er.rename(columns={f'{experiment_condition}_er_merge':'Enrichment Ratio', f'{experiment_condition}_er_lb_merge':'Enrichment Ratio Lower Bound'}, inplace=True)
-    df_cryptic_er.rename(columns={f'{experiment_condition}_inh_er':'Enrichment Ratio', f'{experiment_condition}_inh_er_lb':'Enrichment Ratio Lower Bound'}, inplace=True)
-
-    # Concatenate the dataframes for seaborn plotting and take log10 of the enrichment ratio
-    df_er_boxenplot = pd.concat([df_ortho_er, df_allo_er, df_cryptic_er])
-    df_er_boxenplot['log 10 Enrichment Ratio'] = df_er_boxenplot['Enrichment Ratio'].apply(lambda x: np.log10(x))
-    df_er_boxenplot['log 10 Enrichment Ratio Lower Bound'] = df_er_boxenplot['Enrichment Ratio Lower Bound'].apply(lambda x: np.log10(x))
-
-    # Plot the enrichment ratio for each label (Allosteric, Orthosteric, Cryptic)
-    fig_er, ax_er = plt.subplots()
-    sns.boxenplot(data=df_er_boxenplot.sort_values('customlabel'), x='customlabel', y='log 10 Enrichment Ratio', palette=palette, ax=ax_er)
-    fig_er.savefig(os.path.join(output_path, experiment_condition, 'enrichment_ratio.png'))
-    
-    # Plot the enrichment ratio lower bound for each label (Allosteric, Orthosteric, Cryptic)
-    fig_er_lb, ax_er_lb = plt.subplots()
-    sns.boxenplot(data=df_er_boxenplot.sort_values('customlabel'), x='customlabel', y='log 10 Enrichment Ratio Lower Bound', palette=palette, ax=ax_er_lb)
-    fig_er_lb.savefig(os.path.join(output_path, experiment_condition, 'enrichment_ratio_lower_bound.png'))
-
-    # Plot the enrichment ratio of orthosteric for each library
-    fig_ortho_er_per_lib, ax_ortho_er_per_lib = plt.subplots()
-    sns.boxenplot(data=df_er_boxenplot[df_er_boxenplot['customlabel'] == 'Orthosteric'].sort_values('library.name'), x='library.name', y='log 10 Enrichment Ratio', ax=ax_ortho_er_per_lib)
-    ax_ortho_er_per_lib.set_title(f'{experiment_condition} Orthosteric Enrichment Ratio')
-    fig_ortho_er_per_lib.savefig(os.path.join(output_path, experiment_condition, 'orthosteric_enrichment_ratio_perlib.png'))
-
-    # Plot the enrichment ratio lower bound of orthosteric for each library
-    fig_ortho_erlb_per_lib, ax_ortho_erlb_per_lib = plt.subplots()
-    sns.boxenplot(data=df_er_boxenplot[df_er_boxenplot['customlabel'] == 'Orthosteric'].sort_values('library.name'), x='library.name', y='log 10 Enrichment Ratio Lower Bound', ax=ax_ortho_erlb_per_lib)
-    ax_ortho_erlb_per_lib.set_title(f'{experiment_condition} Orthosteric Enrichment Ratio Lower Bound')
-    fig_ortho_erlb_per_lib.savefig(os.path.join(output_path, experiment_condition, 'orthosteric_enrichment_ratio_lower_bound_perlib.png'))
-    plt.close()
+    labels = df['customlabel']
+    orthosteric = (labels == 'Orthosteric').to_numpy()
+    conditions = [orthosteric, (labels == 'Allosteric').to_numpy(), (labels == 'Cryptic').to_numpy()]
+    # Each label is measured by its own column: the condition itself, the merged conditions and the inhibitor condition
+    er = np.select(conditions, [df[f'{experiment_condition}_er'], df[f'{experiment_condition}_er_merge'],
+                                df[f'{experiment_condition}_inh_er']], np.nan)
+    er_lb = np.select(conditions, [df[f'{experiment_condition}_er_lb'], df[f'{experiment_condition}_er_lb_merge'],
+                                   df[f'{experiment_condition}_inh_er_lb']], np.nan)
+    labelled = np.any(conditions, axis=0)
+    save_path = os.path.join(output_path, experiment_condition)
+    figures = []
+    for values, name, ylabel, title in [(er, 'enrichment_ratio', 'log 10 Enrichment Ratio', 'Enrichment Ratio'),
+                                        (er_lb, 'enrichment_ratio_lower_bound', 'log 10 Enrichment Ratio Lower Bound',
+                                         'Enrichment Ratio Lower Bound')]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_values = np.log10(values)
+        figures.append({'path': os.path.join(save_path, f'{name}.png'), 'kind': 'boxen', 'palette': palette,
+                        'boxes': group_boxes(labels[labelled], log_values[labelled], k),
+                        'xlabel': 'customlabel', 'ylabel': ylabel})
+        figures.append({'path': os.path.join(save_path, f'orthosteric_{name}_perlib.png'), 'kind': 'boxen',
+                        'boxes': group_boxes(df['library.name'].to_numpy()[orthosteric], log_values[orthosteric], k),
+                        'xlabel': 'library.name', 'ylabel': ylabel, 'title': f'{experiment_condition} Orthosteric {title}'})
+    return figures
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_cache", action="store_true",
+                        help="render the figures from the aggregates cached by the last run, without reading any table")
+    args = parser.parse_args()
+    with open('./config.yaml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    num_workers = config.get('num_workers', 1)
+    k = config.get('quantile_sketch_k', 1000)
+    output_path = "./output/lib_stat/"
+    cache_path = os.path.join(output_path, 'report_figures.pkl')
+    if args.from_cache:
+        print(f"Rendering the figures cached in {cache_path}...")
+        render_report(load_figures(cache_path), num_workers)
+        sys.exit(0)
+
     print("Loading data...")
     print("")
-    df = pd.read_csv("./output/preprocessed/preprocessed.csv")
-    df_negative = pd.read_csv("./output/stratified/negative_99k.csv")
-    df_CK1a = pd.read_csv("./output/stratified/CK1a_filtered.csv")
-    df_CK1a_inh = pd.read_csv("./output/stratified/CK1a_inh_filtered.csv")
-    df_CK1a_all_label = pd.read_csv("./output/stratified/CK1a_all_labels.csv")
-    df_CK1d = pd.read_csv("./output/stratified/CK1d_filtered.csv")
-    df_CK1d_inh = pd.read_csv("./output/stratified/CK1d_inh_filtered.csv")
-    df_CK1d_all_label = pd.read_csv("./output/stratified/CK1d_all_labels.csv")
-    df_exclusive_CK1a = pd.read_csv("./output/stratified/CK1a_orthosteric_153k.csv")
-    df_exclusive_CK1d = pd.read_csv("./output/stratified/CK1d_orthosteric_58k.csv")
-
-    output_path = "./output/lib_stat/"
-    os.makedirs(output_path)
-    
-    experiments = [df_exclusive_CK1a, df_exclusive_CK1d, df_CK1a, df_CK1d, df_CK1a_inh, df_CK1d_inh, df_negative, df]
+    os.makedirs(output_path, exist_ok=True)
+    # The sublibrary statistics only need the library of each compound
+    sublib_mol_count = CategoryCounts().update(
+        read_table("./output/preprocessed", "preprocessed", columns=['library.name'])['library.name']).to_dict()
+    experiments = [("./output/stratified", "CK1a_orthosteric_153k"), ("./output/stratified", "CK1d_orthosteric_58k"),
+                   ("./output/stratified", "CK1a_filtered"), ("./output/stratified", "CK1d_filtered"),
+                   ("./output/stratified", "CK1a_inh_filtered"), ("./output/stratified", "CK1d_inh_filtered"),
+                   ("./output/stratified", "negative_99k"), None]
     experiment_conditions = ['CK1a_orthosteric','CK1d_orthosteric', 'CK1a', 'CK1d', 'CK1a_inh','CK1d_inh', 'negative', 'all']
     quantiles = [0.0 ,0.1, 0.25, 0.5, 0.75, 0.9, 1.0]
-    sublib_mol_count = df.groupby('library.name').count()['SMILES'].to_dict()
 
-    for df_exp, exp_cond in zip(experiments, experiment_conditions):
+    figures = []
+    for table, exp_cond in zip(experiments, experiment_conditions):
         print(f"Calculating sublibrary statistics for {exp_cond}")
-
-        if 'orthosteric' in exp_cond:
-            os.makedirs(os.path.join(output_path, exp_cond.split("_")[0]), exist_ok=True)
+        if table is None:
+            counts = sublib_mol_count
         else:
-            os.makedirs(os.path.join(output_path, exp_cond), exist_ok=True)
-        sublibrary_stat = get_sublibary_stat(df_exp, sublib_mol_count, exp_cond)
-        sublibrary_frac_bar = sns.catplot(data=sublibrary_stat,
-                                        x='library.name',
-                                        y='fraction',
-                                        kind='bar',
-                                        col='experiment_condition')
-        sublibrary_pass_bar = sns.catplot(data=sublibrary_stat,
-                                        x='library.name',
-                                        y='pass_filter_rate',
-                                        kind='bar',
-                                        col='experiment_condition')
+            counts = CategoryCounts().update(read_table(*table, columns=['library.name'])['library.name']).to_dict()
         if 'orthosteric' in exp_cond:
-            sublibrary_frac_bar.savefig(os.path.join(output_path, exp_cond.split("_")[0], 'orthosteric_sublibrary_fraction.png'))
-            sublibrary_pass_bar.savefig(os.path.join(output_path, exp_cond.split("_")[0], 'orthosteric_sublibrary_pass_filter_rate.png'))
+            figures += sublibrary_figures(counts, sublib_mol_count, exp_cond, os.path.join(output_path, exp_cond.split("_")[0]),
+                                          prefix='orthosteric_')
         else:
-            sublibrary_frac_bar.savefig(os.path.join(output_path, exp_cond, 'sublibrary_fraction.png'))
-            sublibrary_pass_bar.savefig(os.path.join(output_path, exp_cond, 'sublibrary_pass_filter_rate.png'))
-        plt.close()
+            figures += sublibrary_figures(counts, sublib_mol_count, exp_cond, os.path.join(output_path, exp_cond))
     print("")
     print("Calculating enrichment ratio quantile statistics...")
-    enrichment_ratio = []
-    enrichment_ratio_lb = []
-    for pfx, df in [('CK1a', df_CK1a), ('CK1a_inh', df_CK1a_inh), ('CK1d', df_CK1d), ('CK1d_inh', df_CK1d_inh)]:
-        enrichment_ratio.append(df[f'{pfx}_er'].quantile(quantiles))
-        enrichment_ratio_lb.append(df[f'{pfx}_er_lb'].quantile(quantiles))
-    enrichment_ratio_quantile = pd.concat(enrichment_ratio, axis=1)
-    enrichment_ratio_lb_quantile = pd.concat(enrichment_ratio_lb, axis=1)
+    # The enrichment ratios of each filtered table are sketched chunk by chunk instead of being loaded
+    enrichment_ratio = {}
+    enrichment_ratio_lb = {}
+    for pfx in ['CK1a', 'CK1a_inh', 'CK1d', 'CK1d_inh']:
+        _, sketches = sketch_chunks(iter_table_chunks("./output/stratified", f"{pfx}_filtered", columns=[f'{pfx}_er', f'{pfx}_er_lb']),
+                                    {pfx: (None, [f'{pfx}_er', f'{pfx}_er_lb'])}, k=k, num_workers=num_workers)
+        enrichment_ratio[f'{pfx}_er'] = sketches[(pfx, f'{pfx}_er')]
+        enrichment_ratio_lb[f'{pfx}_er_lb'] = sketches[(pfx, f'{pfx}_er_lb')]
+    enrichment_ratio_quantile = quantile_table(enrichment_ratio, quantiles)
+    enrichment_ratio_lb_quantile = quantile_table(enrichment_ratio_lb, quantiles)
     enrichment_ratio_quantile.to_csv(os.path.join(output_path, 'enrichment_ratio_quantile.csv'))
     enrichment_ratio_lb_quantile.to_csv(os.path.join(output_path, 'enrichment_ratio_lb_quantile.csv'))
 
-    print("Plotting enrichment ratio")
-    get_enrichment_ratio_plot(df_CK1a_all_label, 'CK1a', output_path)
-    get_enrichment_ratio_plot(df_CK1d_all_label, 'CK1d', output_path)
-
-
-
+    print("Summarizing enrichment ratio")
+    for exp_code in ['CK1a', 'CK1d']:
+        df_all_label = read_table("./output/stratified", f"{exp_code}_all_labels",
+                                  columns=['library.name', 'customlabel', f'{exp_code}_er', f'{exp_code}_er_lb', f'{exp_code}_er_merge',
+                                           f'{exp_code}_er_lb_merge', f'{exp_code}_inh_er', f'{exp_code}_inh_er_lb'])
+        figures += enrichment_ratio_figures(df_all_label, exp_code, output_path, k)
+
+    # The figures only hold aggregates: they are cached, then rendered in parallel
+    save_figures(figures, cache_path)
+    print(f"Rendering {len(figures)} figures...")
+    render_report(figures, num_workers)
@@ -1,10 +1,14 @@
 import yaml
 import os
+import sys
 import numpy as np
-import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import read_table, write_table
+from del_common.stratification import compound_keys, stratify, labelled_rows
+from del_common.registry import register_compounds
 
-def get_filtered_hc_df(df, hit_count_col_0, hit_count_col_1=None, thresh=0.0, blank_thresh=0.0,):
-    """Filter data based on hit count threshold and blank hit count threshold
+def hit_count_mask(df, hit_count_col_0, hit_count_col_1=None, thresh=0.0, blank_thresh=0.0,):
+    """Select the compounds passing the hit count threshold and the blank hit count threshold
     Args:
         df (pd.DataFrame): Dataframe to be filtered
         hit_count_col_0 (str): Column name of hit count 0
@@ -12,56 +16,32 @@ def get_filtered_hc_df(df, hit_count_col_0, hit_count_col_1=None, thresh=0.0, bl
         thresh (float): Hit count threshold
         blank_thresh (float): Blank hit count threshold
     Returns:
-        filt_df (pd.DataFrame): Filtered dataframe
-        frac (float): Fraction of data that passed the filter
+        mask (np.ndarray): Boolean mask of the rows that passed the filter
     """
+    mask = (df[hit_count_col_0] > thresh) & (df['blank_hit_counts_0'] <= blank_thresh)
     if hit_count_col_1:
-        filt_df = df[(df[hit_count_col_0] > thresh) & (df[hit_count_col_1] > thresh) & 
-                     (df['blank_hit_counts_0'] <= blank_thresh) & 
-                     (df['blank_hit_counts_1'] <= blank_thresh)
-                    ]
-    else:
-        filt_df = df[(df[hit_count_col_0] > thresh) & (df['blank_hit_counts_0'] <= blank_thresh)]
-        
-    print(f"{len(filt_df)} data ({len(filt_df) / len(df) * 100:.2f}%) passed the hit count filter with threshold ({thresh})")
-    return filt_df, len(filt_df) / len(df)
+        mask &= (df[hit_count_col_1] > thresh) & (df['blank_hit_counts_1'] <= blank_thresh)
+    mask = mask.to_numpy()
+    print(f"{mask.sum()} data ({mask.mean() * 100:.2f}%) passed the hit count filter with threshold ({thresh})")
+    return mask
 
-def label_generation(df_exp, df_exp_inh, relevant_columns, exp_code):
-    """Generate labels for each compound based on the experimental condition
+def label_table(df, labels, exp_code):
+    """Rows of `df` labelled for `exp_code` (Orthosteric, then Cryptic, then Allosteric), with the mean
+    enrichment ratios of both conditions for the Allosteric compounds
     Args:
-        df_exp (pd.DataFrame): Dataframe of experimental condition
-        df_exp_inh (pd.DataFrame): Dataframe of experimental condition (inhibitor)
-        relevant_columns (list): List of relevant columns
+        df (pd.DataFrame): Preprocessed data
+        labels (pd.Categorical): Label of each row of `df` for `exp_code` (see `stratify`)
         exp_code (str): Experimental condition code
     Returns:
-        df_common_exp_and_inh (pd.DataFrame): Dataframe of compounds that are common in both experimental conditions
-        df_exclusive_exp_inh (pd.DataFrame): Dataframe of compounds that are exclusive in experimental condition (inhibitor)
-        df_exclusive_exp (pd.DataFrame): Dataframe of compounds that are exclusive in experimental condition
+        df_all_labels (pd.DataFrame): Labelled rows with customlabel, {exp_code}_er_merge and {exp_code}_er_lb_merge
     """
     assert exp_code in ['CK1a', 'CK1d']
-    # Select relevant columns for df_exp and df_exp_inh
-    df_exp = df_exp[relevant_columns]
-    df_exp_inh = df_exp_inh[relevant_columns]
-
-    # Merge df_exp and df_exp_inh based on relevant columns
-    df_common_exp_and_inh = df_exp.merge(df_exp_inh, how='inner', on=relevant_columns)
-    df_common_exp_and_inh['customlabel'] = 'Allosteric'
-    df_common_exp_and_inh[f'{exp_code}_er_merge'] = np.mean(df_common_exp_and_inh[[f'{exp_code}_er', f'{exp_code}_inh_er']], axis=1)
-    df_common_exp_and_inh[f'{exp_code}_er_lb_merge'] = np.mean(df_common_exp_and_inh[[f'{exp_code}_er_lb', f'{exp_code}_inh_er_lb']], axis=1)
-
-    # Find exclusive rows in df_exp_inh
-    df_exclusive_exp_inh = df_exp_inh[~df_exp_inh['SMILES'].isin(df_exp['SMILES'])].copy()
-    df_exclusive_exp_inh['customlabel'] = 'Cryptic'
-    #df_exclusive_exp_inh.rename(columns={f'{exp_code}_inh_er': 'Enrichment Ratio', f'{exp_code}_inh_er_lb': 'Enrichment Ratio LB'}, inplace=True)
-
-
-    # Find exclusive rows in df_exp
-    df_exclusive_exp = df_exp[~df_exp['SMILES'].isin(df_exp_inh['SMILES'])].copy()
-    df_exclusive_exp['customlabel'] = 'Orthosteric'
-    #df_exclusive_exp.rename(columns={f'{exp_code}_er': 'Enrichment Ratio', f'{exp_code}_er_lb': 'Enrichment Ratio LB'}, inplace=True)
-
-    # Return the processed dataframes
-    return df_common_exp_and_inh, df_exclusive_exp_inh, df_exclusive_exp
+    df_all_labels = labelled_rows(df, labels)
+    allosteric = (df_all_labels['customlabel'] == 'Allosteric').to_numpy()
+    for column in ['er', 'er_lb']:
+        merged = df_all_labels[[f'{exp_code}_{column}', f'{exp_code}_inh_{column}']].mean(axis=1)
+        df_all_labels[f'{exp_code}_{column}_merge'] = np.where(allosteric, merged, np.nan)
+    return df_all_labels
 
 
 if __name__ == "__main__":
@@ -79,7 +59,12 @@ if __name__ == "__main__":
 
     # Load data
     print("Loading data...")
-    df = pd.read_csv(os.path.join(config['output_path'],'preprocessed', 'preprocessed.csv'))
+    # All the columns are read: the negative and filtered tables keep every column of the preprocessed table, while
+    # the labelled tables only keep the columns used by the stratification
+    df = read_table(os.path.join(config['output_path'], 'preprocessed'), 'preprocessed')
+    # Compounds are matched on their registry key, so the same molecule written differently counts as one compound
+    df['compound_key'] = register_compounds(df['SMILES'], 'DOS-DEL', config.get('registry_path', '../registry'))
+    df_relevant = df[relevant_columns + ['compound_key']]
 
     # Filtering data with low hit counts
     print("Filtering data with low hit counts...")
@@ -89,26 +74,31 @@ if __name__ == "__main__":
                          (df['CK1d_hit_counts_0'] <= thresh) & (df['CK1d_hit_counts_1'] <= thresh) &\
                          (df['CK1d_inh_hit_counts_0'] <= thresh) & (df['CK1d_inh_hit_counts_1'] <= thresh)
     df_negative = df[negative_condition]
-    df_CK1a, frac_CK1a = get_filtered_hc_df(df, 'CK1a_hit_counts_0', "CK1a_hit_counts_1", thresh, blank_thresh)
-    df_CK1a_inh, frac_CK1a_inh = get_filtered_hc_df(df, 'CK1a_inh_hit_counts_0', "CK1a_inh_hit_counts_1", thresh, blank_thresh)
-    df_CK1d, frac_CK1d = get_filtered_hc_df(df, 'CK1d_hit_counts_0', "CK1d_hit_counts_1", thresh, blank_thresh)
-    df_CK1d_inh, frac_CK1d_inh = get_filtered_hc_df(df, 'CK1d_inh_hit_counts_0', "CK1d_inh_hit_counts_1", thresh, blank_thresh)
+    masks = {exp_cond: hit_count_mask(df, f'{exp_cond}_hit_counts_0', f'{exp_cond}_hit_counts_1', thresh, blank_thresh)
+             for exp_cond in ['CK1a', 'CK1a_inh', 'CK1d', 'CK1d_inh']}
 
     # Stratify data into three groups: Allosteric, Cryptic, Orthosteric
+    # Both targets are labelled in one pass over integer compound keys
     print("Stratifying data...")
-    df_common_CK1a_and_inh, df_exclusive_CK1a_inh, df_exclusive_CK1a = label_generation(df_CK1a, df_CK1a_inh, relevant_columns, exp_code='CK1a')
-    df_common_CK1d_and_inh, df_exclusive_CK1d_inh, df_exclusive_CK1d = label_generation(df_CK1d, df_CK1d_inh, relevant_columns, exp_code='CK1d')
-    df_CK1a_all_labels = pd.concat([df_exclusive_CK1a, df_exclusive_CK1a_inh,df_common_CK1a_and_inh])
-    df_CK1d_all_labels = pd.concat([df_exclusive_CK1d, df_exclusive_CK1d_inh,df_common_CK1d_and_inh])
+    labels = stratify(compound_keys(df['compound_key']), {'CK1a': (masks['CK1a'], masks['CK1a_inh']),
+                                                           'CK1d': (masks['CK1d'], masks['CK1d_inh'])})
+    df_exclusive_CK1a = labelled_rows(df_relevant, labels['CK1a'], ['Orthosteric'])
+    df_exclusive_CK1d = labelled_rows(df_relevant, labels['CK1d'], ['Orthosteric'])
+    df_CK1a_all_labels = label_table(df_relevant, labels['CK1a'], 'CK1a')
+    df_CK1d_all_labels = label_table(df_relevant, labels['CK1d'], 'CK1d')
 
-    # Write data to csv
-    print("Writing data to csv...")
+    # Write data
+    table_format = config.get('table_format', 'parquet')
+    print(f"Writing data to {table_format}...")
     output_path_stratified = os.path.join(config['output_path'], 'stratified')
     if not os.path.exists(output_path_stratified):
         os.makedirs(output_path_stratified)
 
-    df_exclusive_CK1a.to_csv(os.path.join(output_path_stratified,'CK1a_orthosteric_153k.csv'), index=False)
-    df_exclusive_CK1d.to_csv(os.path.join(output_path_stratified, 'CK1d_orthosteric_58k.csv'), index=False)
-    df_negative.to_csv(os.path.join(output_path_stratified, 'negative_99k.csv'), index=False)
-    df_CK1a_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1a_all_labels.csv'), index=False)
-    df_CK1d_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1d_all_labels.csv'), index=False)
+    write_table(df_exclusive_CK1a, output_path_stratified, 'CK1a_orthosteric_153k', table_format)
+    write_table(df_exclusive_CK1d, output_path_stratified, 'CK1d_orthosteric_58k', table_format)
+    write_table(df_negative, output_path_stratified, 'negative_99k', table_format)
+    write_table(df_CK1a_all_labels, output_path_stratified, 'CK1a_all_labels', table_format)
+    write_table(df_CK1d_all_labels, output_path_stratified, 'CK1d_all_labels', table_format)
+    # The filtered tables are read by statistics.py
+    for exp_cond, mask in masks.items():
+        write_table(df[mask], output_path_stratified, f'{exp_cond}_filtered', table_format)
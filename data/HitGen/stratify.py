@@ -1,114 +1,94 @@
-import numpy as np
 import pandas as pd
-import copy
 import os
+import sys
 import yaml
-def filtering(df, condition, count_thresh, blank_thresh, relevant_columns):
-    filtering_col = {'CK1a': 'A counts', 'CK1a-inh': 'A-inh counts', 'CK1d': 'D counts', 'CK1d-inh': 'D-inh counts'}
-    assert condition in filtering_col.keys(), 'condition must be one of {}'.format(filtering_col.keys())
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import write_table
+from del_common.streaming import stream_partitions, read_partitions
+from del_common.stratification import compound_keys, stratify, labelled_rows, competitive_labels
+from del_common.registry import register_compounds
 
-    df_tmp = df[df[filtering_col[condition]] > count_thresh]
-    df_tmp = df_tmp[df_tmp['blank Effect Size'] <= blank_thresh]
-    return df_tmp[relevant_columns]
+# Columns of the counts and of the effect sizes of each experimental condition
+FILTERING_COL = {'CK1a': 'A counts', 'CK1a-inh': 'A-inh counts', 'CK1d': 'D counts', 'CK1d-inh': 'D-inh counts'}
+EFFECT_SIZE_COL = {'CK1a': ('A Effect Size', 'A-inh Effect Size'), 'CK1d': ('D Effect Size', 'D-inh Effect Size')}
 
-def label_generation(df_exp, df_exp_inh, relevant_columns, exp_code, config):
+def filtering(df, condition, count_thresh, blank_thresh):
+    """Boolean mask of the compounds with more than `count_thresh` counts in `condition` and a blank effect size of
+    at most `blank_thresh`"""
+    assert condition in FILTERING_COL.keys(), 'condition must be one of {}'.format(FILTERING_COL.keys())
+    return ((df[FILTERING_COL[condition]] > count_thresh) & (df['blank Effect Size'] <= blank_thresh)).to_numpy()
+
+def label_tables(df, labels, exp_code, config):
     """
-    df_exp (pd.DataFrame): Dataframe of experimental condition
-    df_exp_inh (pd.DataFrame): Dataframe of experimental condition (inhibitor)
-    relevant_columns (list): List of relevant columns
+    df (pd.DataFrame): Dataframe of all compounds
+    labels (pd.Categorical): Label of each compound for `exp_code` (see `stratify`)
     exp_code (str): Experimental condition code (CK1a or CK1d)
     config (dict): Configuration dictionary
+    Returns a dictionary with the labelled compounds (Allosteric, Orthosteric then Cryptic, with the competitive
+    column for the Allosteric ones), the Orthosteric compounds and the Allosteric compounds followed by the
+    competitive Allosteric compounds
     """
     assert exp_code in ['CK1a', 'CK1d']
-    result = {'Allosteric': None, 'Orthosteric': None, 'Cryptic': None, 
-              'Allosteric_competitive': None, 'Allosteric_non_competitive': None}
-    competive_measure = config[f'competitive_measure_{exp_code}']
-    
-    # Stratify to allosteric
-    df_common_exp_and_inh = df_exp.merge(df_exp_inh, how='inner', on=relevant_columns)
-    df_common_exp_and_inh['customlabel'] = 'Allosteric'
-    result['Allosteric'] = df_common_exp_and_inh
-
-    # Stratify to orthosteric
-    df_exclusive_exp = copy.deepcopy(df_exp[~df_exp.SMILES.isin(df_exp_inh.SMILES)])
-    df_exclusive_exp['customlabel'] = 'Orthosteric'
-    result['Orthosteric'] = df_exclusive_exp
-
-    # Stratify to cryptic
-    df_exclusive_exp_inh = copy.deepcopy(df_exp_inh[~df_exp_inh.SMILES.isin(df_exp.SMILES)])
-    df_exclusive_exp_inh['customlabel'] = 'Cryptic'
-    result['Cryptic'] = df_exclusive_exp_inh
-
-    # Stratify to allosteric competitive and non-competitive
-    if exp_code == 'CK1a':
-        df_common_exp_and_inh['competitive'] = np.where((df_common_exp_and_inh['A Effect Size'] 
-                                                        > df_common_exp_and_inh['A-inh Effect Size'] * competive_measure), 
-                                                        f'{exp_code}_common_competitive_to_inh', f'{exp_code}_common_non_competitive_to_inh')
-    elif exp_code == 'CK1d':
-        df_common_exp_and_inh['competitive'] = np.where((df_common_exp_and_inh['D Effect Size'] 
-                                                        > df_common_exp_and_inh['D-inh Effect Size'] * competive_measure), 
-                                                        f'{exp_code}_common_competitive_to_inh', f'{exp_code}_common_non_competitive_to_inh')
-    df_common_competitive_exp_to_inh = df_common_exp_and_inh.loc[df_common_exp_and_inh['competitive'] == f'{exp_code}_common_competitive_to_inh']
-    df_common_non_competitive_exp_to_inh = df_common_exp_and_inh.loc[df_common_exp_and_inh['competitive'] == f'{exp_code}_common_non_competitive_to_inh', ]
-    df_common_competitive_exp_to_inh.reset_index(drop=True, inplace=True)
-    df_common_non_competitive_exp_to_inh.reset_index(drop=True, inplace=True)
-    result['Allosteric_competitive'] = df_common_competitive_exp_to_inh
-    result['Allosteric_non_competitive'] = df_common_non_competitive_exp_to_inh
-
-    print(exp_code)
-    for key, value in result.items():
-        print(key, len(value))
-    return result
+    exp_column, inh_column = EFFECT_SIZE_COL[exp_code]
+    df_all_labels = labelled_rows(df, labels, ['Allosteric', 'Orthosteric', 'Cryptic'])
+    # Stratify allosteric to competitive and non-competitive
+    df_all_labels['competitive'] = competitive_labels(exp_code, df_all_labels['customlabel'], df_all_labels[exp_column],
+                                                      df_all_labels[inh_column], config[f'competitive_measure_{exp_code}'])
+    df_allosteric = df_all_labels[df_all_labels['customlabel'] == 'Allosteric']
+    df_competitive = df_allosteric[df_allosteric['competitive'] == f'{exp_code}_common_competitive_to_inh']
+    print('Allosteric_competitive', len(df_competitive))
+    print('Allosteric_non_competitive', len(df_allosteric) - len(df_competitive))
+    return {'all_labels': df_all_labels, 'Orthosteric': labelled_rows(df, labels, ['Orthosteric']),
+            'exclusive_competitive': pd.concat([df_allosteric, df_competitive]).reset_index(drop=True)}
 
 if __name__ == '__main__':
     with open('./config.yml', 'r') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
     # Loaind data
     print('Loading data...')
-    molecular_enrichments_df = pd.read_csv(os.path.join(config['data_path'], 'merged_molecule_enrichments.csv'))
-    molecular_enrichments_df.rename(columns={'product_smiles': 'SMILES', 'mol.id':'CompoundIndex'}, inplace=True)
     # Define columns for analysis and threshold for filtering
     effect_size_columns = [f'{x} Effect Size' for x in ['A', 'A-inh', 'D', 'D-inh', 'blank']]
     counts_columns = [f'{l} counts' for l in ['A', 'A-inh', 'D', 'D-inh', 'blank']]
     relevant_columns = ['CompoundIndex', 'SMILES', 'library.name'] + effect_size_columns + counts_columns
     count_thresh = config['count_threshold']
     blank_effect_size_thresh = config['blank_effect_size_threshold']
+    output_path_stratified = os.path.join(config['output_path'], 'stratified')
+    if not os.path.exists(output_path_stratified):
+        os.makedirs(output_path_stratified)
     print("")
     # Filter data
+    # The screen is read chunk by chunk and the compounds passing the filter of each condition are appended to
+    # output/stratified/partitions/{condition}.parquet, so only the filtered compounds are ever held in memory
     print('Filtering data...')
-    df_CK1a = filtering(molecular_enrichments_df, 'CK1a', count_thresh, blank_effect_size_thresh, relevant_columns)
-    df_CK1a_inh = filtering(molecular_enrichments_df, 'CK1a-inh', count_thresh, blank_effect_size_thresh, relevant_columns)
-    df_CK1d = filtering(molecular_enrichments_df, 'CK1d', count_thresh, blank_effect_size_thresh, relevant_columns)
-    df_CK1d_inh = filtering(molecular_enrichments_df, 'CK1d-inh', count_thresh, blank_effect_size_thresh, relevant_columns)
+    partition_path = os.path.join(output_path_stratified, 'partitions')
+    stream_partitions(os.path.join(config['data_path'], 'merged_molecule_enrichments.csv'),
+                      {condition: lambda chunk, condition=condition: filtering(chunk, condition, count_thresh, blank_effect_size_thresh)
+                       for condition in FILTERING_COL},
+                      partition_path, usecols=['mol.id', 'product_smiles', 'library.name'] + effect_size_columns + counts_columns,
+                      rename={'product_smiles': 'SMILES', 'mol.id':'CompoundIndex'}, chunk_size=config.get('chunk_size', 1000000))
+    molecular_enrichments_df, masks = read_partitions(partition_path, list(FILTERING_COL), columns=relevant_columns)
     print("")
     # Stratify data into three major categories: Allosteric, Orthosteric, and Cryptic
+    # Both targets are labelled in one pass over integer compound keys. Compounds are matched on their registry key,
+    # so the same molecule written differently counts as one compound
     # The purpose of CK1x exclusive competitive is unclear. feel free to leave them out
     print('Stratifying data...')
-    results_CK1a = label_generation(df_CK1a, df_CK1a_inh, relevant_columns, 'CK1a', config)
-    df_CK1a_all_labels = pd.concat([results_CK1a['Allosteric'], results_CK1a['Orthosteric'], results_CK1a['Cryptic']])
-    df_CK1a_orthosteric = results_CK1a['Orthosteric']
-    df_CK1a_exclusive_competitive = pd.concat([results_CK1a['Allosteric'], results_CK1a['Allosteric_competitive']])
-    df_CK1a_exclusive_competitive.reset_index(drop=True, inplace=True)
+    molecular_enrichments_df['compound_key'] = register_compounds(molecular_enrichments_df['SMILES'], 'HitGen',
+                                                                  config.get('registry_path', '../registry'))
+    labels = stratify(compound_keys(molecular_enrichments_df['compound_key']),
+                      {'CK1a': (masks['CK1a'], masks['CK1a-inh']), 'CK1d': (masks['CK1d'], masks['CK1d-inh'])})
+    print('CK1a')
+    results_CK1a = label_tables(molecular_enrichments_df, labels['CK1a'], 'CK1a', config)
     print("")
-    results_CK1d = label_generation(df_CK1d, df_CK1d_inh, relevant_columns, 'CK1d', config)
-    df_CK1d_all_labels = pd.concat([results_CK1d['Allosteric'], results_CK1d['Orthosteric'], results_CK1d['Cryptic']])
-    df_CK1d_orthosteric = results_CK1d['Orthosteric']
-    df_CK1d_exclusive_competitive = pd.concat([results_CK1d['Allosteric'], results_CK1d['Allosteric_competitive']])
-    df_CK1d_exclusive_competitive.reset_index(drop=True, inplace=True)
+    print('CK1d')
+    results_CK1d = label_tables(molecular_enrichments_df, labels['CK1d'], 'CK1d', config)
     print("")
-    print("Writing data to csv...")
-    output_path_stratified = os.path.join(config['output_path'], 'stratified')
-    if not os.path.exists(output_path_stratified):
-        os.makedirs(output_path_stratified)
-
-    df_CK1a.to_csv(os.path.join(output_path_stratified, 'CK1a_filtered.csv'), index=False)
-    df_CK1a_inh.to_csv(os.path.join(output_path_stratified, 'CK1a_inh_filtered.csv'), index=False)
-    df_CK1a_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1a_all_labels.csv'), index=False)
-    df_CK1a_orthosteric.to_csv(os.path.join(output_path_stratified, 'CK1a_orthosteric.csv'), index=False)
-    df_CK1a_exclusive_competitive.to_csv(os.path.join(output_path_stratified, 'CK1a_exclusive_competitive.csv'), index=False)
+    table_format = config.get('table_format', 'parquet')
+    print(f"Writing data to {table_format}...")
 
-    df_CK1d.to_csv(os.path.join(output_path_stratified, 'CK1d_filtered.csv'), index=False)
-    df_CK1d_inh.to_csv(os.path.join(output_path_stratified, 'CK1d_inh_filtered.csv'), index=False)
-    df_CK1d_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1d_all_labels.csv'), index=False)
-    df_CK1d_orthosteric.to_csv(os.path.join(output_path_stratified, 'CK1d_orthosteric.csv'), index=False)
-    df_CK1d_exclusive_competitive.to_csv(os.path.join(output_path_stratified, 'CK1d_exclusive_competitive.csv'), index=False)
\ No newline at end of file
+    for exp_code, results in [('CK1a', results_CK1a), ('CK1d', results_CK1d)]:
+        write_table(molecular_enrichments_df[masks[exp_code]], output_path_stratified, f'{exp_code}_filtered', table_format)
+        write_table(molecular_enrichments_df[masks[f'{exp_code}-inh']], output_path_stratified, f'{exp_code}_inh_filtered', table_format)
+        write_table(results['all_labels'], output_path_stratified, f'{exp_code}_all_labels', table_format)
+        write_table(results['Orthosteric'], output_path_stratified, f'{exp_code}_orthosteric', table_format)
+        write_table(results['exclusive_competitive'], output_path_stratified, f'{exp_code}_exclusive_competitive', table_format)
\ No newline at end of file
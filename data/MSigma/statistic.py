@@ -1,66 +1,76 @@
-import pandas as pd
-import seaborn as sns
-import matplotlib.pylab as plt
+import argparse
 import numpy as np
 import os
+import sys
 import yaml
-import copy
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import read_table
+from del_common.streaming import iter_csv_chunks
+from del_common.sketches import sketch_chunks, quantile_table
+from del_common.report import group_boxes, render_report, save_figures, load_figures
 
 palette = {"Allosteric":"tab:blue",
            "Orthosteric":"tab:green",
            "Cryptic":"tab:purple"}
 
-def get_quantiles(df, col):
-    """Get the quantiles of the dataframe for the columns of interest
+def zscore_figure(df_all_labels, exp_code, exp_column, inh_column, output_path, k=1000):
+    """Boxen plot of the log10 ZScore of each label (the mean of both conditions for the Allosteric compounds)
     Args:
-        df (pd.DataFrame): Dataframe contains effect size and counts
-        col (str): Column of interest
+        df_all_labels (pd.DataFrame): Labelled compounds of `exp_code` with their ZScores
+        exp_code (str): Experimental condition code (CK1a or CK1d)
+        exp_column (str): ZScore column without inhibitor
+        inh_column (str): ZScore column with inhibitor
+        output_path (str): Output path
+        k (int): Accuracy of the letter values of the large groups
     Returns:
-        pd.DataFrame: Dataframe of quantiles for the column of interest
+        dict: ZScore.png figure
     """
-    return df[col].quantile([0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0])
+    labels = df_all_labels['customlabel']
+    zscore = np.select([(labels == 'Orthosteric').to_numpy(), (labels == 'Allosteric').to_numpy(), (labels == 'Cryptic').to_numpy()],
+                       [df_all_labels[exp_column], df_all_labels[[exp_column, inh_column]].mean(axis=1), df_all_labels[inh_column]],
+                       np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_zscore = np.log10(zscore)
+    return {'path': os.path.join(output_path, 'lib_stat', exp_code, 'ZScore.png'), 'kind': 'boxen', 'palette': palette,
+            'boxes': group_boxes(labels[~np.isnan(zscore)], log_zscore[~np.isnan(zscore)], k),
+            'xlabel': 'customlabel', 'ylabel': 'log 10 ZScore'}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_cache", action="store_true",
+                        help="render the figures from the aggregates cached by the last run, without reading any table")
+    args = parser.parse_args()
     # Load data
     with open('./config.yml', 'r') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
-    df_all = pd.read_csv(os.path.join(config['data_path'], "Broad_10M_Screen_Results_2022-07-12.csv"))
-    df_CK1a_all_labels = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1a_all_labels.csv'))
-    df_CK1d_all_labels = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1d_all_labels.csv'))
-    df_CK1a = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1a_filtered.csv'))
-    df_CK1a_inh = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1a_inh_filtered.csv'))
-    df_CK1d = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1d_filtered.csv'))
-    df_CK1d_inh = pd.read_csv(os.path.join(config['output_path'], 'stratified', 'CK1d_inh_filtered.csv'))
+    num_workers = config.get('num_workers', 1)
+    k = config.get('quantile_sketch_k', 1000)
+    cache_path = os.path.join(config['output_path'], 'lib_stat', 'report_figures.pkl')
+    if args.from_cache:
+        print(f"Rendering the figures cached in {cache_path}...")
+        render_report(load_figures(cache_path), num_workers)
+        sys.exit(0)
+
+    # Only the columns used below are read (the filtered tables are not needed here)
+    stratified_path = os.path.join(config['output_path'], 'stratified')
+    df_CK1a_all_labels = read_table(stratified_path, 'CK1a_all_labels', columns=['customlabel', 'ZScore_A', 'ZScore_A_inh'])
+    df_CK1d_all_labels = read_table(stratified_path, 'CK1d_all_labels', columns=['customlabel', 'ZScore_D', 'ZScore_D_inh'])
 
     # Prepare output path
     os.makedirs(os.path.join(config['output_path'],'lib_stat', 'all'), exist_ok=True)
-    os.makedirs(os.path.join(config['output_path'],'lib_stat', 'CK1a'), exist_ok=True)
-    os.makedirs(os.path.join(config['output_path'],'lib_stat', 'CK1d'), exist_ok=True)
-    
-    # Calculate quantile table for the whole library
-    df_all_quantiles= get_quantiles(df_all, 'ZScore')
+
+    # Calculate quantile table for the whole library, sketched chunk by chunk instead of loading the whole screen
+    _, sketches = sketch_chunks(iter_csv_chunks(os.path.join(config['data_path'], "Broad_10M_Screen_Results_2022-07-12.csv"),
+                                                usecols=['ZScore'], chunk_size=config.get('chunk_size', 1000000)),
+                                {'all': (None, ['ZScore'])}, k=k, num_workers=num_workers)
+    df_all_quantiles = quantile_table({'ZScore': sketches[('all', 'ZScore')]})
     df_all_quantiles.to_csv(os.path.join(config['output_path'], 'lib_stat', 'all', 'zscore_quantiles.csv'), index=False)
-    
-    # Plot Zscore of CK1a
-    df_CK1a_orthosteric = copy.deepcopy(df_CK1a_all_labels[df_CK1a_all_labels['customlabel'] == 'Orthosteric'])
-    df_CK1a_allosteric = copy.deepcopy(df_CK1a_all_labels[df_CK1a_all_labels['customlabel'] == 'Allosteric'])
-    df_CK1a_cryptic = copy.deepcopy(df_CK1a_all_labels[df_CK1a_all_labels['customlabel'] == 'Cryptic'])
-    df_CK1a_orthosteric['log 10 ZScore'] = np.log10(df_CK1a_orthosteric['ZScore_A'])
-    df_CK1a_allosteric['log 10 ZScore'] = np.log10(np.mean(df_CK1a_allosteric[['ZScore_A', 'ZScore_A_inh']], axis=1))
-    df_CK1a_cryptic['log 10 ZScore'] = np.log10(df_CK1a_cryptic['ZScore_A_inh'])
-    df_effectsize_boxenplot = pd.concat([df_CK1a_orthosteric, df_CK1a_allosteric, df_CK1a_cryptic])
-    sns.boxenplot(data=df_effectsize_boxenplot.sort_values('customlabel'), x='customlabel', y='log 10 ZScore', palette=palette)    
-    plt.savefig(os.path.join(config['output_path'], 'lib_stat', 'CK1a', 'ZScore.png'), bbox_inches='tight')
-    plt.clf()
 
-    # Plot Zscore of CK1d
-    df_CK1d_orthosteric = copy.deepcopy(df_CK1d_all_labels[df_CK1d_all_labels['customlabel'] == 'Orthosteric'])
-    df_CK1d_allosteric = copy.deepcopy(df_CK1d_all_labels[df_CK1d_all_labels['customlabel'] == 'Allosteric'])
-    df_CK1d_cryptic = copy.deepcopy(df_CK1d_all_labels[df_CK1d_all_labels['customlabel'] == 'Cryptic'])
-    df_CK1d_orthosteric['log 10 ZScore'] = np.log10(df_CK1d_orthosteric['ZScore_D'])
-    df_CK1d_allosteric['log 10 ZScore'] = np.log10(np.mean(df_CK1d_allosteric[['ZScore_D', 'ZScore_D_inh']], axis=1))
-    df_CK1d_cryptic['log 10 ZScore'] = np.log10(df_CK1d_cryptic['ZScore_D_inh'])
-    df_effectsize_boxenplot = pd.concat([df_CK1d_orthosteric, df_CK1d_allosteric, df_CK1d_cryptic])
-    sns.boxenplot(data=df_effectsize_boxenplot.sort_values('customlabel'), x='customlabel', y='log 10 ZScore', palette=palette)    
-    plt.savefig(os.path.join(config['output_path'], 'lib_stat', 'CK1d', 'ZScore.png'), bbox_inches='tight')
-    plt.clf()
\ No newline at end of file
+    # ZScore of each label of CK1a and CK1d (log scale)
+    figures = [zscore_figure(df_CK1a_all_labels, 'CK1a', 'ZScore_A', 'ZScore_A_inh', config['output_path'], k),
+               zscore_figure(df_CK1d_all_labels, 'CK1d', 'ZScore_D', 'ZScore_D_inh', config['output_path'], k)]
+
+    # The figures only hold aggregates: they are cached, then rendered in parallel
+    save_figures(figures, cache_path)
+    print(f"Rendering {len(figures)} figures...")
+    render_report(figures, num_workers)
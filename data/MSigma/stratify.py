@@ -1,38 +1,50 @@
-import pandas as pd
-import copy
 import os
+import sys
 import numpy as np
 import yaml
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from del_common.table_io import write_table
+from del_common.streaming import stream_partitions, read_partitions
+from del_common.stratification import ALLOSTERIC, compound_keys, stratify, compound_values, competitive_labels, labelled_rows
+from del_common.registry import register_compounds
 
-def label_generation(df_exp, df_exp_inh, relevant_columns, exp_code):
+# Samples screened without and with the inhibitor, and the names of their ZScore columns in the outputs
+SAMPLES = {'CK1a': ('Sigma-A', 'Sigma-A-inh'), 'CK1d': ('Sigma-D', 'Sigma-D-inh')}
+ZSCORE_COLUMNS = {'CK1a': ('ZScore_A', 'ZScore_A_inh'), 'CK1d': ('ZScore_D', 'ZScore_D_inh')}
+# The CK1a positive set adds the competitive common compounds to the orthosteric ones, the CK1d positive set
+# adds all common compounds (as in the released datasets)
+POSITIVE_COMPETITIVE_ONLY = {'CK1a': True, 'CK1d': False}
+
+def label_tables(df_all, keys, masks, labels, exp_code):
     """
-    df_exp (pd.DataFrame): Dataframe of experimental condition
-    df_exp_inh (pd.DataFrame): Dataframe of experimental condition (inhibitor)
-    relevant_columns (list): List of relevant columns
+    df_all (pd.DataFrame): Screening results, one row per compound and sample
+    keys (np.ndarray): Compound key of each row (see `compound_keys`)
+    masks (tuple): Boolean masks of the rows of the sample without and with the inhibitor
+    labels (pd.Categorical): Label of each row for `exp_code` (see `stratify`)
     exp_code (str): Experimental condition code (CK1a or CK1d)
-    config (dict): Configuration dictionary
+    Returns a dictionary with the rows of both samples, the labelled compounds (Allosteric, Orthosteric then Cryptic,
+    with the ZScores of both samples), the Orthosteric compounds and the positive compounds
     """
     assert exp_code in ['CK1a', 'CK1d']
-    result = {'Allosteric': None, 'Orthosteric': None, 'Cryptic': None}
-    
-    # Stratify to allosteric
-    df_common_exp_and_inh = df_exp.merge(df_exp_inh, how='inner', on=relevant_columns)
-    df_common_exp_and_inh['customlabel'] = 'Allosteric'
-    result['Allosteric'] = df_common_exp_and_inh
-
-    # Stratify to orthosteric
-    df_exclusive_exp = copy.deepcopy(df_exp[~df_exp.SMILES.isin(df_exp_inh.SMILES)])
-    df_exclusive_exp['customlabel'] = 'Orthosteric'
-    result['Orthosteric'] = df_exclusive_exp
+    exp_mask, inh_mask = masks
+    exp_column, inh_column = ZSCORE_COLUMNS[exp_code]
+    zscore = df_all['ZScore'].to_numpy(dtype=np.float64)
+    # The rows of the inhibitor sample keep their own ZScore, the other rows get the one of their compound
+    df_scored = df_all[['CompoundIndex', 'SMILES', 'compound_key', 'Sample']].assign(**{
+        exp_column: np.where(exp_mask, zscore, np.nan),
+        inh_column: np.where(inh_mask, zscore, compound_values(keys, inh_mask, zscore))})
+    df_all_labels = labelled_rows(df_scored, labels, ['Allosteric', 'Orthosteric', 'Cryptic'])
+    df_orthosteric = df_all_labels[df_all_labels['customlabel'] == 'Orthosteric'].drop(columns=inh_column)
 
-    # Stratify to cryptic
-    df_exclusive_exp_inh = copy.deepcopy(df_exp_inh[~df_exp_inh.SMILES.isin(df_exp.SMILES)])
-    df_exclusive_exp_inh['customlabel'] = 'Cryptic'
-    result['Cryptic'] = df_exclusive_exp_inh
-    print(exp_code)
-    for key, value in result.items():
-        print(key, len(value))
-    return result
+    print(f"Generating {exp_code} positive label by merging part of allosteric and orthosteric")
+    competitive = competitive_labels(exp_code, labels, df_scored[exp_column], df_scored[inh_column])
+    is_competitive = np.asarray(competitive.codes) == 0
+    print(f"Total compounds common between {exp_code} and {exp_code}+inh but competitive to {exp_code}", is_competitive.sum())
+    positive_mask = (np.asarray(labels.codes) != ALLOSTERIC) | is_competitive if POSITIVE_COMPETITIVE_ONLY[exp_code] else None
+    df_positive = labelled_rows(df_scored, labels, ['Orthosteric', 'Allosteric'], mask=positive_mask).drop(columns=inh_column)
+    return {'filtered': df_all[exp_mask].rename(columns={'ZScore': exp_column}),
+            'inh_filtered': df_all[inh_mask].rename(columns={'ZScore': inh_column}),
+            'all_labels': df_all_labels, 'orthosteric': df_orthosteric, 'positive': df_positive}
 
 if __name__ == "__main__":
     # Load data
@@ -42,57 +54,31 @@ if __name__ == "__main__":
     if not os.path.exists(output_path_stratified):
         os.makedirs(output_path_stratified, exist_ok=True)
     relevant_columns = ['CompoundIndex','SMILES', 'Sample', 'ZScore']
-    df_all = pd.read_csv(os.path.join(config['data_path'], "Broad_10M_Screen_Results_2022-07-12.csv"), usecols=relevant_columns)
+    # The screen is read chunk by chunk and the rows of the CK1a/CK1d samples are appended to
+    # output/stratified/partitions/{Sample}.parquet, so the rows of the other samples are never held in memory
+    partition_path = os.path.join(output_path_stratified, 'partitions')
+    sample_names = [sample for samples in SAMPLES.values() for sample in samples]
+    stream_partitions(os.path.join(config['data_path'], "Broad_10M_Screen_Results_2022-07-12.csv"),
+                      {sample: lambda chunk, sample=sample: chunk['Sample'] == sample for sample in sample_names},
+                      partition_path, usecols=relevant_columns, chunk_size=config.get('chunk_size', 1000000))
+    df_all, sample_masks = read_partitions(partition_path, sample_names, columns=relevant_columns)
 
-    df_CK1a = copy.deepcopy(df_all.loc[df_all["Sample"] == "Sigma-A"])
-    df_CK1a_inh = copy.deepcopy(df_all.loc[df_all["Sample"] == "Sigma-A-inh"])
-    df_CK1a.rename(columns={'ZScore': 'ZScore_A'}, inplace=True)
-    df_CK1a_inh.rename(columns={'ZScore': 'ZScore_A_inh'}, inplace=True)
-    results_CK1a = label_generation(df_CK1a, df_CK1a_inh, ['SMILES'], 'CK1a')
-    df_CK1a_all_labels = pd.concat([results_CK1a['Allosteric'], results_CK1a['Orthosteric'], results_CK1a['Cryptic']])
-    df_CK1a_orthosteric = results_CK1a['Orthosteric']
-    print("Generating CK1a positive label by merging part of allosteric and orthosteric")
-    df_common_CK1a_and_inh = df_CK1a.merge(df_CK1a_inh, how='inner', on=['SMILES'])
-    df_common_CK1a_and_inh['customlabel'] = 'common_CK1a_CK1aInh'
-    df_common_CK1a_and_inh['ZScore'] = df_common_CK1a_and_inh[['ZScore_A']]
-    df_common_CK1a_and_inh['competitive'] = np.where((df_common_CK1a_and_inh['ZScore_A'] > df_common_CK1a_and_inh['ZScore_A_inh']), 'CK1a_common_competitive_to_inh', 'CK1a_common_non_competitive_to_inh')
-    df_common_competitive_CK1a_to_inh = df_common_CK1a_and_inh.loc[df_common_CK1a_and_inh['competitive'] == 'CK1a_common_competitive_to_inh']
-    df_common_competitive_CK1a_to_inh = df_common_competitive_CK1a_to_inh.reset_index(drop=True)
-    df_common_competitive_CK1a_to_inh = df_common_competitive_CK1a_to_inh[["CompoundIndex_x", "SMILES", "Sample_x", "ZScore_A"]]
-    df_common_competitive_CK1a_to_inh = df_common_competitive_CK1a_to_inh.rename({'CompoundIndex_x':'CompoundIndex','Sample_x': 'Sample'}, axis=1)
-    df_CK1a_positive = pd.concat([results_CK1a['Orthosteric'], df_common_competitive_CK1a_to_inh], axis=0)
-    print("Total compounds common between CK1d and CK1d+inh but competitive to CK1a", len(df_common_competitive_CK1a_to_inh))
+    # Both targets are labelled in one pass over integer compound keys. Compounds are matched on their registry key,
+    # so the same molecule written differently counts as one compound
+    df_all['compound_key'] = register_compounds(df_all['SMILES'], 'MSigma', config.get('registry_path', '../registry'))
+    keys = compound_keys(df_all['compound_key'])
+    masks = {exp_code: tuple(sample_masks[sample] for sample in samples) for exp_code, samples in SAMPLES.items()}
+    labels = stratify(keys, masks)
     print("")
 
-    df_CK1d = copy.deepcopy(df_all.loc[df_all["Sample"] == "Sigma-D"])
-    df_CK1d_inh = copy.deepcopy(df_all.loc[df_all["Sample"] == "Sigma-D-inh"])
-    df_CK1d.rename(columns={'ZScore': 'ZScore_D'}, inplace=True)
-    df_CK1d_inh.rename(columns={'ZScore': 'ZScore_D_inh'}, inplace=True)
-    results_CK1d = label_generation(df_CK1d, df_CK1d_inh, ['SMILES'], 'CK1d')
-    df_CK1d_all_labels = pd.concat([results_CK1d['Allosteric'], results_CK1d['Orthosteric'], results_CK1d['Cryptic']])
-    df_CK1d_orthosteric = results_CK1d['Orthosteric']
-    print("Generating CK1d positive label by merging part of allosteric and orthosteric")
-    df_common_CK1d_and_inh = df_CK1d.merge(df_CK1d_inh, how='inner', on=['SMILES'])
-    df_common_CK1d_and_inh['customlabel'] = 'common_CK1d_CK1dInh'
-    df_common_CK1d_and_inh['ZScore'] = df_common_CK1d_and_inh[['ZScore_D']]
-    df_common_CK1d_and_inh['competitive'] = np.where((df_common_CK1d_and_inh['ZScore_D'] > df_common_CK1d_and_inh['ZScore_D_inh']), 'CK1d_common_competitive_to_inh', 'CK1d_common_non_competitive_to_inh')
-    df_common_competitive_CK1d_to_inh = df_common_CK1d_and_inh.loc[df_common_CK1d_and_inh['competitive'] == 'CK1d_common_competitive_to_inh', ]
-    df_common_competitive_CK1d_to_inh = df_common_competitive_CK1d_to_inh.reset_index(drop=True)
-    df_common_competitive_CK1d_to_inh = df_common_competitive_CK1d_to_inh[["CompoundIndex_x", "SMILES", "Sample_x", "ZScore"]]
-    df_common_competitive_CK1d_to_inh = df_common_competitive_CK1d_to_inh.rename({'CompoundIndex_x':'CompoundIndex', 'Sample_x': 'Sample'}, axis=1)
-    df_CK1d_positive = pd.concat([results_CK1d['Orthosteric'], df_common_CK1d_and_inh], axis=0)
-    print("Total compounds common between CK1d and CK1d+inh but competitive to CK1d", len(df_common_competitive_CK1d_to_inh))
-
-    # Following the naming convention of other two libraries (HitGen and DOS-DEL),
-    # We append a filtered suffix to the file name but there is no filtering happens in MSigma
-    df_CK1a.to_csv(os.path.join(output_path_stratified, 'CK1a_filtered.csv'), index=False)
-    df_CK1a_inh.to_csv(os.path.join(output_path_stratified, 'CK1a_inh_filtered.csv'), index=False)
-    df_CK1a_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1a_all_labels.csv'), index=False)
-    df_CK1a_orthosteric.to_csv(os.path.join(output_path_stratified, 'CK1a_orthosteric.csv'), index=False)
-    df_CK1a_positive.to_csv(os.path.join(output_path_stratified, 'CK1a_positive.csv'), index=False)
-
-    df_CK1d.to_csv(os.path.join(output_path_stratified, 'CK1d_filtered.csv'), index=False)
-    df_CK1d_inh.to_csv(os.path.join(output_path_stratified, 'CK1d_inh_filtered.csv'), index=False)
-    df_CK1d_all_labels.to_csv(os.path.join(output_path_stratified, 'CK1d_all_labels.csv'), index=False)
-    df_CK1d_orthosteric.to_csv(os.path.join(output_path_stratified, 'CK1d_orthosteric.csv'), index=False)
-    df_CK1d_positive.to_csv(os.path.join(output_path_stratified, 'CK1d_positive.csv'), index=False)
\ No newline at end of file
+    table_format = config.get('table_format', 'parquet')
+    for exp_code in SAMPLES:
+        results = label_tables(df_all, keys, masks[exp_code], labels[exp_code], exp_code)
+        print("")
+        # Following the naming convention of other two libraries (HitGen and DOS-DEL),
+        # We append a filtered suffix to the file name but there is no filtering happens in MSigma
+        write_table(results['filtered'], output_path_stratified, f'{exp_code}_filtered', table_format)
+        write_table(results['inh_filtered'], output_path_stratified, f'{exp_code}_inh_filtered', table_format)
+        write_table(results['all_labels'], output_path_stratified, f'{exp_code}_all_labels', table_format)
+        write_table(results['orthosteric'], output_path_stratified, f'{exp_code}_orthosteric', table_format)
+        write_table(results['positive'], output_path_stratified, f'{exp_code}_positive', table_format)
@@ -0,0 +1,54 @@
+import os
+import json
+import hashlib
+
+# Manifests record what each intermediate output was built from (content hashes of the input files and the
+# config values it depends on), so that a rerun only rebuilds the outputs whose fingerprint changed. The size and
+# modification time of every hashed file are kept with its hash, so a rerun only reads the files that changed.
+
+def file_digest(path, block_size=1 << 20):
+    """SHA-256 of the content of a file, read `block_size` bytes at a time"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_stat(path):
+    """Size and modification time (in ns) of a file, which change whenever its content is rewritten"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def cached_digests(paths, cache, map_function=map):
+    """SHA-256 of each file, hashing only the files whose size or modification time differ from `cache`
+    Args:
+        paths (list): Files to hash
+        cache (dict): path -> {'size', 'mtime_ns', 'sha256'} of the previous run (typically stored in the
+            manifest), updated in place
+        map_function (callable): `map` or `executor.map`, to hash the changed files in parallel
+    Returns:
+        dict: path -> sha256
+    """
+    stats = {path: file_stat(path) for path in paths}
+    changed = [path for path in paths if {key: cache.get(path, {}).get(key) for key in stats[path]} != stats[path]]
+    for path, digest in zip(changed, map_function(file_digest, changed)):
+        cache[path] = dict(stats[path], sha256=digest)
+    return {path: cache[path]['sha256'] for path in paths}
+
+def config_subset(config, keys):
+    """Values of the config keys an output depends on, in a form that compares equal after a json round trip"""
+    return json.loads(json.dumps({key: config.get(key) for key in keys}, sort_keys=True))
+
+def load_manifest(path):
+    """Load a manifest written by `save_manifest`, or an empty one if it does not exist yet"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, path):
+    """Write a manifest atomically, so an interrupted run never leaves a truncated file behind"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
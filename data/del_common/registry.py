@@ -0,0 +1,182 @@
+import os
+import sys
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from rdkit import Chem, RDLogger
+
+# The DEL vendors write the same molecule differently (HitGen `product_smiles`, DOS-DEL `structure`, MSigma
+# `SMILES`), so compounds are matched on a 64-bit key of their canonical SMILES rather than on the raw strings.
+# The registry remembers the key of every raw SMILES it has seen (by a 64-bit hash of the raw string), so each
+# structure is parsed by RDKit only once across runs and libraries, and later lookups are integer searches.
+#
+# Files of the registry folder:
+#   compounds.parquet: raw_key, key and canonical SMILES of every raw SMILES registered (sorted by raw_key)
+#   libraries.parquet: library and key of the compounds registered by each library
+
+# Number of SMILES canonicalized per worker task
+CANONICALIZE_BATCH = 10000
+
+def hash_keys(strings):
+    """64-bit blake2b hash of each string, as signed integers (so they can be stored in any table format)"""
+    digests = b''.join(hashlib.blake2b(string.encode(), digest_size=8).digest() for string in strings)
+    return np.frombuffer(digests, dtype='<i8').astype(np.int64)
+
+def expand_keys(unique_keys, codes):
+    """Key of each row from the keys of the unique values and the codes of `pd.factorize`, whose code -1 (a missing
+    value) gets the key -1 instead of the key of the last unique value"""
+    return np.where(codes >= 0, unique_keys[codes], -1) if len(unique_keys) else np.full(len(codes), -1, dtype=np.int64)
+
+def canonicalize_batch(smiles):
+    """Canonical SMILES of each SMILES string (None if RDKit cannot parse it)"""
+    RDLogger.DisableLog('rdApp.*')
+    canonical = []
+    for smiles_string in smiles:
+        mol = Chem.MolFromSmiles(smiles_string)
+        canonical.append(Chem.MolToSmiles(mol) if mol is not None else None)
+    return canonical
+
+def canonicalize(smiles, num_processes=None):
+    """Canonicalize SMILES strings in parallel (see `canonicalize_batch`)"""
+    num_processes = num_processes or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    batches = [smiles[start:start + CANONICALIZE_BATCH] for start in range(0, len(smiles), CANONICALIZE_BATCH)]
+    if num_processes <= 1 or len(batches) <= 1:
+        return [canonical for batch in batches for canonical in canonicalize_batch(batch)]
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        return [canonical for batch in executor.map(canonicalize_batch, batches) for canonical in batch]
+
+class CompoundRegistry:
+    """Persistent mapping from raw SMILES to 64-bit compound keys, shared by the DEL pipelines"""
+    def __init__(self, path, compounds=None, libraries=None):
+        self.path = path
+        self.compounds = compounds if compounds is not None else pd.DataFrame(
+            {'raw_key': np.zeros(0, dtype=np.int64), 'key': np.zeros(0, dtype=np.int64), 'SMILES': pd.Series(dtype=object)})
+        self.libraries = libraries if libraries is not None else pd.DataFrame(
+            {'library': pd.Series(dtype='category'), 'key': np.zeros(0, dtype=np.int64)})
+
+    @classmethod
+    def load(cls, path):
+        """Load the registry stored in the folder `path` (empty if it does not exist yet)"""
+        compounds_path, libraries_path = os.path.join(path, 'compounds.parquet'), os.path.join(path, 'libraries.parquet')
+        if not os.path.exists(compounds_path):
+            return cls(path)
+        libraries = pd.read_parquet(libraries_path) if os.path.exists(libraries_path) else None
+        return cls(path, pd.read_parquet(compounds_path), libraries)
+
+    def save(self):
+        """Write the registry atomically, so an interrupted run never leaves a truncated file behind"""
+        os.makedirs(self.path, exist_ok=True)
+        for name, table in [('compounds', self.compounds), ('libraries', self.libraries)]:
+            path = os.path.join(self.path, f'{name}.parquet')
+            table.to_parquet(f'{path}.tmp', index=False)
+            os.replace(f'{path}.tmp', path)
+
+    def lookup(self, smiles):
+        """Compound key of each raw SMILES, -1 for the SMILES that are missing or not registered
+        Args:
+            smiles (array-like): Raw SMILES strings
+        Returns:
+            np.ndarray: int64 compound keys
+        """
+        codes, uniques = pd.factorize(np.asarray(smiles, dtype=object))
+        return expand_keys(self._lookup_unique(hash_keys(uniques)), codes)
+
+    def _lookup_unique(self, raw_keys):
+        known = self.compounds['raw_key'].to_numpy()
+        positions = np.minimum(np.searchsorted(known, raw_keys), max(len(known) - 1, 0))
+        found = (known[positions] == raw_keys) if len(known) else np.zeros(len(raw_keys), dtype=bool)
+        return np.where(found, self.compounds['key'].to_numpy()[positions] if len(known) else -1, -1)
+
+    def register(self, smiles, library=None, num_processes=None):
+        """Compound key of each raw SMILES, canonicalizing (in parallel) only the SMILES never registered before
+        The key is the hash of the canonical SMILES, or of the raw string if RDKit cannot parse it.
+        Args:
+            smiles (array-like): Raw SMILES strings
+            library (str, optional): Library the compounds are recorded in (e.g. HitGen). Defaults to None
+            num_processes (int, optional): Number of processes canonicalizing the new SMILES. Defaults to None (all cores)
+        Returns:
+            np.ndarray: int64 compound keys (-1 for missing SMILES)
+        """
+        codes, uniques = pd.factorize(np.asarray(smiles, dtype=object))
+        raw_keys = hash_keys(uniques)
+        keys = self._lookup_unique(raw_keys)
+        new = np.flatnonzero(keys == -1)
+        if len(new):
+            canonical = canonicalize(list(uniques[new]), num_processes)
+            keys[new] = hash_keys([c if c is not None else raw for c, raw in zip(canonical, uniques[new])])
+            added = pd.DataFrame({'raw_key': raw_keys[new], 'key': keys[new], 'SMILES': pd.Series(canonical, dtype=object)})
+            self._check_collisions(added)
+            self.compounds = pd.concat([self.compounds, added], ignore_index=True).sort_values('raw_key', kind='stable', ignore_index=True)
+            print(f"Registered {len(new)} new SMILES ({sum(c is None for c in canonical)} could not be parsed)")
+        if library is not None:
+            self.record(library, keys)
+        return expand_keys(keys, codes)
+
+    def _check_collisions(self, added):
+        """Make sure no two different canonical SMILES share a key (extremely unlikely with 64-bit keys)"""
+        known = self.compounds[['key', 'SMILES']]
+        pairs = pd.concat([known[known['key'].isin(added['key'])], added[['key', 'SMILES']]]).dropna().drop_duplicates()
+        colliding = pairs['key'][pairs['key'].duplicated()]
+        if len(colliding):
+            raise ValueError(f"Different SMILES share the compound keys {colliding.unique().tolist()}")
+
+    def record(self, library, keys):
+        """Record that the compounds `keys` belong to `library`, replacing what it recorded before"""
+        others = self.libraries.astype({'library': str})
+        others = others[others['library'] != library]
+        self.libraries = pd.concat([others, pd.DataFrame({'library': library, 'key': np.unique(keys)})],
+                                   ignore_index=True).astype({'library': 'category'})
+
+    def library_keys(self):
+        """Library -> sorted unique keys of its compounds"""
+        return {str(library): np.sort(group['key'].to_numpy()) for library, group in self.libraries.groupby('library', observed=True)}
+
+    def overlap_report(self):
+        """Number of compounds of each library (diagonal) and shared by each pair of libraries
+        Returns:
+            pd.DataFrame: Library x library table of compound counts
+        """
+        keys = self.library_keys()
+        names = sorted(keys)
+        counts = np.array([[len(np.intersect1d(keys[a], keys[b], assume_unique=True)) for b in names] for a in names], dtype=np.int64)
+        return pd.DataFrame(counts, index=pd.Index(names, name='library'), columns=names)
+
+    def duplicate_report(self):
+        """Compounds registered under several raw SMILES (the same molecule written differently)
+        Returns:
+            pd.DataFrame: key, canonical SMILES, number of spellings and libraries of each duplicated compound
+        """
+        spellings = self.compounds.groupby('key').agg(SMILES=('SMILES', 'first'), spellings=('raw_key', 'size'))
+        duplicated = spellings[spellings['spellings'] > 1]
+        libraries = self.libraries[self.libraries['key'].isin(duplicated.index)]
+        libraries = libraries.astype({'library': str}).groupby('key')['library'].agg(lambda names: ';'.join(sorted(names)))
+        return duplicated.join(libraries.rename('libraries')).reset_index().sort_values('spellings', ascending=False, kind='stable')
+
+def register_compounds(smiles, library, registry_path):
+    """Register the compounds of a library in the registry folder `registry_path` and return their keys"""
+    registry = CompoundRegistry.load(registry_path)
+    keys = registry.register(smiles, library)
+    registry.save()
+    return keys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-library overlap and duplicate reports of the compound registry")
+    parser.add_argument("--registry_path", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'registry'),
+                        help="folder of the registry (written by the stratify scripts)")
+    parser.add_argument("--save_path", type=str, default=None, help="folder to write overlap.csv and duplicates.csv")
+    args = parser.parse_args()
+
+    registry = CompoundRegistry.load(args.registry_path)
+    if not len(registry.compounds):
+        sys.exit(f"No compound registered in {args.registry_path}, run the stratify scripts first")
+    print(f"{len(registry.compounds)} SMILES registered for {registry.compounds['key'].nunique()} compounds")
+    overlap = registry.overlap_report()
+    duplicates = registry.duplicate_report()
+    print(overlap.to_string())
+    print(f"{len(duplicates)} compounds are written in more than one way")
+    if args.save_path:
+        os.makedirs(args.save_path, exist_ok=True)
+        overlap.to_csv(os.path.join(args.save_path, 'overlap.csv'))
+        duplicates.to_csv(os.path.join(args.save_path, 'duplicates.csv'), index=False)
@@ -0,0 +1,245 @@
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+from matplotlib.patches import Rectangle
+from .sketches import QuantileSketch
+
+# The lib_stat figures are drawn from compact aggregates instead of the rows of the screens: letter-value summaries
+# for the boxen plots, density grids for the distribution plots and per-library counts for the bar plots. The
+# aggregates are computed once with numpy (chunk by chunk for the screens, see `aggregate_chunks`), the figures are
+# described by plain dictionaries holding them, and every figure is rendered on the headless Agg backend by a pool of
+# processes. The figure list is cached, so the report can be drawn again without reading any table.
+
+# Default colours of the boxen and distribution plots (matplotlib's, as seaborn)
+COLORS = plt.rcParams['axes.prop_cycle'].by_key()['color']
+
+class CategoryCounts:
+    """Mergeable counts of the values of a column (e.g. the number of compounds of each library)"""
+    def __init__(self):
+        self.counts = pd.Series(dtype=np.int64)
+
+    def update(self, values):
+        return self._add(pd.Series(values).value_counts())
+
+    def merge(self, other):
+        return self._add(other.counts)
+
+    def _add(self, counts):
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+        return self
+
+    def to_dict(self):
+        """Value -> count, in sorted order of the values"""
+        return {str(value): int(count) for value, count in self.counts.sort_index().items()}
+
+class Histogram:
+    """Mergeable histogram of the values of a column within [low, high], used as the grid of a kernel density estimate"""
+    def __init__(self, low, high, bins=20000):
+        self.low, self.high = low, high
+        self.counts = np.zeros(bins, dtype=np.int64)
+        # Moments and range of the values in [low, high], for the bandwidth and the extent of the density
+        self.n, self.sum, self.sum_squares = 0, 0.0, 0.0
+        self.min, self.max = np.inf, -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[(values >= self.low) & (values <= self.high)]
+        if len(values):
+            bins = len(self.counts)
+            index = np.minimum(((values - self.low) * (bins / (self.high - self.low))).astype(np.int64), bins - 1)
+            self.counts += np.bincount(index, minlength=bins)
+            self.n += len(values)
+            self.sum += values.sum()
+            self.sum_squares += np.square(values).sum()
+            self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.n += other.n
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def density(self, cut=3, points=512):
+        """Gaussian kernel density estimate with Scott's bandwidth (as `sns.kdeplot`), computed on the histogram
+        Args:
+            cut (float): The density extends `cut` bandwidths past the extreme values
+            points (int): Number of points of the returned curve
+        Returns:
+            np.ndarray: Grid of values
+            np.ndarray: Density at each value of the grid
+        """
+        if self.n < 2:
+            return np.zeros(0), np.zeros(0)
+        std = np.sqrt(max(self.sum_squares / self.n - (self.sum / self.n) ** 2, 0) * self.n / (self.n - 1))
+        bin_width = (self.high - self.low) / len(self.counts)
+        bandwidth = max(std * self.n ** (-1 / 5), bin_width)
+        # Pad the histogram so the kernels of the extreme bins are not cut, then smooth it
+        radius = int(np.ceil(4 * bandwidth / bin_width))
+        offsets = np.arange(-radius, radius + 1) * bin_width
+        kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+        smoothed = np.convolve(np.pad(self.counts.astype(np.float64), radius), kernel / kernel.sum(), mode='same')
+        centers = self.low + (np.arange(-radius, len(self.counts) + radius) + 0.5) * bin_width
+        grid = np.linspace(max(self.min - cut * bandwidth, centers[0]), min(self.max + cut * bandwidth, centers[-1]), points)
+        return grid, np.interp(grid, centers, smoothed) / (self.n * bin_width)
+
+def letter_values(sketch):
+    """Letter-value summary of a QuantileSketch (the boxes of a boxen plot), with seaborn's default number of boxes
+    (log2(n) - 3) but no deeper than the accuracy of the sketch allows
+    Returns:
+        dict: n, median, lows and highs (quantiles 1/4 and 3/4, 1/8 and 7/8...), min and max of the values
+    """
+    if sketch.count == 0:
+        return {'n': 0}
+    depth = max(int(np.floor(np.log2(sketch.count))) - 3, 1)
+    if len(sketch.levels) > 1:
+        # Quantiles closer to the tails than the rank error of the sketch are not meaningful
+        depth = min(depth, max(int(np.floor(np.log2(sketch.k / 1.7))) - 1, 1))
+    tails = 0.5 ** np.arange(2, depth + 2)
+    return {'n': sketch.count, 'median': float(sketch.quantile(0.5)[0]), 'lows': sketch.quantile(tails),
+            'highs': sketch.quantile(1 - tails), 'min': float(sketch.min), 'max': float(sketch.max)}
+
+def summarize(values, k=1000):
+    """Letter-value summary of an array (exact if it has fewer values than the sketch holds), infinite values excluded"""
+    values = np.asarray(values, dtype=np.float64)
+    return letter_values(QuantileSketch(k).update(values[np.isfinite(values)]))
+
+def group_boxes(groups, values, k=1000):
+    """Letter-value summary of the values of each group (e.g. each label or each library), in sorted group order
+    (the order of the categories for a categorical column, as seaborn)
+    Args:
+        groups (array-like): Group of each value
+        values (array-like): Values
+        k (int): Accuracy of the sketches of the large groups
+    Returns:
+        dict: Group -> letter-value summary
+    """
+    codes, names = pd.factorize(pd.Series(groups).reset_index(drop=True), sort=True)
+    values = np.asarray(values, dtype=np.float64)
+    return {str(name): summarize(values[codes == i], k) for i, name in enumerate(names)}
+
+def sublibrary_figures(counts, library_counts, experiment_condition, save_dir, prefix='', rotation=None):
+    """Bar plots of the fraction of a compound set in each sublibrary, and of the fraction of each sublibrary in the set
+    (pass filter rate)
+    Args:
+        counts (dict): Sublibrary -> number of compounds of the set
+        library_counts (dict): Sublibrary -> number of compounds of the whole library
+        experiment_condition (str): Name of the set
+        save_dir (str): Folder of the figures ({prefix}sublibrary_fraction.png and {prefix}sublibrary_pass_filter_rate.png)
+    Returns:
+        list: The two figures (see `render_figure`)
+    """
+    total = sum(counts.values())
+    fraction = {library: counts.get(library, 0) / total if total else 0 for library in library_counts}
+    pass_filter_rate = {library: counts.get(library, 0) / count for library, count in library_counts.items()}
+    title = f'experiment_condition = {experiment_condition}'
+    return [{'path': os.path.join(save_dir, f'{prefix}sublibrary_fraction.png'), 'kind': 'bar', 'values': fraction,
+             'xlabel': 'library.name', 'ylabel': 'fraction', 'title': title, 'rotation': rotation},
+            {'path': os.path.join(save_dir, f'{prefix}sublibrary_pass_filter_rate.png'), 'kind': 'bar', 'values': pass_filter_rate,
+             'xlabel': 'library.name', 'ylabel': 'pass_filter_rate', 'title': title, 'rotation': rotation}]
+
+def draw_boxen(ax, boxes, palette=None, xlabel=None, ylabel=None, yscale=None, title=None, rotation=None):
+    """Draw letter-value summaries side by side (see `letter_values`)
+    Args:
+        boxes (dict): Category -> letter-value summary, in drawing order
+        palette (dict, optional): Category -> colour. Defaults to None (matplotlib colour cycle)
+    """
+    if not any(summary['n'] for summary in boxes.values()):
+        # e.g. a condition without orthosteric hits: an empty plot with a placeholder instead of singular limits
+        ax.text(0.5, 0.5, 'no data', ha='center', va='center', transform=ax.transAxes)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_xlabel(xlabel or '')
+        ax.set_ylabel(ylabel or '')
+        if title:
+            ax.set_title(title)
+        return
+    for i, (category, summary) in enumerate(boxes.items()):
+        if summary['n'] == 0:
+            continue
+        color = to_rgb(palette[category] if palette else COLORS[i % len(COLORS)])
+        depth = len(summary['lows'])
+        # The central box is the widest and darkest, the boxes further in the tails are narrower and lighter
+        for level in range(depth - 1, -1, -1):
+            width = 0.8 * (1 - level / (depth + 1))
+            shade = level / (depth + 1)
+            face = tuple(c + (1 - c) * shade for c in color)
+            low, high = summary['lows'][level], summary['highs'][level]
+            ax.add_patch(Rectangle((i - width / 2, low), width, high - low, facecolor=face, edgecolor='white', linewidth=0.5))
+        ax.plot([i - 0.4, i + 0.4], [summary['median']] * 2, color='0.2', linewidth=1.5)
+        ax.plot([i, i], [summary['min'], summary['max']], linestyle='none', marker='d', markersize=4, color='0.3')
+    ax.set_xticks(range(len(boxes)), list(boxes), rotation=rotation)
+    ax.set_xlim(-0.5, len(boxes) - 0.5)
+    ax.autoscale(axis='y')
+    if yscale:
+        ax.set_yscale(yscale)
+    ax.set_xlabel(xlabel or '')
+    ax.set_ylabel(ylabel or '')
+    if title:
+        ax.set_title(title)
+
+def draw_density(ax, curves, xlabel=None, ylabel='Density'):
+    """Draw density curves (see `Histogram.density`)
+    Args:
+        curves (dict): Label -> (grid, density)
+    """
+    for label, (grid, density) in curves.items():
+        ax.plot(grid, density, label=label)
+    ax.set_xlabel(xlabel or '')
+    ax.set_ylabel(ylabel)
+    ax.legend()
+
+def draw_bar(ax, values, xlabel=None, ylabel=None, title=None, rotation=None):
+    """Draw one bar per category
+    Args:
+        values (dict): Category -> height
+    """
+    ax.bar(range(len(values)), list(values.values()), color=COLORS[0])
+    ax.set_xticks(range(len(values)), list(values), rotation=rotation)
+    ax.set_xlabel(xlabel or '')
+    ax.set_ylabel(ylabel or '')
+    if title:
+        ax.set_title(title)
+
+DRAW = {'boxen': draw_boxen, 'density': draw_density, 'bar': draw_bar}
+
+def render_figure(figure):
+    """Render one figure: a dictionary with its `path`, its `kind` (boxen, density or bar), optionally its `figsize`,
+    and the arguments of the draw function of its kind"""
+    figure = dict(figure)
+    path, kind = figure.pop('path'), figure.pop('kind')
+    fig, ax = plt.subplots(figsize=figure.pop('figsize', None))
+    DRAW[kind](ax, **figure)
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+def render_report(figures, num_workers=1):
+    """Render figures (see `render_figure`) in a pool of `num_workers` processes
+    Returns:
+        list: Paths of the rendered figures
+    """
+    for directory in {os.path.dirname(figure['path']) for figure in figures}:
+        os.makedirs(directory or '.', exist_ok=True)
+    if num_workers <= 1:
+        return [render_figure(figure) for figure in figures]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(render_figure, figures))
+
+def save_figures(figures, path):
+    """Cache the figures (with their aggregates) so the report can be rendered again without the tables"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(figures, f)
+
+def load_figures(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,174 @@
+import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# The statistics scripts summarize columns of screens with 10M+ rows by their quantiles. Instead of loading and
+# filtering the whole table, each chunk is summarized by a KLL sketch (Karnin, Lang and Liberty, "Optimal Quantile
+# Approximation in Streams", 2016) and the sketches of all chunks are merged. A sketch keeps O(k) values whatever the
+# number of rows; its rank error is about 1.7/k (0.2% of the rows with the default k=1000). Quantiles are exact as long
+# as the column has fewer values than the sketch can hold, and the minimum and maximum are always exact.
+
+# Quantiles reported by the statistics scripts
+QUANTILES = [0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0]
+
+class QuantileSketch:
+    """Mergeable KLL quantile sketch of a stream of numbers (NaN are ignored, as in `pd.Series.quantile`)"""
+    # Ratio between the capacities of two consecutive levels
+    DECAY = 2 / 3
+
+    def __init__(self, k=1000, seed=None):
+        """
+        Args:
+            k (int): Capacity of the top level, which sets the accuracy (rank error about 1.7/k)
+            seed (int, optional): Seed of the random compactions. Defaults to None
+        """
+        self.k = k
+        # The values of level h stand for 2**h values of the stream each
+        self.levels = [np.zeros(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.rng = np.random.default_rng(seed)
+
+    def __deepcopy__(self, memo):
+        # Copies (e.g. the sketches of the chunks built by the workers) draw their own random compactions, so that
+        # their errors do not add up when they are merged
+        sketch = QuantileSketch(self.k)
+        sketch.levels = [values.copy() for values in self.levels]
+        sketch.count, sketch.min, sketch.max = self.count, self.min, self.max
+        return sketch
+
+    def capacity(self, level):
+        return max(int(np.ceil(self.k * self.DECAY ** (len(self.levels) - level - 1))), 2)
+
+    def update(self, values):
+        """Add an array of values to the sketch"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.count += len(values)
+            self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """Add the values summarized by another sketch (of any k) to this one"""
+        self.levels += [np.zeros(0)] * (len(other.levels) - len(self.levels))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.count += other.count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _compress(self):
+        # A full level is sorted and every other value (starting at random at the first or second one) moves up
+        # with twice the weight. An odd value out stays, so the total weight always equals the count
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                values = np.sort(self.levels[level])
+                kept, values = values[:len(values) % 2], values[len(values) % 2:]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], values[self.rng.integers(2)::2]])
+                self.levels[level] = kept
+            level += 1
+
+    def quantile(self, q):
+        """Quantiles of the values, interpolated linearly between ranks as `pd.Series.quantile`
+        Args:
+            q (float or list): Quantile(s) in [0, 1]
+        Returns:
+            np.ndarray: One value per quantile (NaN if the sketch is empty)
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if self.count == 0:
+            return np.full(len(q), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_values), 2 ** level, dtype=np.int64)
+                                  for level, level_values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, ends = values[order], np.cumsum(weights[order])
+        # Value i covers the ranks [ends[i] - weights[i], ends[i])
+        rank = q * (self.count - 1)
+        low = values[np.searchsorted(ends, np.floor(rank), side='right')]
+        high = values[np.searchsorted(ends, np.ceil(rank), side='right')]
+        result = low + (rank - np.floor(rank)) * (high - low)
+        result[q <= 0] = self.min
+        result[q >= 1] = self.max
+        return result
+
+def _aggregate_values(values, aggregators):
+    """Fresh copy of each aggregator updated with its array of `values` (run by the worker processes)"""
+    return {key: copy.deepcopy(aggregators[key]).update(array) for key, array in values.items()}
+
+def aggregate_chunks(chunks, stages, make, num_workers=1):
+    """Row counts and mergeable summaries of several filter stages of a table, in one pass over its chunks
+    Args:
+        chunks (iterable): pd.DataFrame chunks of the table
+        stages (dict): Stage name -> (select, columns), where select is a function taking a chunk and returning the
+            boolean mask of the rows of the stage (None for all rows) and columns are the columns to summarize
+        make (function): Takes a stage name and a column and returns an empty summary of the column, with
+            `update(values)` and `merge(other)` methods (e.g. a QuantileSketch)
+        num_workers (int): Number of processes summarizing the chunks, whose summaries are then merged
+    Returns:
+        dict: Stage name -> number of rows
+        dict: (stage name, column) -> summary
+    """
+    counts = {stage: 0 for stage in stages}
+    summaries = {(stage, column): make(stage, column) for stage, (_, columns) in stages.items() for column in columns}
+
+    def selected_values(chunk):
+        values = {}
+        for stage, (select, columns) in stages.items():
+            mask = np.ones(len(chunk), dtype=bool) if select is None else np.asarray(select(chunk), dtype=bool)
+            counts[stage] += int(mask.sum())
+            for column in columns:
+                values[(stage, column)] = chunk[column].to_numpy()[mask]
+        return values
+
+    def merge(chunk_summaries):
+        for key, summary in chunk_summaries.items():
+            summaries[key].merge(summary)
+
+    if num_workers <= 1:
+        for chunk in chunks:
+            for key, values in selected_values(chunk).items():
+                summaries[key].update(values)
+        return counts, summaries
+    # The workers get empty copies of the summaries
+    empty = copy.deepcopy(summaries)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # At most two chunks per worker are in flight, so the memory stays bounded
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_aggregate_values, selected_values(chunk), empty))
+            if len(pending) >= 2 * num_workers:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+    return counts, summaries
+
+def sketch_chunks(chunks, stages, k=1000, num_workers=1):
+    """Row counts and quantile sketches of several filter stages of a table, in one pass over its chunks
+    (see `aggregate_chunks`, every column being summarized by a QuantileSketch of accuracy `k`)
+    Returns:
+        dict: Stage name -> number of rows
+        dict: (stage name, column) -> QuantileSketch
+    """
+    return aggregate_chunks(chunks, stages, lambda stage, column: QuantileSketch(k), num_workers)
+
+def quantile_table(sketches, quantiles=QUANTILES):
+    """Quantiles of several sketches
+    Args:
+        sketches (dict): Column name -> QuantileSketch
+        quantiles (list): Quantiles to compute
+    Returns:
+        pd.DataFrame: One column per sketch, indexed by the quantiles (as `pd.DataFrame.quantile`)
+    """
+    return pd.DataFrame({name: sketch.quantile(quantiles) for name, sketch in sketches.items()},
+                        index=pd.Index(quantiles))
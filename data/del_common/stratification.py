@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+# Binder categories of a target screened without (exp) and with (inh) an orthosteric inhibitor:
+#   Orthosteric: the compound binds the target, but not when the inhibitor occupies the orthosteric site
+#   Cryptic: the compound only binds the target together with the inhibitor
+#   Allosteric: the compound binds the target with and without the inhibitor
+LABELS = ['Orthosteric', 'Cryptic', 'Allosteric']
+ORTHOSTERIC, CRYPTIC, ALLOSTERIC = range(len(LABELS))
+
+def compound_keys(compounds):
+    """Dense integer key of each row: rows of the same compound share a key, so compounds are matched across
+    conditions by comparing integers instead of joining on strings. Rows without a compound (missing SMILES, or
+    registry key -1) get a key of their own, so they are never matched with any other row
+    Args:
+        compounds (pd.Series): Registry key (see `CompoundRegistry.register`) or SMILES of each row
+    Returns:
+        np.ndarray: Keys in [0, number of distinct compounds + number of rows without a compound)
+    """
+    compounds = pd.Series(compounds).reset_index(drop=True)
+    missing = (compounds.isna() | (compounds == -1)).to_numpy()
+    # Only the rows with a compound are factorized, so int64 registry keys are never converted to floats (which
+    # would merge keys differing in their low bits)
+    keys = np.empty(len(compounds), dtype=np.int64)
+    keys[~missing] = pd.factorize(compounds[~missing])[0]
+    keys[missing] = keys[~missing].max(initial=-1) + 1 + np.arange(missing.sum())
+    return keys
+
+def stratify(keys, conditions):
+    """Label every row for several targets in one pass
+    A row passing the filter of a condition is a hit of its compound in that condition. For each target, the hits
+    without inhibitor are Orthosteric if the compound is not a hit with the inhibitor and Allosteric otherwise, and
+    the hits with inhibitor are Cryptic if the compound is not a hit without it.
+    Args:
+        keys (np.ndarray): Compound key of each row (see `compound_keys`)
+        conditions (dict): Target (e.g. CK1a) -> (exp_mask, inh_mask), the boolean masks of the rows passing the
+            filter of the target without and with the inhibitor
+    Returns:
+        dict: Target -> pd.Categorical with the label of each row (NaN for the rows without label)
+    """
+    targets = list(conditions)
+    masks = np.column_stack([mask for target in targets for mask in conditions[target]])
+    # hits[k, j]: whether compound k is a hit in condition j
+    hits = np.zeros((keys.max() + 1 if len(keys) else 0, masks.shape[1]), dtype=bool)
+    for j in range(masks.shape[1]):
+        hits[keys[masks[:, j]], j] = True
+    row_hits = hits[keys]
+
+    labels = {}
+    for i, target in enumerate(targets):
+        exp, inh = masks[:, 2 * i], masks[:, 2 * i + 1]
+        exp_compound, inh_compound = row_hits[:, 2 * i], row_hits[:, 2 * i + 1]
+        codes = np.full(len(keys), -1, dtype=np.int8)
+        codes[exp & ~inh_compound] = ORTHOSTERIC
+        codes[inh & ~exp_compound] = CRYPTIC
+        codes[exp & inh_compound] = ALLOSTERIC
+        labels[target] = pd.Categorical.from_codes(codes, categories=LABELS)
+        print(target, ', '.join(f"{label} {count}" for label, count in zip(LABELS, np.bincount(codes[codes >= 0], minlength=len(LABELS)))))
+    return labels
+
+def compound_values(keys, mask, values):
+    """Value of each row's compound taken from the rows selected by `mask`, e.g. the score of a compound under the
+    inhibitor for the rows measured without it (NaN if no selected row has the compound)"""
+    by_key = np.full(keys.max() + 1 if len(keys) else 0, np.nan)
+    by_key[keys[mask]] = np.asarray(values, dtype=np.float64)[mask]
+    return by_key[keys]
+
+def competitive_labels(target, labels, exp_score, inh_score, measure=1.0):
+    """Split the Allosteric rows of a target into competitive (binding is weaker with the inhibitor, exp_score >
+    inh_score * measure) and non competitive ones
+    Args:
+        target (str): Target code (e.g. CK1a)
+        labels (pd.Categorical or pd.Series): Label of each row (see `stratify`)
+        exp_score (array-like): Score of each row without inhibitor
+        inh_score (array-like): Score of each row with inhibitor
+        measure (float): Factor applied to the score with inhibitor
+    Returns:
+        pd.Categorical: {target}_common_competitive_to_inh or {target}_common_non_competitive_to_inh for the
+            Allosteric rows, NaN for the others
+    """
+    categories = [f'{target}_common_competitive_to_inh', f'{target}_common_non_competitive_to_inh']
+    codes = np.where(np.asarray(exp_score) > np.asarray(inh_score) * measure, 0, 1).astype(np.int8)
+    codes[pd.Categorical(labels, categories=LABELS).codes != ALLOSTERIC] = -1
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def labelled_rows(df, labels, order=LABELS, mask=None):
+    """Rows of `df` having one of the labels in `order`, grouped by label in that order, with a customlabel column
+    Args:
+        df (pd.DataFrame): Table the labels were computed on
+        labels (pd.Categorical): Label of each row (see `stratify`)
+        order (list): Labels to keep, in output order
+        mask (np.ndarray, optional): Additional boolean mask of the rows to keep. Defaults to None
+    Returns:
+        pd.DataFrame: The selected rows (one copy of the table, whatever the number of labels)
+    """
+    rank = np.full(len(LABELS) + 1, -1)
+    rank[[LABELS.index(label) for label in order]] = np.arange(len(order))
+    row_rank = rank[np.asarray(labels.codes)]  # code -1 (no label) picks the last entry, which is -1
+    selected = np.flatnonzero((row_rank >= 0) if mask is None else (row_rank >= 0) & mask)
+    selected = selected[np.argsort(row_rank[selected], kind='stable')]
+    rows = df.iloc[selected].copy()
+    rows['customlabel'] = labels[selected]
+    return rows
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Screen tables can be much larger than memory. They are read `chunk_size` rows at a time and the rows of each
+# partition (an experimental condition, a sample...) are appended to their own parquet file as they are read,
+# so the peak memory depends on the chunk size and not on the size of the screen.
+
+# Column holding the position of each row in the screen table, used as integer key of the row
+ROW_COLUMN = '_row'
+
+class PartitionWriter:
+    """Append DataFrame chunks to one parquet file per partition"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.writers = {}
+        self.counts = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.parquet")
+
+    def write(self, name, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if name not in self.writers:
+            self.writers[name] = pq.ParquetWriter(self.path(name), table.schema)
+            self.counts[name] = 0
+        elif table.schema != self.writers[name].schema:
+            # Type inference may differ between chunks (e.g. a column without any value in a chunk)
+            table = pa.Table.from_pandas(df, schema=self.writers[name].schema, preserve_index=False)
+        self.writers[name].write_table(table)
+        self.counts[name] += len(df)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def iter_csv_chunks(path, usecols=None, rename=None, chunk_size=1000000):
+    """Read a csv `chunk_size` rows at a time, renaming the columns of each chunk with `rename`"""
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_size):
+        yield chunk.rename(columns=rename) if rename else chunk
+
+def stream_partitions(path, partitions, directory, usecols=None, rename=None, chunk_size=1000000):
+    """Read a csv chunk by chunk and append the rows of every partition to `{directory}/{name}.parquet`
+    A row can belong to several partitions. The position of each row in the csv is kept in the `_row` column.
+    Args:
+        path (str): csv file to read
+        partitions (dict): Partition name -> function taking a chunk and returning the boolean mask of its rows
+        directory (str): Folder of the partition files
+        usecols (list, optional): Columns to read. Defaults to None (all columns)
+        rename (dict, optional): Columns to rename after reading. Defaults to None
+        chunk_size (int): Number of rows read at a time
+    Returns:
+        dict: Partition name -> number of rows
+    """
+    offset = 0
+    empty = pd.DataFrame(columns=[ROW_COLUMN])
+    with PartitionWriter(directory) as writer:
+        for chunk in iter_csv_chunks(path, usecols, rename, chunk_size):
+            chunk[ROW_COLUMN] = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            empty = chunk.iloc[:0]
+            for name, select in partitions.items():
+                mask = np.asarray(select(chunk), dtype=bool)
+                if mask.any():
+                    writer.write(name, chunk[mask])
+    # Partitions without any row still get an (empty) file, so that they can be read like the others
+    for name in partitions:
+        if name not in writer.counts:
+            empty.to_parquet(writer.path(name), index=False)
+    print(f"Read {offset} rows: " + ', '.join(f"{name} {writer.counts.get(name, 0)}" for name in partitions))
+    return {name: writer.counts.get(name, 0) for name in partitions}
+
+def read_partitions(directory, names, columns=None):
+    """Read partitions written by `stream_partitions` back as one table without duplicated rows
+    Args:
+        directory (str): Folder of the partition files
+        names (list): Partitions to read
+        columns (list, optional): Columns to read (besides `_row`). Defaults to None (all columns)
+    Returns:
+        pd.DataFrame: Rows of all partitions in their csv order, without the `_row` column
+        dict: Partition name -> boolean mask of its rows in the table
+    """
+    read_columns = None if columns is None else list(columns) + [ROW_COLUMN]
+    parts = {name: pd.read_parquet(os.path.join(directory, f"{name}.parquet"), columns=read_columns) for name in names}
+    df = pd.concat(parts.values(), ignore_index=True).drop_duplicates(ROW_COLUMN).sort_values(ROW_COLUMN, kind='stable')
+    rows = df[ROW_COLUMN].to_numpy()
+    masks = {name: np.isin(rows, part[ROW_COLUMN].to_numpy()) for name, part in parts.items()}
+    return df.drop(columns=ROW_COLUMN).reset_index(drop=True), masks
@@ -0,0 +1,133 @@
+import os
+import operator
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Formats of the intermediate tables (preprocessed, stratified) written by the DEL scripts.
+# Parquet and Feather are typed and columnar: they keep the dtypes below and can be read column by column.
+TABLE_FORMATS = {"parquet": ".parquet", "feather": ".feather", "csv": ".csv"}
+
+# Low-cardinality string columns stored as categoricals (also with the _x/_y suffixes added by merges)
+CATEGORICAL_COLUMNS = ['library.name', 'sublibrary', 'customlabel', 'competitive', 'Sample']
+
+FILTER_OPERATORS = {'==': operator.eq, '=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+                    '>': operator.gt, '>=': operator.ge}
+
+def is_count_column(column):
+    """Whether a column holds hit counts (e.g. `A counts`, `CK1a_hit_counts_0`, `HitCounts`)"""
+    return column.endswith('counts') or 'hit_counts' in column or column == 'HitCounts'
+
+def optimize_dtypes(df):
+    """Convert the label columns to categoricals and the hit-count columns to the smallest integer type
+    Count columns with missing values are kept as floats.
+    Args:
+        df (pd.DataFrame): Table to convert (modified in place)
+    Returns:
+        pd.DataFrame: The converted table
+    """
+    for column in df.columns:
+        if (column in CATEGORICAL_COLUMNS or column.rsplit('_', 1)[0] in CATEGORICAL_COLUMNS) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+        elif is_count_column(column) and pd.api.types.is_numeric_dtype(df[column]):
+            values = df[column].to_numpy()
+            if not np.isnan(values.astype(np.float64)).any() and np.array_equal(values, np.round(values)):
+                df[column] = pd.to_numeric(values.astype(np.int64), downcast='integer')
+    return df
+
+def table_path(directory, name, table_format):
+    """Path of the table `name` in `directory` (the extension depends on the format)"""
+    return os.path.join(directory, f"{name}{TABLE_FORMATS[table_format]}")
+
+def find_table(directory, name):
+    """Find the table `name` in `directory`, preferring the columnar formats over csv
+    Returns:
+        str: Path of the table
+        str: Format of the table
+    """
+    for table_format in TABLE_FORMATS:
+        path = table_path(directory, name, table_format)
+        if os.path.exists(path):
+            return path, table_format
+    raise FileNotFoundError(f"No {name} table ({', '.join(TABLE_FORMATS)}) in {directory}")
+
+def write_table(df, directory, name, table_format="parquet"):
+    """Write a table with compact dtypes
+    Args:
+        df (pd.DataFrame): Table to write
+        directory (str): Output folder
+        name (str): Table name (file name without extension)
+        table_format (str): parquet, feather or csv
+    Returns:
+        str: Path of the written file
+    """
+    path = table_path(directory, name, table_format)
+    if table_format == "csv":
+        df.to_csv(path, index=False)
+        return path
+    df = optimize_dtypes(df.reset_index(drop=True))
+    if table_format == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+    return path
+
+def apply_filters(df, filters):
+    """Keep the rows matching all `filters` (same format as the `filters` of `read_table`)"""
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        if op == 'in':
+            mask &= df[column].isin(value).to_numpy()
+        elif op == 'not in':
+            mask &= ~df[column].isin(value).to_numpy()
+        else:
+            mask &= FILTER_OPERATORS[op](df[column], value).to_numpy()
+    return df[mask].reset_index(drop=True)
+
+def read_table(directory, name, columns=None, filters=None):
+    """Read a table written by `write_table` (or a csv of an earlier run)
+    Only the requested columns are read. With Parquet, the filters are pushed down to the reader so row
+    groups that cannot match are skipped; other formats filter after reading.
+    Args:
+        directory (str): Folder of the table
+        name (str): Table name (file name without extension)
+        columns (list, optional): Columns to read. Defaults to None (all columns)
+        filters (list, optional): Conditions (column, op, value) that must all hold, with op one of
+            ==, !=, <, <=, >, >=, in, not in. Defaults to None
+    Returns:
+        pd.DataFrame: The table
+    """
+    path, table_format = find_table(directory, name)
+    if table_format == "parquet":
+        df = pd.read_parquet(path, columns=columns, filters=filters or None)
+    else:
+        read_columns = columns
+        if columns is not None and filters:
+            read_columns = list(columns) + [column for column, _, _ in filters if column not in columns]
+        if table_format == "feather":
+            df = pd.read_feather(path, columns=read_columns)
+        else:
+            df = pd.read_csv(path, usecols=read_columns)
+        if filters:
+            df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[columns]
+    # Categories without rows left after filtering would otherwise show up as empty groups in plots
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.remove_unused_categories()
+    return df
+
+def iter_table_chunks(directory, name, columns=None, chunk_size=1000000):
+    """Read a table written by `write_table` `chunk_size` rows at a time (Parquet row groups are read one batch at
+    a time, the other formats are read whole and split)"""
+    path, table_format = find_table(directory, name)
+    if table_format == "parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif table_format == "csv":
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+    else:
+        df = pd.read_feather(path, columns=columns)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
@@ -0,0 +1,210 @@
+import time
+import pickle
+import numpy as np
+import scipy.sparse as sp
+from contextlib import contextmanager
+from tanimoto import tanimoto_matrix
+
+# Above this number of points, the exact/Barnes-Hut sklearn t-SNE becomes impractical and the
+# `auto` backend switches to the FFT-accelerated openTSNE
+SKLEARN_TSNE_MAX_POINTS = 100000
+
+@contextmanager
+def timer(message):
+    """Print `message` and the time spent in the block"""
+    print(f"{message}...")
+    t_start = time.time()
+    yield
+    print(f"{message} done in {time.time() - t_start:.1f} seconds")
+
+def require(module, package):
+    """Import an optional dependency with an install hint if it is missing"""
+    try:
+        return __import__(module)
+    except ImportError as error:
+        raise ImportError(f"{module} is required for this option, please install it with `pip install {package}`") from error
+
+def reduce_dimensions(feature, n_components, random_state=0):
+    """Project the fingerprints to `n_components` dimensions before the embedding
+    Uses randomized truncated SVD, which works on both dense and sparse (CSR) inputs without densifying them.
+    Args:
+        feature (np.ndarray or scipy.sparse.csr_matrix): Fingerprints of shape (n, nBits)
+        n_components (int): Number of output dimensions
+    Returns:
+        np.ndarray: Reduced features of shape (n, n_components)
+        TruncatedSVD: The fitted projection, to reduce new fingerprints the same way
+    """
+    from sklearn.decomposition import TruncatedSVD
+    with timer(f"Reducing {feature.shape[1]} dimensions to {n_components} with truncated SVD"):
+        svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=random_state)
+        return svd.fit_transform(feature).astype(np.float32), svd
+
+def prepare_for_metric(feature, metric):
+    """Convert features to the input expected by the neighbour search of `metric`
+    The Jaccard distance is computed on dense boolean fingerprints; other metrics accept the features as they are.
+    """
+    if metric == "jaccard":
+        if sp.issparse(feature):
+            feature = feature.toarray()
+        return feature.astype(bool)
+    return feature
+
+def resolve_backend(backend, n_points):
+    """Pick the t-SNE implementation (`auto` uses sklearn for small inputs and openTSNE otherwise)"""
+    if backend != "auto":
+        return backend
+    return "sklearn" if n_points <= SKLEARN_TSNE_MAX_POINTS else "opentsne"
+
+def embed(feature, method="tsne", backend="auto", metric="euclidean", perplexity=30, n_neighbors=15, n_jobs=-1, random_state=0):
+    """Embed fingerprints in 2D
+    Args:
+        feature (np.ndarray or scipy.sparse.csr_matrix): Fingerprints (or reduced features) of shape (n, d)
+        method (str): `tsne` or `umap`
+        backend (str): t-SNE implementation, `sklearn` (exact/Barnes-Hut), `opentsne` (approximate
+            nearest neighbours with FFT-accelerated gradients) or `auto`
+        metric (str): Distance between fingerprints. `jaccard` is the Tanimoto distance on binary fingerprints
+        perplexity (float): Perplexity of t-SNE
+        n_neighbors (int): Number of neighbours of UMAP
+        n_jobs (int): Number of threads (-1 for all CPUs)
+        random_state (int): Random seed (None for a non reproducible but multithreaded UMAP)
+    Returns:
+        np.ndarray: Embedding of shape (n, 2)
+    """
+    n_points = feature.shape[0]
+    if method == "umap":
+        umap = require("umap", "umap-learn")
+        # A fixed random_state makes UMAP reproducible but single-threaded; pass random_state=None to use n_jobs threads
+        if random_state is not None and n_jobs != 1:
+            print(f"UMAP is seeded with random_state={random_state} and runs on one thread (random_state=None uses {n_jobs} jobs)")
+        with timer(f"Running UMAP on {n_points} points ({metric} metric)"):
+            return umap.UMAP(n_components=2, n_neighbors=n_neighbors, metric=metric, low_memory=True,
+                             n_jobs=n_jobs if random_state is None else 1, random_state=random_state,
+                             verbose=True).fit_transform(feature)
+
+    backend = resolve_backend(backend, n_points)
+    if backend == "sklearn":
+        from sklearn.manifold import TSNE
+        feature = prepare_for_metric(feature, metric)
+        if sp.issparse(feature):
+            feature = feature.toarray()
+        with timer(f"Running sklearn t-SNE on {n_points} points ({metric} metric)"):
+            return TSNE(n_components=2, n_jobs=n_jobs, perplexity=perplexity, metric=metric,
+                        random_state=random_state).fit_transform(feature)
+
+    openTSNE = require("openTSNE", "openTSNE pynndescent")
+    # Annoy (the default neighbour search) only handles dense inputs and a few metrics, while
+    # pynndescent handles sparse inputs and the Jaccard distance. PCA initialization needs a dense
+    # input, the spectral one works from the affinities
+    neighbors = "pynndescent" if sp.issparse(feature) or metric == "jaccard" else "auto"
+    initialization = "spectral" if sp.issparse(feature) else "pca"
+    with timer(f"Running openTSNE on {n_points} points ({metric} metric, FFT gradients)"):
+        return np.asarray(openTSNE.TSNE(n_components=2, perplexity=perplexity, metric=metric, neighbors=neighbors,
+                                        negative_gradient_method="fft", initialization=initialization,
+                                        n_jobs=n_jobs, random_state=random_state, verbose=True).fit(feature))
+
+class TanimotoIndex:
+    """Exact nearest neighbour search on the Tanimoto (Jaccard) distance between binary fingerprints
+    Intersections are computed with one sparse matrix product per block of queries (see tanimoto.py), which is orders of
+    magnitude faster than the generic Jaccard distance of scikit-learn. Same `kneighbors` interface as
+    `sklearn.neighbors.NearestNeighbors`.
+    """
+    # Size (in float32 values) of the block of query x reference similarities computed at a time
+    MAX_BLOCK_VALUES = 2**26
+
+    def __init__(self, n_neighbors=10):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, feature):
+        self.reference = sp.csr_matrix(feature, dtype=np.float32)
+        self.reference_counts = np.asarray(self.reference.sum(axis=1), dtype=np.float32).ravel()
+        return self
+
+    def kneighbors(self, feature, n_neighbors=None):
+        """
+        Returns:
+            np.ndarray: Tanimoto distances of shape (n, n_neighbors), closest first
+            np.ndarray: Indices of the neighbours in the reference features
+        """
+        n_neighbors = min(n_neighbors or self.n_neighbors, self.reference.shape[0])
+        feature = sp.csr_matrix(feature, dtype=np.float32)
+        counts = np.asarray(feature.sum(axis=1), dtype=np.float32).ravel()
+        distances = np.empty((feature.shape[0], n_neighbors), dtype=np.float32)
+        neighbors = np.empty((feature.shape[0], n_neighbors), dtype=np.int64)
+        block_size = max(1, self.MAX_BLOCK_VALUES // self.reference.shape[0])
+        for start in range(0, feature.shape[0], block_size):
+            end = min(start + block_size, feature.shape[0])
+            distance = 1.0 - tanimoto_matrix(feature[start:end], self.reference, counts[start:end], self.reference_counts)
+            nearest = np.argpartition(distance, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            nearest_distance = np.take_along_axis(distance, nearest, axis=1)
+            order = np.argsort(nearest_distance, axis=1)
+            neighbors[start:end] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:end] = np.take_along_axis(nearest_distance, order, axis=1)
+        return distances, neighbors
+
+class EmbeddingMap:
+    """A fixed 2D map of reference compounds that new compounds can be projected into
+    The map keeps the reference embedding, a nearest neighbour index over the reference features and the
+    SVD projection (if any) used before the embedding. A new compound is placed at the distance-weighted
+    mean of the coordinates of its `n_neighbors` nearest reference compounds, so the reference points never
+    move and placing a few thousand compounds only costs a neighbour query.
+    """
+    def __init__(self, embedding, index, metric, n_neighbors, svd=None):
+        """
+        Args:
+            embedding (np.ndarray): Reference embedding of shape (n_reference, 2)
+            index (TanimotoIndex or sklearn.neighbors.NearestNeighbors): Neighbour index fitted on the reference features
+            metric (str): Distance of the index
+            n_neighbors (int): Number of reference neighbours used to place a new compound
+            svd (TruncatedSVD, optional): Projection applied to the fingerprints before the index. Defaults to None
+        """
+        self.embedding = np.asarray(embedding, dtype=np.float32)
+        self.index = index
+        self.metric = metric
+        self.n_neighbors = n_neighbors
+        self.svd = svd
+
+    @classmethod
+    def fit(cls, feature, embedding, metric="euclidean", n_neighbors=10, svd=None, n_jobs=-1):
+        """Build the neighbour index of a reference embedding
+        Args:
+            feature (np.ndarray or scipy.sparse.csr_matrix): Reference features the embedding was computed from
+                (after the SVD projection, if any)
+            embedding (np.ndarray): Reference embedding of shape (n_reference, 2)
+        """
+        from sklearn.neighbors import NearestNeighbors
+        with timer(f"Indexing {feature.shape[0]} reference points ({metric} metric)"):
+            if metric == "jaccard":
+                index = TanimotoIndex(n_neighbors).fit(feature)
+            else:
+                index = NearestNeighbors(n_neighbors=n_neighbors, metric=metric, n_jobs=n_jobs).fit(feature)
+        return cls(embedding, index, metric, n_neighbors, svd)
+
+    def project(self, feature, batch_size=10000):
+        """Place new compounds in the map
+        Args:
+            feature (np.ndarray or scipy.sparse.csr_matrix): Fingerprints of shape (n, nBits)
+            batch_size (int): Number of compounds queried at a time
+        Returns:
+            np.ndarray: Coordinates of shape (n, 2)
+        """
+        coordinates = np.empty((feature.shape[0], 2), dtype=np.float32)
+        with timer(f"Projecting {feature.shape[0]} points onto the map"):
+            for start in range(0, feature.shape[0], batch_size):
+                block = feature[start: start + batch_size]
+                if self.svd is not None:
+                    block = self.svd.transform(block)
+                distances, neighbors = self.index.kneighbors(block, self.n_neighbors)
+                # Closer neighbours weigh more; an exact match (distance 0) takes the position of that neighbour
+                weights = 1.0 / np.maximum(distances, 1e-6)
+                weights /= weights.sum(axis=1, keepdims=True)
+                coordinates[start: start + len(neighbors)] = np.einsum("nk,nkd->nd", weights, self.embedding[neighbors])
+        return coordinates
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
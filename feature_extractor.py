@@ -11,69 +11,199 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from io_utils import DENSE, PACKED, rows_per_chunk, create_appendable_dataset, append_to_dataset, iter_smiles_chunks
+from fingerprint_cache import FingerprintCache
+
+# Read-only fingerprint caches opened by each worker process, keyed by cache path
+_worker_caches = {}
+
+def morgan_fingerprint_from_mol(mol, radius, nBits, useChirality, packed=False):
+    """Calculate the Morgan fingerprint of an RDKit molecule as a numpy array (packed with np.packbits if `packed`)"""
+    morgan_fingerprint = AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nBits, useChirality=useChirality)
+    if packed:
+        # 8 bits per byte: nBits / 8 bytes per molecule instead of nBits float64
+        morgan_fingerprint_array = np.zeros((1,), dtype=np.uint8)
+        AllChem.DataStructs.ConvertToNumpyArray(morgan_fingerprint, morgan_fingerprint_array)
+        return np.packbits(morgan_fingerprint_array)
+    morgan_fingerprint_array = np.zeros((1,))
+    AllChem.DataStructs.ConvertToNumpyArray(morgan_fingerprint, morgan_fingerprint_array)
+    return morgan_fingerprint_array
 
 # Define a function to calculate Morgan fingerprints for a given SMILES string
-def calculate_morgan_fingerprint(smiles_string, radius, nBits, useChirality):
+def calculate_morgan_fingerprint(smiles_string, radius, nBits, useChirality, packed=False):
     #print("I am process", os.getpid())
     mol = Chem.MolFromSmiles(smiles_string)
     if mol is not None:
-        morgan_fingerprint = AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nBits, useChirality=useChirality)
-        morgan_fingerprint_array = np.zeros((1,))
-        AllChem.DataStructs.ConvertToNumpyArray(morgan_fingerprint, morgan_fingerprint_array)
-        return morgan_fingerprint_array
+        return morgan_fingerprint_from_mol(mol, radius, nBits, useChirality, packed)
     else:
-        return 0
+        return None
+
+def calculate_morgan_fingerprint_batch(smiles_strings, radius, nBits, useChirality, cache_path=None):
+    """Calculate packed Morgan fingerprints for a batch of SMILES strings in one worker call
+    Args:
+        smiles_strings (list): SMILES strings of the batch
+        radius (int): Radius of the Morgan fingerprint
+        nBits (int): Number of fingerprint bits
+        useChirality (bool): Whether to include chirality
+        cache_path (str, optional): Fingerprint cache to look up before computing. Defaults to None (no cache)
+    Returns:
+        np.ndarray: Boolean mask of the valid SMILES in the batch
+        np.ndarray: Contiguous uint8 array of shape (n_valid, ceil(nBits / 8)) with the packed fingerprints
+        list: Canonical SMILES of the valid molecules (None without cache)
+        np.ndarray: Boolean mask of the valid molecules found in the cache
+    """
+    mols = [Chem.MolFromSmiles(smiles_string) for smiles_string in smiles_strings]
+    valid = np.array([mol is not None for mol in mols], dtype=bool)
+    mols = [mol for mol in mols if mol is not None]
+    block = np.empty((len(mols), (nBits + 7) // 8), dtype=np.uint8)
+
+    canonical_smiles, hit = None, np.zeros(len(mols), dtype=bool)
+    if cache_path is not None:
+        if cache_path not in _worker_caches:
+            _worker_caches[cache_path] = FingerprintCache(cache_path, radius, nBits, useChirality, readonly=True)
+        canonical_smiles = [Chem.MolToSmiles(mol) for mol in mols]
+        hit, cached_block = _worker_caches[cache_path].get_many(canonical_smiles)
+        block[hit] = cached_block
+
+    for i in np.flatnonzero(~hit):
+        block[i] = morgan_fingerprint_from_mol(mols[i], radius, nBits, useChirality, packed=True)
+    return valid, block, canonical_smiles, hit
+
+def resolve_pool_settings(config):
+    """Resolve the number of worker processes and the number of SMILES per task from the config
+    `auto` uses every available core and sizes the batches so that each worker gets about four
+    batches per chunk, which keeps the workers balanced while amortizing the pickling overhead.
+    Returns:
+        int: Number of worker processes
+        int: Number of SMILES sent to a worker per task
+    """
+    num_processes = config.get('num_processes', 'auto')
+    if num_processes == 'auto':
+        num_processes = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    batch_size = config.get('batch_size', 'auto')
+    if batch_size == 'auto':
+        batch_size = min(max(config['chunk_size'] // (num_processes * 4), 64), 4096)
+    return int(num_processes), int(batch_size)
+
+class FeatureFileWriter:
+    """Append fingerprints to a feature file (`SMILES`, `feature` and `invalid_SMILES` datasets)
+    The layout and the fingerprint parameters are recorded as attributes of the file so readers know
+    how to unpack the features (see io_utils).
+    """
+    def __init__(self, path, config, feature_format):
+        """
+        Args:
+            path (str): Path of the .h5 file
+            config (dict): Fingerprint settings (radius, nBits, useChirality) from config.yaml
+            feature_format (str): Layout of the feature dataset (dense or packed)
+        """
+        self.nBits = config['nBits']
+        self.packed = feature_format == PACKED
+        self.n_valid, self.n_invalid = 0, 0
+        self.hdf5_file = h5py.File(path, "w")
+        # Record the layout and the fingerprint parameters so readers know how to unpack the features
+        self.hdf5_file.attrs['feature_format'] = feature_format
+        self.hdf5_file.attrs['nBits'] = config['nBits']
+        self.hdf5_file.attrs['radius'] = config['radius']
+        self.hdf5_file.attrs['useChirality'] = config['useChirality']
+
+        # Create datasets for SMILES and Morgan fingerprints
+        smiles_dtype = h5py.string_dtype()
+        self.smiles_dataset = create_appendable_dataset(self.hdf5_file, "SMILES", (), smiles_dtype, chunk_rows=4096)
+        if self.packed:
+            feature_shape, feature_dtype = ((config['nBits'] + 7) // 8,), np.uint8
+        else:
+            feature_shape, feature_dtype = (config['nBits'],), np.float64
+        self.feature_dataset = create_appendable_dataset(self.hdf5_file, "feature", feature_shape, feature_dtype,
+                                                         chunk_rows=rows_per_chunk(feature_shape[0] * np.dtype(feature_dtype).itemsize))
+        self.invalid_dataset = create_appendable_dataset(self.hdf5_file, "invalid_SMILES", (), smiles_dtype, chunk_rows=4096, compression=None)
+
+    def append(self, smiles_valid, fingerprint_valid, smiles_invalid):
+        """Append a block
+        Args:
+            smiles_valid (np.ndarray): SMILES of the valid molecules
+            fingerprint_valid (np.ndarray): Packed fingerprints of the valid molecules (unpacked here for dense files)
+            smiles_invalid (np.ndarray): SMILES that could not be parsed
+        """
+        if not self.packed:
+            fingerprint_valid = np.unpackbits(fingerprint_valid, axis=1, count=self.nBits).astype(np.float64)
+        append_to_dataset(self.smiles_dataset, np.asarray(smiles_valid, dtype=object))
+        append_to_dataset(self.feature_dataset, fingerprint_valid)
+        append_to_dataset(self.invalid_dataset, np.asarray(smiles_invalid, dtype=object))
+        self.n_valid += len(smiles_valid)
+        self.n_invalid += len(smiles_invalid)
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_fingerprint_cache(cache_path, config):
+    """Open the fingerprint cache for the fingerprint settings in `config` (None if no cache is configured)"""
+    if cache_path is None:
+        return None
+    cache = FingerprintCache(cache_path, config['radius'], config['nBits'], config['useChirality'],
+                             max_entries=config.get('cache_max_entries'))
+    print(f"Using fingerprint cache {cache_path} ({cache.n_entries} entries)")
+    return cache
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_file", type=str, required=True, help="SMILES string")
     parser.add_argument("--save_path", type=str, required=True, help="path to store features")
     parser.add_argument("--experiment", type=str, required=True, help="experiment name")
+    parser.add_argument("--feature_format", type=str, choices=[DENSE, PACKED], default=None,
+                        help="layout of the feature dataset (overrides feature_format in config.yaml)")
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="fingerprint cache file (overrides cache_path in config.yaml)")
     args = parser.parse_args()
 
     with open('./config.yaml', 'r') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
-    print("Loading file...")
-    smiles_df = pd.read_csv(args.input_file, usecols=['SMILES'])
-    smiles_strings = smiles_df['SMILES'].tolist()
+    feature_format = args.feature_format or config.get('feature_format', DENSE)
 
-    calculate_morgan = partial(calculate_morgan_fingerprint, radius=config['radius'], 
-                               nBits=config['nBits'], useChirality=config['useChirality'])
-    # Create a ProcessPoolExecutor to parallelize fingerprint calculation
-    print("Calculate fingerprints...")
-    t_start = time.time()
-    morgan_fingerprints = []
-    # for smile in tqdm(smiles_strings):
-    #     morgan_fingerprints.append(calculate_morgan(smile))
-    chunk_size = config['chunk_size']
-    for i in range(0, len(smiles_strings), config['chunk_size']):
-        print(f"Processing chunk {i} to {i+chunk_size}")
-        with ProcessPoolExecutor(max_workers=config['num_processes']) as executor:
-            tmp = list(tqdm(executor.map(calculate_morgan, smiles_strings[i: i+chunk_size]), total=len(smiles_strings[i: i+chunk_size])))
-            morgan_fingerprints.extend(tmp)
+    # Fingerprints of molecules seen in earlier runs are read from the cache and only the misses are computed
+    cache_path = args.cache_path or config.get('cache_path')
+    cache = open_fingerprint_cache(cache_path, config)
 
-    t_end = time.time()
-    print(f"Time elapsed: {t_end - t_start} seconds")
+    calculate_morgan_batch = partial(calculate_morgan_fingerprint_batch, radius=config['radius'],
+                                     nBits=config['nBits'], useChirality=config['useChirality'], cache_path=cache_path)
+    num_processes, batch_size = resolve_pool_settings(config)
+    print(f"Using {num_processes} processes with {batch_size} SMILES per batch")
 
-    # morgan_fingerprints is a list of numpy arrays containing the fingerprints
-    smile_valid = []
-    fingerprint_valid = []
-    smile_invalid = []
-    for i, smile in enumerate(smiles_strings):
-        if morgan_fingerprints[i] is None:
-            smile_invalid.append(smile)
-        else:
-            smile_valid.append(smile)
-            fingerprint_valid.append(morgan_fingerprints[i])
-    
-    print("Saving features...")
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
-    with h5py.File(os.path.join(args.save_path, f'{args.experiment}.h5'), "w") as hdf5_file:
-        # Create datasets for SMILES and Morgan fingerprints
-        hdf5_file.create_dataset("SMILES", data=np.array(smile_valid, dtype="S"), compression="gzip")
-        hdf5_file.create_dataset("feature", data=fingerprint_valid, compression="gzip")
-        hdf5_file.create_dataset("invalid_SMILES", data=np.array(smile_invalid, dtype="S"))
-            
 
+    # The SMILES column is read `chunk_size` rows at a time and each chunk is appended to the
+    # output file as soon as it is fingerprinted, so peak memory is bounded by one chunk
+    # regardless of the size of the library
+    chunk_size = config['chunk_size']
+    print("Calculate fingerprints...")
+    t_start = time.time()
+    # A single pool lives for the whole run. Workers receive whole batches of SMILES and send back
+    # one packed block per batch, so there is one pickle round-trip per batch instead of per SMILES
+    with ProcessPoolExecutor(max_workers=num_processes) as executor, \
+         FeatureFileWriter(os.path.join(args.save_path, f'{args.experiment}.h5'), config, feature_format) as writer:
+        for i, smiles_strings in enumerate(iter_smiles_chunks(args.input_file, chunk_size)):
+            print(f"Processing chunk {i * chunk_size} to {i * chunk_size + len(smiles_strings)}")
+            batches = [smiles_strings[j: j + batch_size].tolist() for j in range(0, len(smiles_strings), batch_size)]
+            results = list(tqdm(executor.map(calculate_morgan_batch, batches), total=len(batches)))
 
+            # Each result is the valid mask of the batch and the packed fingerprints of its valid SMILES
+            valid = np.concatenate([result[0] for result in results])
+            fingerprint_valid = np.concatenate([result[1] for result in results])
+            if cache is not None:
+                canonical_smiles = np.array([smiles for result in results for smiles in result[2]], dtype=object)
+                cache.update(canonical_smiles, fingerprint_valid, np.concatenate([result[3] for result in results]))
+            writer.append(smiles_strings[valid], fingerprint_valid, smiles_strings[~valid])
+
+    t_end = time.time()
+    print(f"Time elapsed: {t_end - t_start} seconds")
+    print(f"Saved {writer.n_valid} fingerprints ({writer.n_invalid} invalid SMILES)")
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
@@ -0,0 +1,135 @@
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+# SQLite limits the number of host parameters of a statement, so lookups are issued in groups
+MAX_QUERY_PARAMS = 500
+
+class FingerprintCache:
+    """On-disk cache of packed Morgan fingerprints keyed by canonical SMILES and fingerprint parameters
+
+    Each entry is addressed by a hash of the canonical SMILES together with `radius`, `nBits` and
+    `useChirality`, so caches built with different settings never collide. The store is a SQLite
+    file in WAL mode: one writer (the main process) and any number of read-only readers (the
+    fingerprint workers) can use it at the same time. When `max_entries` is set, the least recently
+    used entries are evicted once the cache grows beyond it.
+    """
+    def __init__(self, path, radius, nBits, useChirality, max_entries=None, readonly=False):
+        """
+        Args:
+            path (str): Path of the cache file
+            radius (int): Radius of the Morgan fingerprint
+            nBits (int): Number of fingerprint bits
+            useChirality (bool): Whether chirality is included in the fingerprint
+            max_entries (int, optional): Maximum number of cached fingerprints. Defaults to None (unbounded)
+            readonly (bool): Open the cache read-only (used by the worker processes)
+        """
+        self.path = path
+        self.nBits = nBits
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.params = f"radius={radius};nBits={nBits};useChirality={bool(useChirality)}"
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+        if readonly:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprints "
+                                    "(key BLOB PRIMARY KEY, fingerprint BLOB NOT NULL, last_access REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS last_access_index ON fingerprints (last_access)")
+            self.connection.commit()
+        self.n_entries = self.connection.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+    def key(self, canonical_smiles):
+        """Content address of a canonical SMILES under the fingerprint parameters of this cache"""
+        return hashlib.blake2b(f"{self.params}|{canonical_smiles}".encode(), digest_size=16).digest()
+
+    def get_many(self, canonical_smiles):
+        """Look up the fingerprints of a list of canonical SMILES
+        Args:
+            canonical_smiles (list): Canonical SMILES strings
+        Returns:
+            np.ndarray: Boolean mask of the SMILES found in the cache
+            np.ndarray: uint8 array of shape (n_found, ceil(nBits / 8)) with the packed fingerprints of the hits
+        """
+        keys = [self.key(smiles) for smiles in canonical_smiles]
+        found = {}
+        for i in range(0, len(keys), MAX_QUERY_PARAMS):
+            group = keys[i: i + MAX_QUERY_PARAMS]
+            query = f"SELECT key, fingerprint FROM fingerprints WHERE key IN ({','.join('?' * len(group))})"
+            found.update(self.connection.execute(query, group).fetchall())
+
+        hit = np.array([key in found for key in keys], dtype=bool)
+        block = np.empty((int(hit.sum()), (self.nBits + 7) // 8), dtype=np.uint8)
+        for row, key in enumerate(key for key in keys if key in found):
+            block[row] = np.frombuffer(found[key], dtype=np.uint8)
+        return hit, block
+
+    def _insert(self, canonical_smiles, block, now):
+        cursor = self.connection.executemany("INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)",
+                                             ((self.key(smiles), fingerprint.tobytes(), now)
+                                              for smiles, fingerprint in zip(canonical_smiles, block)))
+        self.n_entries += max(cursor.rowcount, 0)
+
+    def _touch(self, canonical_smiles, now):
+        self.connection.executemany("UPDATE fingerprints SET last_access = ? WHERE key = ?",
+                                    ((now, self.key(smiles)) for smiles in canonical_smiles))
+
+    def put_many(self, canonical_smiles, block):
+        """Store packed fingerprints and evict the least recently used entries beyond `max_entries`"""
+        self._insert(canonical_smiles, block, time.time())
+        self.evict()
+        self.connection.commit()
+
+    def touch_many(self, canonical_smiles):
+        """Mark cached fingerprints as recently used so they are evicted last"""
+        self._touch(canonical_smiles, time.time())
+        self.connection.commit()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache holds at most `max_entries`"""
+        if self.max_entries is None or self.n_entries <= self.max_entries:
+            return
+        n_evict = self.n_entries - self.max_entries
+        # The entries of one put_many share their last_access, so ties are broken by insertion order (rowid)
+        self.connection.execute("DELETE FROM fingerprints WHERE key IN "
+                                "(SELECT key FROM fingerprints ORDER BY last_access, rowid LIMIT ?)", (n_evict,))
+        self.n_entries -= n_evict
+        self.evictions += n_evict
+
+    def update(self, canonical_smiles, block, hit):
+        """Store the fingerprints computed by the workers and refresh the ones they found in the cache
+        Args:
+            canonical_smiles (np.ndarray): Canonical SMILES of the valid molecules
+            block (np.ndarray): Packed fingerprints of the valid molecules
+            hit (np.ndarray): Boolean mask of the molecules that were found in the cache
+        """
+        # The hits are refreshed before the new fingerprints are inserted and the cache is trimmed (in one
+        # transaction), so the fingerprints used by this chunk are not the ones evicted
+        now = time.time()
+        self._touch(canonical_smiles[hit], now)
+        self._insert(canonical_smiles[~hit], block[~hit], now)
+        self.evict()
+        self.connection.commit()
+        self.record(int(hit.sum()), int((~hit).sum()))
+
+    def record(self, n_hits, n_misses):
+        """Add lookups done by the worker processes to the hit/miss statistics"""
+        self.hits += n_hits
+        self.misses += n_misses
+
+    def summary(self):
+        """One-line summary of the cache statistics"""
+        n_lookups = self.hits + self.misses
+        hit_rate = self.hits / n_lookups * 100 if n_lookups else 0.0
+        return (f"Fingerprint cache: {self.hits} hits, {self.misses} misses ({hit_rate:.2f}% hit rate), "
+                f"{self.evictions} evicted, {self.n_entries} entries")
+
+    def close(self):
+        self.connection.close()
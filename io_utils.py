@@ -0,0 +1,344 @@
+import os
+import queue
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import h5py
+
+# Layouts of the `feature` dataset written by feature_extractor.py. The layout is recorded in the
+# `feature_format` attribute of the .h5 file; files written before the attribute existed are dense.
+DENSE = "dense"
+PACKED = "packed"
+
+def rows_per_chunk(row_nbytes, target_nbytes=2**20):
+    """Number of rows in one HDF5 chunk so that a chunk is roughly `target_nbytes` (1 MB by default)"""
+    return max(1, target_nbytes // row_nbytes)
+
+def create_appendable_dataset(hdf5_file, name, row_shape, dtype, chunk_rows, compression="gzip"):
+    """Create an empty dataset that can grow along the first axis
+    Args:
+        hdf5_file (h5py.File): File to create the dataset in
+        name (str): Name of the dataset
+        row_shape (tuple): Shape of a single row (e.g. (nBits,) for features, () for SMILES)
+        dtype: Data type of the dataset
+        chunk_rows (int): Number of rows per HDF5 chunk
+        compression (str): HDF5 compression filter
+    Returns:
+        h5py.Dataset: The resizable dataset
+    """
+    return hdf5_file.create_dataset(name, shape=(0,) + tuple(row_shape), maxshape=(None,) + tuple(row_shape),
+                                    dtype=dtype, chunks=(chunk_rows,) + tuple(row_shape), compression=compression)
+
+def append_to_dataset(dataset, data):
+    """Append rows to a dataset created by `create_appendable_dataset`"""
+    if len(data) == 0:
+        return
+    n_rows = dataset.shape[0]
+    dataset.resize(n_rows + len(data), axis=0)
+    dataset[n_rows:] = data
+
+def get_feature_format(hf):
+    """Get the layout of the `feature` dataset (dense or packed)
+    Args:
+        hf (h5py.File): Feature file written by feature_extractor.py
+    Returns:
+        str: `dense` (one float per bit) or `packed` (np.packbits uint8, 8 bits per byte)
+    """
+    return hf.attrs.get("feature_format", DENSE)
+
+def get_num_features(hf):
+    """Get the number of fingerprint bits of each molecule, regardless of the layout"""
+    if get_feature_format(hf) == PACKED:
+        return int(hf.attrs["nBits"])
+    return hf["feature"].shape[1]
+
+def unpack_features(block, nBits, dtype=np.float32):
+    """Unpack a block of np.packbits fingerprints to one value per bit
+    Args:
+        block (np.ndarray): uint8 array of shape (n, ceil(nBits / 8))
+        nBits (int): Number of fingerprint bits
+        dtype: Data type of the unpacked block
+    Returns:
+        np.ndarray: Array of shape (n, nBits)
+    """
+    return np.unpackbits(block, axis=1, count=nBits).astype(dtype, copy=False)
+
+def read_feature_block(hf, start, end, dtype=np.float32):
+    """Read rows [start, end) of the `feature` dataset and unpack them if the file is packed"""
+    block = hf["feature"][start:end]
+    if get_feature_format(hf) == PACKED:
+        return unpack_features(block, int(hf.attrs["nBits"]), dtype)
+    return block
+
+def read_packed_block(hf, start, end):
+    """Read rows [start, end) of the `feature` dataset as np.packbits fingerprints, packing dense files on the fly
+    Returns:
+        np.ndarray: uint8 array of shape (end - start, ceil(nBits / 8))
+    """
+    block = hf["feature"][start:end]
+    if get_feature_format(hf) == PACKED:
+        return block
+    return np.packbits(block > 0, axis=1)
+
+def iter_feature_blocks(hf, block_size, dtype=np.float32):
+    """Iterate over the `feature` dataset in blocks of `block_size` rows
+    Yields:
+        (int, int, np.ndarray): Start row, end row and the (unpacked) feature block
+    """
+    n_rows = hf["feature"].shape[0]
+    for start in range(0, n_rows, block_size):
+        end = min(start + block_size, n_rows)
+        yield start, end, read_feature_block(hf, start, end, dtype)
+
+def read_features_into(hf, out, block_size=65536):
+    """Read the whole `feature` dataset as one value per bit into the preallocated array `out`
+    Dense files are read straight into `out` (converting to its dtype on the fly) and packed files are
+    unpacked block by block, so no intermediate full-size copy is made. `out` may be a row slice of a
+    larger buffer.
+    Args:
+        hf (h5py.File): Feature file written by feature_extractor.py
+        out (np.ndarray): C-contiguous array of shape (n_rows, nBits)
+    """
+    if len(out) == 0:
+        return out
+    if get_feature_format(hf) != PACKED:
+        hf["feature"].read_direct(out)
+        return out
+    for start, end, block in iter_feature_blocks(hf, block_size, out.dtype):
+        out[start:end] = block
+    return out
+
+def load_features(hf, block_size=65536, dtype=np.float32):
+    """Load the whole `feature` dataset as one value per bit
+    The features are read into a preallocated array (see `read_features_into`), so the only full-size
+    array in memory is the result itself.
+    """
+    feature = np.empty((hf["feature"].shape[0], get_num_features(hf)), dtype=dtype)
+    return read_features_into(hf, feature, block_size)
+
+def load_sparse_features(hf, block_size=65536, dtype=np.float32):
+    """Load the whole `feature` dataset as a scipy.sparse CSR matrix
+    Morgan fingerprints set only a few dozen of their bits, so the sparse matrix is typically two orders
+    of magnitude smaller than the dense one. Blocks are converted one at a time and never held densely
+    all at once.
+    """
+    import scipy.sparse as sp
+    blocks = [sp.csr_matrix(block) for _, _, block in iter_feature_blocks(hf, block_size, dtype)]
+    if not blocks:
+        return sp.csr_matrix((0, get_num_features(hf)), dtype=dtype)
+    return sp.vstack(blocks, format="csr")
+
+def load_feature_files(paths, sparse=False, block_size=65536, dtype=np.float32):
+    """Load the features of several files as one matrix, in the order of `paths`
+    Dense features are read directly into their rows of one preallocated buffer; sparse features are
+    converted file by file and stacked.
+    Args:
+        paths (list): Feature files written by feature_extractor.py (dense or packed)
+        sparse (bool): Return a scipy.sparse CSR matrix instead of a dense array
+    Returns:
+        np.ndarray or scipy.sparse.csr_matrix: Features of shape (total rows, nBits)
+        list: Number of rows of each file
+    """
+    files = [h5py.File(path, 'r') for path in paths]
+    try:
+        lengths = [hf["feature"].shape[0] for hf in files]
+        n_features = {get_num_features(hf) for hf in files}
+        if len(n_features) > 1:
+            raise ValueError(f"The feature files have different numbers of bits: {sorted(n_features)}")
+        if sparse:
+            import scipy.sparse as sp
+            return sp.vstack([load_sparse_features(hf, block_size, dtype) for hf in files], format="csr"), lengths
+        feature = np.empty((sum(lengths), n_features.pop()), dtype=dtype)
+        start = 0
+        for hf, length in zip(files, lengths):
+            read_features_into(hf, feature[start: start + length], block_size)
+            start += length
+        return feature, lengths
+    finally:
+        for hf in files:
+            hf.close()
+
+def prefetch(iterable, depth=2):
+    """Iterate over `iterable` in a background thread, keeping up to `depth` items ready ahead of the consumer
+    Used to overlap reading (and decompressing) the next block of an HDF5 file with processing the current one.
+    Exceptions raised while producing an item are re-raised in the consumer.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                buffer.put((item, None))
+        except BaseException as error:
+            buffer.put((None, error))
+        buffer.put((done, None))
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+def parse_input_files(input_files):
+    """Split `name=path` arguments into names and paths (a bare path is named after its file name)"""
+    names, paths = [], []
+    for input_file in input_files:
+        name, sep, path = input_file.partition("=")
+        if not sep:
+            name, path = os.path.splitext(os.path.basename(input_file))[0], input_file
+        if name in names:
+            raise ValueError(f"Dataset name {name} is used more than once, please name the files with name=path")
+        names.append(name)
+        paths.append(path)
+    return names, paths
+
+def write_embedding_store(path, embedding, names, lengths):
+    """Write an embedding of several datasets with an index of where each dataset starts
+    The store holds the (n, 2) `embedding` dataset, the dataset `names` and an `offsets` table with
+    len(names) + 1 entries: the points of names[i] are rows offsets[i] to offsets[i + 1].
+    Args:
+        path (str): Path of the .h5 store
+        embedding (np.ndarray): Embedding of all datasets, concatenated in the order of `names`
+        names (list): Name of each dataset
+        lengths (list): Number of points of each dataset
+    """
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if offsets[-1] != len(embedding):
+        raise ValueError(f"The datasets have {offsets[-1]} points in total but the embedding has {len(embedding)}")
+    with h5py.File(path, 'w') as hf:
+        hf.create_dataset("embedding", data=np.asarray(embedding, dtype=np.float32))
+        hf.create_dataset("names", data=list(names), dtype=h5py.string_dtype())
+        hf.create_dataset("offsets", data=offsets)
+
+def read_embedding_index(hf):
+    """Read the index of an embedding store written by `write_embedding_store`
+    Returns:
+        dict: Dataset name -> (start row, end row) in the `embedding` dataset, in the stored order
+    """
+    offsets = hf["offsets"][:]
+    return {name: (int(offsets[i]), int(offsets[i + 1])) for i, name in enumerate(hf["names"].asstr()[:])}
+
+def load_embedding(hf, name=None):
+    """Load the points of one dataset (or of all datasets if `name` is None) from an embedding store
+    Only the rows of the requested dataset are read from disk.
+    Args:
+        hf (h5py.File): Embedding store written by `write_embedding_store`
+        name (str, optional): Dataset name. Defaults to None
+    Returns:
+        np.ndarray: Array of shape (n, 2)
+    """
+    if name is None:
+        return hf["embedding"][:]
+    index = read_embedding_index(hf)
+    if name not in index:
+        raise KeyError(f"{name} is not in the embedding store, available datasets: {list(index)}")
+    start, end = index[name]
+    return hf["embedding"][start:end]
+
+def iter_smiles_chunks(input_file, chunk_size):
+    """Read the `SMILES` column of a csv, Parquet or Feather file `chunk_size` rows at a time
+    Only the SMILES column is read, so the stratified tables of the DEL subprojects can be used as input directly.
+    Yields:
+        np.ndarray: Object array of SMILES strings
+    """
+    extension = os.path.splitext(input_file)[1]
+    if extension == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunk_size, columns=['SMILES']):
+            yield batch.column(0).to_numpy(zero_copy_only=False).astype(object)
+    elif extension == ".feather":
+        smiles_strings = pd.read_feather(input_file, columns=['SMILES'])['SMILES'].to_numpy(dtype=object)
+        for start in range(0, len(smiles_strings), chunk_size):
+            yield smiles_strings[start: start + chunk_size]
+    else:
+        for smiles_df in pd.read_csv(input_file, usecols=['SMILES'], chunksize=chunk_size):
+            yield smiles_df['SMILES'].to_numpy(dtype=object)
+
+def checkpoint_name(checkpoint):
+    """Name of the output column of a checkpoint, e.g. data/HitGen/models/CK1a/MLP.keras -> HitGen_CK1a_MLP"""
+    parts = [part for part in Path(checkpoint).with_suffix('').parts[-4:] if part not in ('models', '.', '..')]
+    return "_".join(parts)
+
+def read_smiles(hf, start=None, end=None):
+    """Read rows [start, end) of the `SMILES` dataset as decoded strings (the dataset stores bytes)"""
+    return hf["SMILES"].asstr()[start:end]
+
+class PredictionWriter(ABC):
+    """Base class of the prediction writers. Subclasses open `self.file` and implement `write`"""
+    @abstractmethod
+    def write(self, smiles, scores):
+        """Write one block
+        Args:
+            smiles (np.ndarray): Decoded SMILES strings of the block
+            scores (np.ndarray): Array of shape (n, len(columns)) with the scores of the block
+        """
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class CSVPredictionWriter(PredictionWriter):
+    """Append prediction blocks to a csv file with one `smiles` column and one column per score"""
+    def __init__(self, path, columns):
+        self.file = open(path, 'w')
+        self.columns = list(columns)
+        self.file.write(",".join(["smiles"] + self.columns) + "\n")
+
+    def write(self, smiles, scores):
+        block = pd.DataFrame(scores, columns=self.columns)
+        block.insert(0, "smiles", smiles)
+        block.to_csv(self.file, header=False, index=False)
+
+class ParquetPredictionWriter(PredictionWriter):
+    """Append prediction blocks to a Parquet file (one row group per block)"""
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.columns = list(columns)
+        self.schema = pa.schema([("smiles", pa.string())] + [(column, pa.float32()) for column in self.columns])
+        self.file = pq.ParquetWriter(path, self.schema)
+
+    def write(self, smiles, scores):
+        arrays = [self.pa.array(smiles, type=self.pa.string())]
+        arrays += [self.pa.array(scores[:, i], type=self.pa.float32()) for i in range(len(self.columns))]
+        self.file.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+class HDF5PredictionWriter(PredictionWriter):
+    """Append prediction blocks to an HDF5 file with a `SMILES` dataset and an (n, n_columns) `prediction` dataset
+    The column names are stored in the `columns` attribute of the `prediction` dataset.
+    """
+    def __init__(self, path, columns):
+        self.file = h5py.File(path, 'w')
+        self.columns = list(columns)
+        self.smiles = create_appendable_dataset(self.file, "SMILES", (), h5py.string_dtype(), chunk_rows=4096)
+        self.prediction = create_appendable_dataset(self.file, "prediction", (len(self.columns),), np.float32,
+                                                    chunk_rows=rows_per_chunk(len(self.columns) * 4))
+        self.prediction.attrs["columns"] = self.columns
+
+    def write(self, smiles, scores):
+        append_to_dataset(self.smiles, np.asarray(smiles, dtype=object))
+        append_to_dataset(self.prediction, np.asarray(scores, dtype=np.float32))
+
+PREDICTION_WRITERS = {"csv": CSVPredictionWriter, "parquet": ParquetPredictionWriter, "h5": HDF5PredictionWriter}
+
+def open_prediction_writer(save_path, experiment, output_format, columns):
+    """Open a writer for `{save_path}/{experiment}.{output_format}`
+    Args:
+        save_path (str): Folder to store the results
+        experiment (str): Experiment name (file name without extension)
+        output_format (str): One of csv, parquet or h5
+        columns (list): Names of the score columns
+    """
+    return PREDICTION_WRITERS[output_format](os.path.join(save_path, f"{experiment}.{output_format}"), columns)
@@ -0,0 +1,157 @@
+import os
+import numpy as np
+import argparse
+import yaml
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+from feature_extractor import calculate_morgan_fingerprint_batch, resolve_pool_settings, FeatureFileWriter, open_fingerprint_cache
+from io_utils import unpack_features, open_prediction_writer, iter_smiles_chunks, PREDICTION_WRITERS, DENSE, PACKED
+
+def fingerprint_into_shared_memory(smiles_strings, slot_name, radius, nBits, useChirality, cache_path=None):
+    """Fingerprint a batch of SMILES in a worker and write the packed block into a shared memory slot
+    Only the small valid mask (and the cache bookkeeping) travels back through the pipe; the block itself
+    is read by the consumer straight from shared memory.
+    Returns:
+        np.ndarray: Boolean mask of the valid SMILES in the batch
+        int: Number of fingerprints written to the slot
+        list: Canonical SMILES of the valid molecules (None without cache)
+        np.ndarray: Boolean mask of the valid molecules found in the cache
+    """
+    valid, block, canonical_smiles, hit = calculate_morgan_fingerprint_batch(smiles_strings, radius, nBits, useChirality, cache_path)
+    slot = SharedMemory(name=slot_name)
+    slot_block = np.ndarray(block.shape, dtype=np.uint8, buffer=slot.buf)
+    slot_block[:] = block
+    del slot_block
+    slot.close()
+    return valid, len(block), canonical_smiles, hit
+
+def iter_smiles_batches(input_file, chunk_size, batch_size):
+    """Read the SMILES column `chunk_size` rows at a time and split it into batches of `batch_size`"""
+    for smiles_strings in iter_smiles_chunks(input_file, chunk_size):
+        for i in range(0, len(smiles_strings), batch_size):
+            yield smiles_strings[i: i + batch_size]
+
+if __name__ == "__main__":
+    # TensorFlow is only imported by the main process: the fingerprinting workers are spawned (see below) and import
+    # this module without running this block
+    from prediction import load_models, call_models, add_ensemble_columns, ENSEMBLES
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, required=True, help="csv (or Parquet/Feather) file with a SMILES column")
+    parser.add_argument("--save_path", type=str, required=True, help="path to store results")
+    parser.add_argument("--checkpoint", type=str, nargs='*', default=[],
+                        help="MLP chekcpoint(s). Each checkpoint gets its own output column")
+    parser.add_argument("--chemprop_checkpoint", type=str, nargs='*', default=[],
+                        help="chemprop (GNN) checkpoint(s) scored in the same pass")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of CPU threads used by chemprop")
+    parser.add_argument("--experiment", type=str, required=True, help="experiment name")
+    parser.add_argument("--use_gpu", action='store_true', default=False, help="use gpu")
+    parser.add_argument("--output_format", type=str, choices=list(PREDICTION_WRITERS), default="csv",
+                        help="format of the prediction file")
+    parser.add_argument("--ensemble", type=str, nargs='*', choices=list(ENSEMBLES), default=[],
+                        help="add ensemble columns over all checkpoints")
+    parser.add_argument("--save_features", action='store_true', default=False,
+                        help="also write the fingerprints to {experiment}_feature.h5")
+    parser.add_argument("--feature_format", type=str, choices=[DENSE, PACKED], default=None,
+                        help="layout of the saved features (overrides feature_format in config.yaml)")
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="fingerprint cache file (overrides cache_path in config.yaml)")
+    args = parser.parse_args()
+    if not args.checkpoint and not args.chemprop_checkpoint:
+        parser.error("at least one of --checkpoint and --chemprop_checkpoint is required")
+    if not args.use_gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        print("Not using GPU\n")
+
+    with open('./config.yaml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    nBits = config['nBits']
+    row_nbytes = (nBits + 7) // 8
+    num_processes, batch_size = resolve_pool_settings(config)
+    print(f"Using {num_processes} processes with {batch_size} SMILES per batch")
+
+    cache_path = args.cache_path or config.get('cache_path')
+    cache = open_fingerprint_cache(cache_path, config)
+    fingerprint_batch = partial(fingerprint_into_shared_memory, radius=config['radius'], nBits=nBits,
+                                useChirality=config['useChirality'], cache_path=cache_path)
+
+    models = load_models(args.checkpoint) if args.checkpoint else {}
+    chemprop_scorer = None
+    if args.chemprop_checkpoint:
+        from chemprop_prediction import ChempropScorer
+        chemprop_scorer = ChempropScorer(args.chemprop_checkpoint, args.num_threads)
+    columns = list(models) + (chemprop_scorer.columns if chemprop_scorer else []) + [f"ensemble_{e}" for e in args.ensemble]
+    if not os.path.exists(args.save_path):
+        os.makedirs(args.save_path)
+    feature_writer = None
+    if args.save_features:
+        feature_writer = FeatureFileWriter(os.path.join(args.save_path, f'{args.experiment}_feature.h5'), config,
+                                           args.feature_format or config.get('feature_format', DENSE))
+
+    # The workers fingerprint batches into a ring of shared memory slots while the main process
+    # scores the oldest finished batch, so both stages are busy at the same time. Batches are
+    # consumed in submission order, which keeps the output in the order of the input file.
+    n_slots = 2 * num_processes
+    slots = [SharedMemory(create=True, size=batch_size * row_nbytes) for _ in range(n_slots)]
+    free_slots = deque(range(n_slots))
+    pending = deque()
+    n_smiles, n_valid = 0, 0
+
+    def consume(slot, smiles_strings, future):
+        """Score the batch of a finished worker task, write the results, release its slot and return the number of valid SMILES"""
+        valid, n_fingerprints, canonical_smiles, hit = future.result()
+        block = np.ndarray((n_fingerprints, row_nbytes), dtype=np.uint8, buffer=slots[slot].buf)
+        try:
+            if cache is not None:
+                cache.update(np.array(canonical_smiles, dtype=object), block, hit)
+            if feature_writer is not None:
+                feature_writer.append(smiles_strings[valid], block, smiles_strings[~valid])
+            if n_fingerprints:
+                # MLP scores come from the fingerprints, GNN scores from the molecular graphs of the same batch
+                scores = []
+                if models:
+                    scores.append(call_models(models, unpack_features(block, nBits)))
+                if chemprop_scorer is not None:
+                    scores.append(chemprop_scorer.score(smiles_strings[valid])[1])
+                writer.write(smiles_strings[valid], add_ensemble_columns(np.concatenate(scores, axis=1), args.ensemble))
+        finally:
+            # The slot can only be closed once no view of its buffer is left, even if scoring failed
+            del block
+        free_slots.append(slot)
+        return n_fingerprints
+
+    print("Fingerprinting and predicting...")
+    t_start = time.time()
+    try:
+        # Spawned rather than forked workers: the main process already holds the TensorFlow/torch models and their
+        # threads, which are not safe to fork
+        with ProcessPoolExecutor(max_workers=num_processes, mp_context=get_context('spawn')) as executor, \
+             open_prediction_writer(args.save_path, args.experiment, args.output_format, columns) as writer:
+            for smiles_strings in iter_smiles_batches(args.input_file, config['chunk_size'], batch_size):
+                if not free_slots:
+                    n_valid += consume(*pending.popleft())
+                slot = free_slots.popleft()
+                pending.append((slot, smiles_strings, executor.submit(fingerprint_batch, smiles_strings.tolist(), slots[slot].name)))
+                n_smiles += len(smiles_strings)
+            while pending:
+                n_valid += consume(*pending.popleft())
+    finally:
+        for slot in slots:
+            try:
+                slot.close()
+            except BufferError:
+                # A view of the slot is still held by the traceback of the error being raised: leave the mapping to the
+                # garbage collector rather than hiding that error
+                pass
+            slot.unlink()
+        if feature_writer is not None:
+            feature_writer.close()
+
+    print(f"Time elapsed: {time.time() - t_start} seconds")
+    print(f"Predicted {n_valid} molecules ({n_smiles - n_valid} invalid SMILES)")
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
@@ -1,35 +1,102 @@
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 import tensorflow as tf
+import numpy as np
 import h5py
+import time
 import argparse
+from io_utils import iter_feature_blocks, prefetch, read_smiles, open_prediction_writer, checkpoint_name, PREDICTION_WRITERS
+
+ENSEMBLES = {"mean": np.mean, "max": np.max}
+
+def load_models(checkpoints):
+    """Load each checkpoint once
+    Args:
+        checkpoints (list): Paths of the Keras checkpoints
+    Returns:
+        dict: Output column name -> model. A single checkpoint keeps the `prediction` column name
+    """
+    if len(checkpoints) == 1:
+        return {"prediction": tf.keras.models.load_model(checkpoints[0])}
+    models = {}
+    for checkpoint in checkpoints:
+        name = checkpoint_name(checkpoint)
+        if name in models:
+            name = f"{name}_{len(models)}"
+        print(f"Loading {checkpoint} as {name}")
+        models[name] = tf.keras.models.load_model(checkpoint)
+    return models
+
+def add_ensemble_columns(scores, ensemble):
+    """Append the ensemble columns (mean and/or max over the models) to an (n, n_models) score array"""
+    if not ensemble:
+        return scores
+    return np.concatenate([scores] + [ENSEMBLES[e](scores, axis=1, keepdims=True) for e in ensemble], axis=1)
+
+def predict_block(models, feature, batch_size, ensemble=()):
+    """Feed one feature block to every model
+    Args:
+        models (dict): Output column name -> model (see `load_models`)
+        feature (np.ndarray): Features of the block
+        batch_size (int): Batch size of the models
+        ensemble (list): Ensemble columns to append (mean and/or max over the models)
+    Returns:
+        np.ndarray: Array of shape (n, len(models) + len(ensemble)) with one column per model and ensemble
+    """
+    scores = np.concatenate([model.predict(feature, batch_size=batch_size, verbose=0) for model in models.values()], axis=1)
+    return add_ensemble_columns(scores, ensemble)
+
+def call_models(models, feature, ensemble=()):
+    """Same as `predict_block`, but calls the models directly instead of through `model.predict`
+    This avoids building a tf.data pipeline per call, which dominates the latency of small blocks.
+    """
+    scores = np.concatenate([np.asarray(model(feature, training=False)) for model in models.values()], axis=1)
+    return add_ensemble_columns(scores, ensemble)
+
+def read_blocks(hf, block_size):
+    """Read the feature file in blocks of `block_size` molecules
+    Yields:
+        (np.ndarray, np.ndarray): Decoded SMILES and (unpacked) features of the block
+    """
+    for start, end, feature in iter_feature_blocks(hf, block_size):
+        yield read_smiles(hf, start, end), feature
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_file", type=str, required=True, help="feature file")
     parser.add_argument("--save_path", type=str, required=True, help="path to store results")
-    parser.add_argument("--checkpoint", type=str, required=True, help="model chekcpoint")
+    parser.add_argument("--checkpoint", type=str, nargs='+', required=True,
+                        help="model chekcpoint(s). Each checkpoint gets its own output column")
     parser.add_argument("--experiment", type=str, required=True, help="experiment name")
     parser.add_argument("--use_gpu", action='store_true', default=False, help="use gpu")
+    parser.add_argument("--block_size", type=int, default=100000, help="number of molecules read and predicted at a time")
+    parser.add_argument("--batch_size", type=int, default=1024, help="batch size of the model")
+    parser.add_argument("--output_format", type=str, choices=list(PREDICTION_WRITERS), default="csv",
+                        help="format of the prediction file")
+    parser.add_argument("--ensemble", type=str, nargs='*', choices=list(ENSEMBLES), default=[],
+                        help="add ensemble columns over all checkpoints")
     args = parser.parse_args()
     if not args.use_gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
         print("Not using GPU\n")
 
-    print("Loading data...")
-    with h5py.File(args.input_file, 'r') as hf:
-        smiles = hf["SMILES"][:]
-        feature = hf["feature"][:]
-    print("Predicting...")
-    model = tf.keras.models.load_model(args.checkpoint)
-    prediction = model.predict(feature)
+    # Every model is loaded once and every feature block is read once and fed to all of them
+    models = load_models(args.checkpoint)
+    columns = list(models) + [f"ensemble_{e}" for e in args.ensemble]
 
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
-    with open(os.path.join(args.save_path, f"{args.experiment}.csv"), 'w') as fw:
-        fw.write("smiles,prediction\n")
-        for i in range(len(smiles)):
-            fw.write(f"{smiles[i]},{prediction[i][0]}\n")
-
-
 
+    # The features are read block by block, so memory is bounded by `block_size` instead of the
+    # size of the feature file. The next block is read in a background thread while the model
+    # predicts the current one and the results are appended to the output file as they come.
+    print("Predicting...")
+    t_start = time.time()
+    n_predicted = 0
+    with h5py.File(args.input_file, 'r') as hf, \
+         open_prediction_writer(args.save_path, args.experiment, args.output_format, columns) as writer:
+        for smiles, feature in prefetch(read_blocks(hf, args.block_size)):
+            writer.write(smiles, predict_block(models, feature, args.batch_size, args.ensemble))
+            n_predicted += len(smiles)
+            print(f"Predicted {n_predicted} molecules")
+    print(f"Time elapsed: {time.time() - t_start} seconds")
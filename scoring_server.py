@@ -0,0 +1,184 @@
+import numpy as np
+import argparse
+import yaml
+import json
+import time
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from prediction import load_models, call_models, ENSEMBLES
+from feature_extractor import calculate_morgan_fingerprint
+from io_utils import unpack_features
+
+class ScoringRequest:
+    """SMILES of one client request and the slot where the batching thread puts its scores"""
+    def __init__(self, smiles):
+        self.smiles = smiles
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+class DynamicBatcher:
+    """Group concurrent requests into one batch before scoring them
+    The batching thread takes the first pending request, then keeps collecting requests until the batch
+    holds `max_batch_size` molecules or `max_wait` seconds have passed, and scores them with one call.
+    """
+    def __init__(self, score_fn, max_batch_size, max_wait):
+        """
+        Args:
+            score_fn (callable): Function mapping a list of SMILES to an (n, n_columns) score array
+            max_batch_size (int): Maximum number of molecules per batch
+            max_wait (float): Maximum time (seconds) to wait for more requests after the first one
+        """
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, smiles):
+        """Score a list of SMILES (blocks until its batch is done)"""
+        # Copied in the caller's thread, so a value that is not a sequence never reaches the batching thread
+        request = ScoringRequest(list(smiles))
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def collect(self):
+        """Wait for a request and collect the requests arriving within `max_wait`"""
+        batch = [self.requests.get()]
+        n_molecules = len(batch[0].smiles)
+        deadline = time.monotonic() + self.max_wait
+        while n_molecules < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_molecules += len(request.smiles)
+        return batch
+
+    def score_batch(self, batch):
+        """Score the SMILES of several requests with one call and split the scores between them"""
+        scores = self.score_fn([smiles for request in batch for smiles in request.smiles])
+        start = 0
+        for request in batch:
+            request.scores = scores[start: start + len(request.smiles)]
+            start += len(request.smiles)
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.score_batch(batch)
+            except Exception:
+                # Score the requests of the batch one by one, so an error only fails the request that caused it
+                for request in batch:
+                    try:
+                        self.score_batch([request])
+                    except Exception as error:
+                        request.error = error
+            for request in batch:
+                request.done.set()
+
+def score_smiles(smiles, models, config, ensemble=()):
+    """Fingerprint a list of SMILES in-process and score them with every model
+    Args:
+        smiles (list): SMILES strings
+        models (dict): Output column name -> model (see `prediction.load_models`)
+        config (dict): Fingerprint settings (radius, nBits, useChirality) from config.yaml
+        ensemble (list): Ensemble columns to append (mean and/or max over the models)
+    Returns:
+        np.ndarray: Array of shape (n, len(models) + len(ensemble)), NaN for invalid SMILES
+    """
+    fingerprints = [calculate_morgan_fingerprint(s, config['radius'], config['nBits'], config['useChirality'], packed=True)
+                    for s in smiles]
+    valid = np.array([fingerprint is not None for fingerprint in fingerprints], dtype=bool)
+    scores = np.full((len(smiles), len(models) + len(ensemble)), np.nan, dtype=np.float32)
+    if valid.any():
+        feature = unpack_features(np.stack([fingerprint for fingerprint in fingerprints if fingerprint is not None]), config['nBits'])
+        scores[valid] = call_models(models, feature, ensemble)
+    return scores
+
+def make_handler(batcher, columns):
+    """Create the HTTP request handler
+    POST /predict with {"smiles": [...]} returns {"smiles": [...], "scores": {column: [...]}, "elapsed_ms": ...}
+    (scores of invalid SMILES are null). GET /health returns the score columns.
+    """
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            self.send_json(200, {"status": "ok", "columns": columns})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            t_start = time.perf_counter()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                smiles = request["smiles"]
+                if isinstance(smiles, str):
+                    smiles = [smiles]
+                if not isinstance(smiles, list) or not all(isinstance(s, str) for s in smiles):
+                    raise TypeError("smiles must be a string or a list of strings")
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {"error": f"expected a JSON body like {{\"smiles\": [...]}} ({error})"})
+                return
+            try:
+                scores = batcher.submit(smiles)
+            except Exception as error:
+                self.send_json(500, {"error": str(error)})
+                return
+            self.send_json(200, {
+                "smiles": smiles,
+                "scores": {column: [None if np.isnan(x) else float(x) for x in scores[:, i]] for i, column in enumerate(columns)},
+                "elapsed_ms": (time.perf_counter() - t_start) * 1000,
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, nargs='+', required=True, help="model chekcpoint(s) to keep loaded")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--max_batch_size", type=int, default=4096, help="maximum number of molecules scored together")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0, help="time to wait for concurrent requests to batch together")
+    parser.add_argument("--ensemble", type=str, nargs='*', choices=list(ENSEMBLES), default=[],
+                        help="add ensemble columns over all checkpoints")
+    args = parser.parse_args()
+
+    with open('./config.yaml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    # Models are loaded once for the lifetime of the server
+    models = load_models(args.checkpoint)
+    columns = list(models) + [f"ensemble_{e}" for e in args.ensemble]
+    batcher = DynamicBatcher(lambda smiles: score_smiles(smiles, models, config, args.ensemble),
+                             args.max_batch_size, args.max_wait_ms / 1000)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, columns))
+    print(f"Serving {columns} on http://{args.host}:{args.port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
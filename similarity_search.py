@@ -0,0 +1,291 @@
+import os
+import time
+import argparse
+import yaml
+import h5py
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from io_utils import get_num_features, read_packed_block, read_smiles, parse_input_files, iter_smiles_chunks
+from feature_extractor import calculate_morgan_fingerprint
+from tanimoto import unpack_words, tanimoto_matrix
+
+def to_words(packed):
+    """View np.packbits fingerprints as rows of uint64 words (zero-padded to a multiple of 8 bytes)"""
+    n_bytes = packed.shape[1]
+    padded_bytes = -(-n_bytes // 8) * 8
+    if padded_bytes != n_bytes:
+        packed = np.pad(packed, ((0, 0), (0, padded_bytes - n_bytes)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+# Number of bits set in each byte value, for numpy < 2.0 (which has no np.bitwise_count)
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def bit_counts(words):
+    """Number of bits set in each fingerprint"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int32)
+    return POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+class TanimotoSearchIndex:
+    """Persistent index for Tanimoto similarity search over binary fingerprints
+    Fingerprints are stored as uint64 words sorted by their number of set bits. The Tanimoto similarity
+    of fingerprints with a and b bits is at most min(a, b) / max(a, b). Blocks of queries are compared with
+    blocks of fingerprints as one matrix product (see tanimoto.py), and a block of fingerprints is skipped for
+    the queries whose bound on it is below the similarity threshold or, for top-k queries, below their k-th
+    best similarity found so far (blocks closest in bit count are visited first).
+    """
+    # Number of queries and of reference fingerprints whose similarities are computed at a time
+    QUERY_BLOCK = 1024
+    REFERENCE_BLOCK = 4096
+
+    def __init__(self, words, counts, rows, names, offsets, nBits, path=None):
+        """
+        Args:
+            words (np.ndarray): uint64 fingerprints of shape (n, n_words), sorted by bit count
+            counts (np.ndarray): Bit count of each fingerprint (sorted)
+            rows (np.ndarray): Row of each fingerprint in the concatenated input files
+            names (list): Name of each input file
+            offsets (np.ndarray): First row of each input file, followed by the total number of rows
+            nBits (int): Number of fingerprint bits
+            path (str, optional): Index file, used to look up the SMILES of the hits. Defaults to None
+        """
+        self.words = words
+        self.counts = counts
+        self.rows = rows
+        self.names = list(names)
+        self.offsets = np.asarray(offsets)
+        self.nBits = nBits
+        self.path = path
+        # Fingerprints with b bits are words[bin_start[b]:bin_start[b + 1]]
+        self.bin_start = np.searchsorted(counts, np.arange(nBits + 2))
+
+    @classmethod
+    def build(cls, paths, names=None, block_size=65536):
+        """Index the fingerprints of several feature files (dense or packed)"""
+        names = names or [os.path.splitext(os.path.basename(path))[0] for path in paths]
+        blocks, lengths, nBits = [], [], None
+        for path in paths:
+            with h5py.File(path, 'r') as hf:
+                if nBits is None:
+                    nBits = get_num_features(hf)
+                elif get_num_features(hf) != nBits:
+                    raise ValueError(f"{path} has {get_num_features(hf)} bits per fingerprint instead of {nBits}")
+                n_rows = hf["feature"].shape[0]
+                blocks += [read_packed_block(hf, start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+                lengths.append(n_rows)
+        words = to_words(np.concatenate(blocks)) if blocks else np.zeros((0, -(-nBits // 64)), dtype=np.uint64)
+        counts = bit_counts(words)
+        order = np.argsort(counts, kind='stable')
+        return cls(words[order], counts[order], order.astype(np.int64), names, np.concatenate([[0], np.cumsum(lengths)]), nBits)
+
+    def save(self, path, paths):
+        """Write the index, together with the SMILES of the input files (in their original order)"""
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('fingerprint', data=self.words.view(np.uint8), compression='gzip')
+            f.create_dataset('count', data=self.counts)
+            f.create_dataset('row', data=self.rows)
+            f.create_dataset('names', data=np.array(self.names, dtype=h5py.string_dtype()))
+            f.create_dataset('offsets', data=self.offsets)
+            f.attrs['nBits'] = self.nBits
+            smiles = f.create_dataset('SMILES', shape=(int(self.offsets[-1]),), dtype=h5py.string_dtype())
+            for start, source in zip(self.offsets[:-1], paths):
+                with h5py.File(source, 'r') as hf:
+                    if 'SMILES' in hf:
+                        smiles[start:start + hf['SMILES'].shape[0]] = read_smiles(hf)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        with h5py.File(path, 'r') as f:
+            words = f['fingerprint'][:].view(np.uint64)
+            return cls(words, f['count'][:], f['row'][:], f['names'].asstr()[:], f['offsets'][:], int(f.attrs['nBits']), path)
+
+    def _block_bounds(self, query_counts, start, end):
+        """Highest similarity each query can reach with the fingerprints [start, end), whose bit counts lie in
+        [counts[start], counts[end - 1]]: min(a, b) / max(a, b) for the closest bit count b of that range"""
+        low, high = int(self.counts[start]), int(self.counts[end - 1])
+        return np.where(query_counts < low, query_counts / max(low, 1),
+                        np.where(query_counts > high, high / np.maximum(query_counts, 1), 1.0))
+
+    def _search_block(self, queries, query_counts, top_k, threshold):
+        """Search a block of queries, one matrix product per block of reference fingerprints
+        Returns:
+            list: (positions, similarities) of each query (see `search`)
+        """
+        n = len(queries)
+        searched = query_counts > 0
+        hit_queries, hit_positions, hit_similarities = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+        if searched.any():
+            # Bit counts b that can reach the threshold with one of the queries: threshold * a <= b <= a / threshold
+            low = max(int(np.ceil(threshold * query_counts[searched].min() - 1e-9)), 0)
+            high = min(int(np.floor(query_counts.max() / threshold + 1e-9)), self.nBits) if threshold > 0 else self.nBits
+            start, end = self.bin_start[low], self.bin_start[high + 1]
+            blocks = [(block_start, min(block_start + self.REFERENCE_BLOCK, end)) for block_start in range(start, end, self.REFERENCE_BLOCK)]
+            if top_k is not None:
+                # Blocks closest in bit count first, so that the k-th best similarities rise early and prune the others
+                median = np.median(query_counts[searched])
+                blocks.sort(key=lambda block: -self._block_bounds(np.array([median]), *block)[0])
+                best_positions = np.full((n, top_k), -1, dtype=np.int64)
+                best_similarities = np.full((n, top_k), -np.inf, dtype=np.float32)
+            unpacked = unpack_words(queries)
+            for block_start, block_end in blocks:
+                # The bound prunes the whole block at once for the queries that cannot reach the threshold (or improve
+                # on their k-th best similarity) with any fingerprint of the block
+                bounds = self._block_bounds(query_counts, block_start, block_end)
+                needed = searched & (bounds >= threshold - 1e-6)
+                if top_k is not None:
+                    needed &= bounds >= best_similarities[:, -1] - 1e-6
+                rows = np.flatnonzero(needed)
+                if len(rows) == 0:
+                    continue
+                similarities = tanimoto_matrix(unpacked if len(rows) == n else unpacked[rows],
+                                               unpack_words(self.words[block_start:block_end]),
+                                               query_counts[rows], self.counts[block_start:block_end])
+                if top_k is None:
+                    query, column = np.nonzero(similarities >= threshold)
+                    hit_queries.append(rows[query])
+                    hit_positions.append(block_start + column)
+                    hit_similarities.append(similarities[query, column])
+                    continue
+                similarities[similarities < threshold] = -np.inf
+                candidates = np.concatenate([best_similarities[rows], similarities], axis=1)
+                positions = np.concatenate([best_positions[rows], np.broadcast_to(
+                    np.arange(block_start, block_end), similarities.shape)], axis=1)
+                best = np.argpartition(-candidates, top_k - 1, axis=1)[:, :top_k]
+                best_similarities[rows] = np.take_along_axis(candidates, best, axis=1)
+                best_positions[rows] = np.take_along_axis(positions, best, axis=1)
+                # Keep the k-th best similarity of each query in the last column
+                order = np.argsort(-best_similarities[rows], axis=1, kind='stable')
+                best_similarities[rows] = np.take_along_axis(best_similarities[rows], order, axis=1)
+                best_positions[rows] = np.take_along_axis(best_positions[rows], order, axis=1)
+            if top_k is not None:
+                found = best_similarities > -np.inf
+                hit_queries.append(np.nonzero(found)[0])
+                hit_positions.append(best_positions[found])
+                hit_similarities.append(best_similarities[found])
+
+        # Hits of each query, most similar first (ties in index order)
+        hit_queries, hit_positions, hit_similarities = (np.concatenate(hits) for hits in (hit_queries, hit_positions, hit_similarities))
+        order = np.lexsort((hit_positions, -hit_similarities, hit_queries))
+        hit_positions, hit_similarities = hit_positions[order], hit_similarities[order]
+        splits = np.searchsorted(hit_queries[order], np.arange(1, n))
+        return list(zip(np.split(hit_positions, splits), np.split(hit_similarities, splits)))
+
+    def search(self, queries, top_k=None, threshold=0.0, num_threads=8):
+        """Find the fingerprints similar to each query
+        Queries are sorted by bit count and searched a block at a time, so that the queries of a block share most of
+        the reference fingerprints they need to be compared with. Blocks are searched by several threads (numpy
+        releases the GIL in the matrix products).
+        Args:
+            queries (np.ndarray): uint64 query fingerprints of shape (n, n_words) (see `to_words`)
+            top_k (int, optional): Number of most similar fingerprints to return. Defaults to None (all above threshold)
+            threshold (float): Minimum Tanimoto similarity
+            num_threads (int): Number of blocks of queries searched in parallel
+        Returns:
+            list: (positions, similarities) of each query: positions of the hits in the index, most similar first,
+                and their Tanimoto similarities
+        """
+        queries = np.asarray(queries)
+        query_counts = bit_counts(queries) if len(queries) else np.zeros(0, dtype=np.int32)
+        order = np.argsort(query_counts, kind='stable')
+        blocks = [order[start:start + self.QUERY_BLOCK] for start in range(0, len(order), self.QUERY_BLOCK)]
+        search_block = lambda rows: self._search_block(queries[rows], query_counts[rows], top_k, threshold)
+        results = [None] * len(queries)
+        if num_threads <= 1:
+            block_results = map(search_block, blocks)
+        else:
+            executor = ThreadPoolExecutor(max_workers=num_threads)
+            block_results = executor.map(search_block, blocks)
+        for rows, block_result in zip(blocks, block_results):
+            for row, result in zip(rows, block_result):
+                results[row] = result
+        if num_threads > 1:
+            executor.shutdown()
+        return results
+
+    def search_one(self, query, top_k=None, threshold=0.0):
+        """Find the fingerprints similar to one query (uint64 words, see `search`)"""
+        return self.search(query[None], top_k, threshold, num_threads=1)[0]
+
+    def sources(self, rows):
+        """Name of the input file of each row"""
+        return np.array(self.names, dtype=object)[np.searchsorted(self.offsets, rows, side='right') - 1]
+
+    def smiles(self, rows):
+        """SMILES of the given rows, read from the index file"""
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        with h5py.File(self.path, 'r') as f:
+            return f['SMILES'].asstr()[unique_rows][inverse] if len(unique_rows) else np.zeros(0, dtype=object)
+
+def load_queries(query_file, config, nBits):
+    """Query fingerprints from a feature file or from a SMILES csv/parquet file
+    Returns:
+        np.ndarray: SMILES of the valid queries
+        np.ndarray: uint64 fingerprints of the valid queries
+    """
+    if query_file.endswith(".h5"):
+        with h5py.File(query_file, 'r') as hf:
+            if get_num_features(hf) != nBits:
+                raise ValueError(f"{query_file} has {get_num_features(hf)} bits per fingerprint but the index has {nBits}")
+            smiles = read_smiles(hf) if 'SMILES' in hf else np.array([str(i) for i in range(hf['feature'].shape[0])], dtype=object)
+            return np.asarray(smiles, dtype=object), to_words(read_packed_block(hf, 0, hf['feature'].shape[0]))
+    if config['nBits'] != nBits:
+        raise ValueError(f"config.yaml has nBits={config['nBits']} but the index has {nBits} bits per fingerprint")
+    smiles, fingerprints = [], []
+    for chunk in iter_smiles_chunks(query_file, config['chunk_size']):
+        for smiles_string in chunk:
+            fingerprint = calculate_morgan_fingerprint(smiles_string, config['radius'], config['nBits'], config['useChirality'], packed=True)
+            if fingerprint is None:
+                print(f"Skipping invalid SMILES {smiles_string}")
+                continue
+            smiles.append(smiles_string)
+            fingerprints.append(fingerprint)
+    return np.array(smiles, dtype=object), to_words(np.stack(fingerprints) if fingerprints else np.zeros((0, -(-nBits // 8)), dtype=np.uint8))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index the fingerprints of feature files")
+    build_parser.add_argument("--input_file", type=str, nargs='+', required=True,
+                              help="feature file(s) written by feature_extractor.py, optionally named as name=path")
+    build_parser.add_argument("--index_file", type=str, required=True, help="index file to write (.h5)")
+    query_parser = subparsers.add_parser("query", help="find the indexed compounds most similar to query compounds")
+    query_parser.add_argument("--index_file", type=str, required=True, help="index file written by the build command")
+    query_parser.add_argument("--query_file", type=str, required=True,
+                              help="feature file (.h5) or SMILES file (.csv/.parquet with a SMILES column) of the queries")
+    query_parser.add_argument("--save_path", type=str, required=True, help="folder to store the hits")
+    query_parser.add_argument("--experiment", type=str, required=True, help="experiment name")
+    query_parser.add_argument("--top_k", type=int, default=10, help="number of hits per query (0: all hits above the threshold)")
+    query_parser.add_argument("--threshold", type=float, default=0.0, help="minimum Tanimoto similarity of a hit")
+    query_parser.add_argument("--num_threads", type=int, default=8, help="number of threads scanning the index")
+    args = parser.parse_args()
+
+    t_start = time.time()
+    if args.command == "build":
+        names, paths = parse_input_files(args.input_file)
+        index = TanimotoSearchIndex.build(paths, names)
+        index.save(args.index_file, paths)
+        print(f"Indexed {len(index.rows)} fingerprints in {time.time() - t_start:.1f} seconds")
+    else:
+        with open("./config.yaml", "r") as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        index = TanimotoSearchIndex.load(args.index_file)
+        query_smiles, queries = load_queries(args.query_file, config, index.nBits)
+        t_search = time.time()
+        results = index.search(queries, args.top_k or None, args.threshold, args.num_threads)
+        print(f"Searched {len(queries)} queries against {len(index.rows)} fingerprints in {time.time() - t_search:.1f} seconds")
+
+        n_hits = np.array([len(positions) for positions, _ in results], dtype=np.int64)
+        positions = np.concatenate([positions for positions, _ in results]) if results else np.zeros(0, dtype=np.int64)
+        rows = index.rows[positions]
+        hits = pd.DataFrame({'query_index': np.repeat(np.arange(len(queries)), n_hits),
+                             'query_SMILES': np.repeat(query_smiles, n_hits),
+                             'rank': np.concatenate([np.arange(n) for n in n_hits]) if len(n_hits) else np.zeros(0, dtype=np.int64),
+                             'hit_source': index.sources(rows),
+                             'hit_index': rows - index.offsets[np.searchsorted(index.offsets, rows, side='right') - 1],
+                             'hit_SMILES': index.smiles(rows),
+                             'similarity': np.concatenate([similarities for _, similarities in results]) if results else np.zeros(0)})
+        os.makedirs(args.save_path, exist_ok=True)
+        hits.to_csv(os.path.join(args.save_path, f"{args.experiment}.csv"), index=False)
+        print(f"Found {len(hits)} hits in {time.time() - t_start:.1f} seconds")
@@ -0,0 +1,32 @@
+import numpy as np
+
+# Tanimoto similarities of whole blocks of fingerprints, computed as one matrix product of their bits: the
+# product gives the intersection counts of all pairs at once (exact in float32, as integer sums of at most
+# nBits ones). Shared by the similarity search, the clustering and the embedding neighbour index.
+
+def unpack_words(words):
+    """Unpack uint64 fingerprint words (see similarity_search.to_words) to float32 bits"""
+    return np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1).astype(np.float32)
+
+def tanimoto_matrix(a, b, a_counts, b_counts):
+    """Tanimoto similarities between two sets of binary fingerprints
+    Args:
+        a (np.ndarray or scipy.sparse.csr_matrix): 0/1 float32 fingerprints of shape (n, nBits)
+        b (np.ndarray or scipy.sparse.csr_matrix): 0/1 float32 fingerprints of shape (m, nBits)
+        a_counts (np.ndarray): Bit count of each fingerprint of `a`
+        b_counts (np.ndarray): Bit count of each fingerprint of `b`
+    Returns:
+        np.ndarray: float32 array of shape (n, m)
+    """
+    intersection = a @ b.T
+    if hasattr(intersection, 'toarray'):
+        intersection = intersection.toarray()
+    union = np.asarray(a_counts, dtype=np.float32)[:, None] + np.asarray(b_counts, dtype=np.float32)[None, :] - intersection
+    return intersection / np.maximum(union, 1)
+
+def tanimoto_block(a_words, a_counts, b_words, b_counts):
+    """Tanimoto similarities between two sets of fingerprints stored as uint64 words
+    Returns:
+        np.ndarray: float32 array of shape (len(a_words), len(b_words))
+    """
+    return tanimoto_matrix(unpack_words(a_words), unpack_words(b_words), a_counts, b_counts)
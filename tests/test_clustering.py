@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from similarity_search import TanimotoSearchIndex, to_words, bit_counts
+from clustering import FingerprintClustering
+
+def make_index(dense):
+    words = to_words(np.packbits(dense, axis=1))
+    counts = bit_counts(words)
+    order = np.argsort(counts, kind='stable')
+    return TanimotoSearchIndex(words[order], counts[order], order.astype(np.int64), ['refs'],
+                               np.array([0, len(dense)]), dense.shape[1])
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_butina_matches_rdkit(seed):
+    Butina = pytest.importorskip("rdkit.ML.Cluster.Butina")
+    rng = np.random.default_rng(seed)
+    # Few bits, so that many compounds have as many neighbours and the tie-breaking matters
+    dense = rng.random((300, 64)) < rng.uniform(0.1, 0.4, size=(300, 1))
+    index = make_index(dense)
+    with FingerprintClustering(index, threshold=0.5) as clustering:
+        cluster, _, centroids = clustering.cluster("butina")
+
+    bits = dense.astype(np.float64)
+    intersection = bits @ bits.T
+    similarity = intersection / np.maximum(bits.sum(axis=1)[:, None] + bits.sum(axis=1)[None, :] - intersection, 1)
+    distances = [1 - similarity[i, j] for i in range(len(dense)) for j in range(i)]
+    expected = Butina.ClusterData(distances, len(dense), 0.5 + 1e-9, isDistData=True)
+    assert [index.rows[centroid] for centroid in centroids] == [members[0] for members in expected]
+    assert [sorted(index.rows[cluster == i]) for i in range(len(centroids))] == [sorted(members) for members in expected]
@@ -0,0 +1,29 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+from del_common.manifest import cached_digests, file_digest
+
+def test_only_changed_files_are_hashed(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"lib{i}.csv"
+        path.write_text(f"smiles,{i}\n")
+        paths.append(str(path))
+    hashed = []
+    def recording_map(function, changed):
+        hashed.extend(changed)
+        return map(function, changed)
+
+    cache = {}
+    digests = cached_digests(paths, cache, recording_map)
+    assert hashed == paths
+    assert digests == {path: file_digest(path) for path in paths}
+
+    hashed.clear()
+    assert cached_digests(paths, cache, recording_map) == digests
+    assert hashed == []
+
+    (tmp_path / "lib1.csv").write_text("smiles,changed\n")
+    hashed.clear()
+    assert cached_digests(paths, cache, recording_map)[paths[1]] == file_digest(paths[1])
+    assert hashed == [paths[1]]
@@ -0,0 +1,59 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from similarity_search import TanimotoSearchIndex, to_words, bit_counts
+
+def make_index(packed, nBits):
+    words = to_words(packed)
+    counts = bit_counts(words)
+    order = np.argsort(counts, kind='stable')
+    return TanimotoSearchIndex(words[order], counts[order], order.astype(np.int64), ['refs'],
+                               np.array([0, len(packed)]), nBits)
+
+def fingerprint(bits, nBits=64):
+    dense = np.zeros(nBits, dtype=np.uint8)
+    dense[bits] = 1
+    return np.packbits(dense)
+
+def brute_force(query, packed):
+    query_bits = np.unpackbits(query).astype(bool)
+    ref_bits = np.unpackbits(packed, axis=1).astype(bool)
+    intersection = (ref_bits & query_bits).sum(axis=1)
+    union = (ref_bits | query_bits).sum(axis=1)
+    return intersection / np.maximum(union, 1)
+
+def test_top_k_scans_the_bit_counts_left_by_the_previous_round():
+    # ref 1 has a lower similarity bound than ref 0 but a higher similarity
+    packed = np.stack([fingerprint(list(range(9)) + [20]), fingerprint(list(range(10)) + [30, 31])])
+    index = make_index(packed, 64)
+    positions, similarities = index.search_one(to_words(fingerprint(list(range(10)))[None])[0], top_k=1)
+    assert index.rows[positions].tolist() == [1]
+    assert similarities[0] == pytest.approx(10 / 12)
+
+@pytest.mark.parametrize("top_k,threshold", [(1, 0.0), (5, 0.0), (20, 0.3), (None, 0.4)])
+@pytest.mark.parametrize("query_block,reference_block", [(1024, 4096), (4, 64)])
+def test_search_matches_brute_force(top_k, threshold, query_block, reference_block):
+    rng = np.random.default_rng(0)
+    nBits = 256
+    # Fingerprints of varied densities, so that small blocks of fingerprints are pruned for some queries
+    dense = rng.random((2000, nBits)) < rng.uniform(0.02, 0.3, size=(2000, 1))
+    packed = np.packbits(dense, axis=1)
+    queries = packed[rng.choice(len(packed), 20, replace=False)] ^ np.packbits(rng.random((20, nBits)) < 0.05, axis=1)
+    index = make_index(packed, nBits)
+    index.QUERY_BLOCK, index.REFERENCE_BLOCK = query_block, reference_block
+    for query, (positions, similarities) in zip(queries, index.search(to_words(queries), top_k, threshold, num_threads=2)):
+        expected = brute_force(query, packed)
+        expected = np.sort(expected[expected >= threshold])[::-1]
+        if top_k is not None:
+            expected = expected[:top_k]
+        np.testing.assert_allclose(similarities, expected, rtol=1e-6)
+        np.testing.assert_allclose(similarities, brute_force(query, packed)[index.rows[positions]], rtol=1e-6)
+
+def test_queries_without_bits_have_no_hits():
+    packed = np.stack([fingerprint([1, 2]), fingerprint([3])])
+    index = make_index(packed, 64)
+    results = index.search(to_words(np.stack([fingerprint([]), fingerprint([1, 2])])), top_k=2)
+    assert len(results[0][0]) == 0
+    assert results[1][1].tolist() == [1.0, 0.0]
@@ -0,0 +1,18 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+from del_common.stratification import compound_keys
+
+def test_large_registry_keys_stay_distinct():
+    # 64-bit keys differing only in their low bits cannot be told apart as float64
+    keys = compound_keys(pd.Series([2**62 + 1, 2**62 + 2, -1, 2**62 + 1], dtype=np.int64))
+    assert keys[0] == keys[3]
+    assert len({keys[0], keys[1], keys[2]}) == 3
+
+def test_rows_without_compound_get_their_own_key():
+    keys = compound_keys(pd.Series(['CCO', None, 'CCO', np.nan, 'c1ccccc1']))
+    assert keys[0] == keys[2]
+    assert len(set(keys[[0, 1, 3, 4]])) == 4
+    assert keys.min() == 0 and keys.max() == 3
@@ -1,4 +1,3 @@
-from sklearn.manifold import TSNE
 import numpy as np
 import time
 import h5py
@@ -6,29 +5,68 @@ import glob
 import os
 import pickle
 import argparse
+from io_utils import load_feature_files, write_embedding_store, parse_input_files
+from embedding import embed, reduce_dimensions, timer, EmbeddingMap
 np.random.seed(0)
 
+def parse_seed(value):
+    """Random seed of the embedding, `none` for an unseeded run (UMAP is only multithreaded when unseeded)"""
+    return None if value.lower() == "none" else int(value)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input_file", type=str, required=True, help="folder to store features to be reduced")
+    parser.add_argument("--input_file", type=str, nargs='+', required=True,
+                        help="feature file(s) to embed together, optionally named as name=path")
     parser.add_argument("--save_path", type=str, required=True, help="folder to store features to be reduced")
     parser.add_argument("--experiment", type=str, required=True, help="experiment name")
     parser.add_argument("--perplexity", type=int, default=30, help="perplexity of TSNE")
     parser.add_argument("--n_jobs", type=int, default=-1, help="number of CPU to run TSNE")
+    parser.add_argument("--method", type=str, choices=["tsne", "umap"], default="tsne", help="embedding method")
+    parser.add_argument("--backend", type=str, choices=["auto", "sklearn", "opentsne"], default="auto",
+                        help="t-SNE implementation (auto: sklearn up to 100k points, FFT-accelerated openTSNE above)")
+    parser.add_argument("--metric", type=str, default="euclidean", help="distance between fingerprints (e.g. jaccard for Tanimoto)")
+    parser.add_argument("--n_neighbors", type=int, default=15, help="number of neighbours of UMAP")
+    parser.add_argument("--seed", type=parse_seed, default=0,
+                        help="random seed of the embedding, or none for an unseeded run (a seeded UMAP runs on one thread)")
+    parser.add_argument("--sparse", action='store_true', default=False,
+                        help="keep the fingerprints as a sparse matrix instead of a dense one")
+    parser.add_argument("--svd_components", type=int, default=0,
+                        help="reduce the fingerprints to this many dimensions with truncated SVD first (0 to disable)")
+    parser.add_argument("--save_map", action='store_true', default=False,
+                        help="also save the embedding with its neighbour index to tsne_map_{experiment}.pkl")
+    parser.add_argument("--project_onto", type=str, default=None,
+                        help="map saved with --save_map: place the input compounds in it instead of computing a new embedding")
+    parser.add_argument("--map_neighbors", type=int, default=10, help="number of reference neighbours used to place a compound")
     args = parser.parse_args()
 
-    data = []
-    print("Loading data...")
-    with h5py.File(args.input_file, "r") as f:
-        feature = f["feature"][:]
-
-    print("Running TSNE...")
     t_start = time.time()
-    data_embedded = TSNE(n_components=2, n_jobs=args.n_jobs, 
-                         perplexity=args.perplexity, random_state=0).fit_transform(feature)
+    names, paths = parse_input_files(args.input_file)
+    with timer("Loading data"):
+        feature, lengths = load_feature_files(paths, sparse=args.sparse)
+    for name, length in zip(names, lengths):
+        print(f"Loaded {length} fingerprints of {name}")
+
+    if args.project_onto:
+        # The reference embedding stays fixed, only the new compounds are placed
+        embedding_map = EmbeddingMap.load(args.project_onto)
+        data_embedded = embedding_map.project(feature)
+    else:
+        metric = args.metric
+        svd = None
+        if args.svd_components:
+            feature, svd = reduce_dimensions(feature, args.svd_components, random_state=args.seed)
+            if metric == "jaccard":
+                print("The reduced features are not binary, using the euclidean metric instead of jaccard")
+                metric = "euclidean"
+
+        data_embedded = embed(feature, method=args.method, backend=args.backend, metric=metric, perplexity=args.perplexity,
+                              n_neighbors=args.n_neighbors, n_jobs=args.n_jobs, random_state=args.seed)
+        if args.save_map:
+            EmbeddingMap.fit(feature, data_embedded, metric, args.map_neighbors, svd, args.n_jobs) \
+                .save(os.path.join(args.save_path, f"tsne_map_{args.experiment}.pkl"))
     print('Time elapsed: {} seconds'.format(time.time()-t_start))
 
     print("Saving data...")
     with open(os.path.join(args.save_path, f"data_embedded_{args.experiment}.pkl"), "wb") as f:
         pickle.dump(data_embedded, f)
-
+    write_embedding_store(os.path.join(args.save_path, f"data_embedded_{args.experiment}.h5"), data_embedded, names, lengths)
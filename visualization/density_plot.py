@@ -0,0 +1,150 @@
+import os
+import sys
+import argparse
+import time
+import h5py
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+from matplotlib.lines import Line2D
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from io_utils import read_embedding_index, load_embedding
+
+# Colour, marker size and opacity of each dataset of the paper figures
+VIS_META = {'broad_broad_cp_140k':{'color':'#3BCDFF', 'size':0.1, 'alpha':0.1},
+ 'broad_CK1a_HTS_SPR_binder':{'color':'#9E77C3', 'size':10.0, 'alpha':1.0},
+ 'broad_CK1d_HTS_SPR_binder':{'color':'#9E77C3', 'size':10.0, 'alpha':1.0},
+ 'literature_CK1a_pharos': {'color':'#E584C8', 'size':10.0, 'alpha':1.0},
+ 'literature_CK1d_pharos': {'color':'#E584C8', 'size':10.0, 'alpha':1.0},
+ 'hitgen_CK1a_orthosteric':{'color':'#FF0000', 'size':0.01, 'alpha':0.1},
+ 'hitgen_CK1d_orthosteric':{'color':'#FF0000', 'size':0.01, 'alpha':0.1},
+ 'hitgen_negative':{'color':'#0B7743', 'size':0.1, 'alpha':0.1},
+ 'msigma_CK1a_orthosteric':{'color':'#FF8B25', 'size':0.01, 'alpha':0.1},
+ 'msigma_CK1d_orthosteric':{'color':'#FF8B25', 'size':0.01, 'alpha':0.1},
+ 'msigma_negative':{'color':'#8B8B8B', 'size':0.1, 'alpha':0.1},
+ 'dos-del_CK1a_orthosteric':{'color':'#2075B4', 'size':0.1, 'alpha':0.1},
+ 'dos-del_CK1d_orthosteric':{'color':'#2075B4', 'size':0.1, 'alpha':0.1},
+ 'dos-del_negative':{'color':'#BCBD21', 'size':0.1, 'alpha':0.1},
+ }
+
+# Marker size and opacity of the datasets missing from VIS_META (e.g. the file-stem names written by tsne.py),
+# which are coloured with the matplotlib colour cycle
+DEFAULT_SIZE = 1.0
+DEFAULT_ALPHA = 0.5
+
+# Small sets of known binders that are drawn as markers on top of the density image
+HIGHLIGHT_SUFFIXES = ('HTS_SPR_binder', 'pharos')
+
+def is_highlight(name):
+    return name.endswith(HIGHLIGHT_SUFFIXES)
+
+def dataset_styles(names, vis_meta=VIS_META):
+    """Colour, marker size and opacity of each dataset, from `vis_meta` or the defaults for unknown names"""
+    cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    unknown = [name for name in names if name not in vis_meta]
+    styles = {name: {'color': cycle[i % len(cycle)], 'size': DEFAULT_SIZE, 'alpha': DEFAULT_ALPHA} for i, name in enumerate(unknown)}
+    styles.update({name: vis_meta[name] for name in names if name in vis_meta})
+    return styles
+
+def compute_extent(point_sets, padding=0.02):
+    """Bounding box (xmin, xmax, ymin, ymax) of several point sets with a relative padding ((-1, 1, -1, 1) if
+    every set is empty)"""
+    points = [p for p in point_sets if len(p)]
+    if not points:
+        return -1.0, 1.0, -1.0, 1.0
+    xmin = min(p[:, 0].min() for p in points)
+    xmax = max(p[:, 0].max() for p in points)
+    ymin = min(p[:, 1].min() for p in points)
+    ymax = max(p[:, 1].max() for p in points)
+    dx, dy = (xmax - xmin) * padding or 1.0, (ymax - ymin) * padding or 1.0
+    return xmin - dx, xmax + dx, ymin - dy, ymax + dy
+
+def rasterize(points, extent, resolution):
+    """Count the points falling in each pixel of a `resolution` x `resolution` grid
+    Args:
+        points (np.ndarray): Array of shape (n, 2)
+        extent (tuple): (xmin, xmax, ymin, ymax) of the grid
+        resolution (int): Number of pixels along each axis
+    Returns:
+        np.ndarray: Counts of shape (resolution, resolution), rows along y
+    """
+    xmin, xmax, ymin, ymax = extent
+    col = ((points[:, 0] - xmin) / (xmax - xmin) * resolution).astype(np.int64)
+    row = ((points[:, 1] - ymin) / (ymax - ymin) * resolution).astype(np.int64)
+    inside = (col >= 0) & (col < resolution) & (row >= 0) & (row < resolution)
+    counts = np.bincount(row[inside] * resolution + col[inside], minlength=resolution * resolution)
+    return counts.reshape(resolution, resolution)
+
+def blend_categories(counts, colors, min_alpha=0.2):
+    """Blend the density images of several categories into one RGBA image
+    The colour of a pixel is the mean of the category colours weighted by log(1 + count), so a large
+    category does not completely hide a small one sharing the same pixels, and the opacity grows with
+    the log of the total count.
+    Args:
+        counts (list): Count images of shape (H, W), one per category
+        colors (list): Matplotlib colours, one per category
+        min_alpha (float): Opacity of the pixels holding a single point
+    Returns:
+        np.ndarray: RGBA image of shape (H, W, 4)
+    """
+    weights = np.stack([np.log1p(c) for c in counts]).astype(np.float32)
+    rgb = np.array([to_rgb(color) for color in colors], dtype=np.float32)
+    total_weight = weights.sum(axis=0)
+    image = np.zeros(weights.shape[1:] + (4,), dtype=np.float32)
+    occupied = total_weight > 0
+    image[..., :3][occupied] = np.einsum("chw,cd->hwd", weights, rgb)[occupied] / total_weight[occupied, None]
+    total = np.log1p(np.sum(counts, axis=0).astype(np.float32))
+    if total.max() > 0:
+        image[..., 3] = np.where(occupied, min_alpha + (1 - min_alpha) * total / total.max(), 0)
+    return image
+
+def plot_density(datasets, vis_meta=VIS_META, ax=None, resolution=1000, extent=None):
+    """Plot embedded datasets as a blended density image, with the highlight sets as markers
+    Args:
+        datasets (dict): Dataset name -> points of shape (n, 2), in drawing order
+        vis_meta (dict): Dataset name -> {'color', 'size', 'alpha'} (only `color` is used for the density image).
+            Datasets missing from it get a colour of the matplotlib cycle and the default size and opacity
+        ax (matplotlib.axes.Axes, optional): Axes to draw on. Defaults to the current axes
+        resolution (int): Number of pixels along each axis of the density image
+        extent (tuple, optional): (xmin, xmax, ymin, ymax). Defaults to the bounding box of all points
+    Returns:
+        matplotlib.axes.Axes: The axes
+    """
+    ax = ax or plt.gca()
+    vis_meta = dataset_styles(list(datasets), vis_meta)
+    extent = extent or compute_extent(list(datasets.values()))
+    dense = [name for name in datasets if not is_highlight(name)]
+    if dense:
+        image = blend_categories([rasterize(datasets[name], extent, resolution) for name in dense],
+                                 [vis_meta[name]['color'] for name in dense])
+        ax.imshow(image, extent=extent, origin='lower', interpolation='nearest', aspect='auto')
+    for name in datasets:
+        if is_highlight(name):
+            vis = vis_meta[name]
+            ax.scatter(datasets[name][:, 0], datasets[name][:, 1], color=vis['color'], s=vis['size'], alpha=vis['alpha'])
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+
+    legend_elements = [Line2D([0], [0], marker='o', color='w', label=name,
+                              markerfacecolor=vis_meta[name]['color'], markersize=10) for name in datasets]
+    ax.legend(handles=legend_elements, loc='upper right', bbox_to_anchor=(1.53, 1.02))
+    return ax
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, required=True, help="embedding store (data_embedded_{experiment}.h5) written by tsne.py")
+    parser.add_argument("--output_file", type=str, required=True, help="image to save (e.g. CK1a.png)")
+    parser.add_argument("--datasets", type=str, nargs='*', default=None,
+                        help="datasets to plot, in drawing order. Defaults to all datasets of the store")
+    parser.add_argument("--resolution", type=int, default=1000, help="number of pixels along each axis of the density image")
+    parser.add_argument("--dpi", type=int, default=300, help="resolution of the saved image")
+    args = parser.parse_args()
+
+    t_start = time.time()
+    with h5py.File(args.input_file, 'r') as f:
+        names = args.datasets or list(read_embedding_index(f))
+        datasets = {name: load_embedding(f, name) for name in names}
+    fig, ax = plt.subplots()
+    plot_density(datasets, ax=ax, resolution=args.resolution)
+    fig.savefig(args.output_file, dpi=args.dpi, bbox_inches='tight')
+    print(f"Plotted {sum(len(points) for points in datasets.values())} points in {time.time() - t_start:.1f} seconds")